@@ -7,6 +7,48 @@ let model = null;
 let trialEmbeddings = null;
 let trialsMap = null;
 
+// Binary export written by backend/embedding_export.py: unit-length rows in one typed array
+function loadBinaryEmbeddings(dir) {
+  const idsPath = path.join(dir, 'trial_embeddings.ids.json');
+  const binPath = path.join(dir, 'trial_embeddings.bin');
+  if (!fs.existsSync(idsPath) || !fs.existsSync(binPath)) {
+    return null;
+  }
+
+  const { dtype, dim, count, scales, ids } = JSON.parse(fs.readFileSync(idsPath, 'utf8'));
+  const buffer = fs.readFileSync(binPath);
+  let vectors;
+  if (dtype === 'int8') {
+    vectors = new Int8Array(buffer.buffer, buffer.byteOffset, count * dim);
+  } else if (buffer.byteOffset % 4 === 0) {
+    vectors = new Float32Array(buffer.buffer, buffer.byteOffset, count * dim);
+  } else {
+    // Small files can land unaligned in Node's shared buffer pool
+    vectors = new Float32Array(buffer.buffer.slice(buffer.byteOffset, buffer.byteOffset + buffer.length));
+  }
+  return { ids, dim, count, vectors, scales: scales ? Float32Array.from(scales) : null };
+}
+
+// Legacy trial_embeddings.json from generate-embeddings.js, packed into the same layout
+function loadJsonEmbeddings(dir) {
+  const embeddingsData = JSON.parse(fs.readFileSync(path.join(dir, 'trial_embeddings.json'), 'utf8'));
+  const ids = Object.keys(embeddingsData);
+  const dim = ids.length ? embeddingsData[ids[0]].length : 0;
+  const vectors = new Float32Array(ids.length * dim);
+  ids.forEach((nctId, row) => {
+    const vec = embeddingsData[nctId];
+    let norm = 0;
+    for (let d = 0; d < dim; d++) {
+      norm += vec[d] * vec[d];
+    }
+    norm = Math.sqrt(norm) || 1;
+    for (let d = 0; d < dim; d++) {
+      vectors[row * dim + d] = vec[d] / norm;
+    }
+  });
+  return { ids, dim, count: ids.length, vectors, scales: null };
+}
+
 async function initializeMatcher() {
   if (model && trialEmbeddings && trialsMap) {
     return; // Already initialized
@@ -15,10 +57,8 @@ async function initializeMatcher() {
   // Load the model
   model = await pipeline('feature-extraction', 'Xenova/all-MiniLM-L6-v2');
 
-  // Load pre-computed trial embeddings
-  const embeddingsPath = path.join(process.cwd(), 'trial_embeddings.json');
-  const embeddingsData = fs.readFileSync(embeddingsPath, 'utf8');
-  trialEmbeddings = JSON.parse(embeddingsData);
+  // Load pre-computed trial embeddings, preferring the compact binary export
+  trialEmbeddings = loadBinaryEmbeddings(process.cwd()) || loadJsonEmbeddings(process.cwd());
 
   // Load trial data to map NCTId back to trial info
   const csvPath = path.join(process.cwd(), 'filtered_trials.csv');
@@ -44,14 +84,49 @@ function meanPool(embeddings) {
   return avg;
 }
 
-function cosineSimilarity(a, b) {
-  let dot = 0, normA = 0, normB = 0;
-  for (let i = 0; i < a.length; i++) {
-    dot += a[i] * b[i];
-    normA += a[i] * a[i];
-    normB += b[i] * b[i];
+// Rows are unit length, so a dot product with the normalized query is the cosine similarity
+function scoreTrials({ vectors, dim, count, scales }, query) {
+  const weights = new Float32Array(dim);
+  let norm = 0;
+  for (let d = 0; d < dim; d++) {
+    norm += query[d] * query[d];
+  }
+  norm = Math.sqrt(norm) || 1;
+  for (let d = 0; d < dim; d++) {
+    // int8 rows hold value / scales[d]; folding the scale into the query keeps the loop multiply-add
+    weights[d] = (query[d] / norm) * (scales ? scales[d] : 1);
+  }
+
+  const scores = new Float32Array(count);
+  for (let row = 0, offset = 0; row < count; row++, offset += dim) {
+    let dot = 0;
+    for (let d = 0; d < dim; d++) {
+      dot += vectors[offset + d] * weights[d];
+    }
+    scores[row] = dot;
+  }
+  return scores;
+}
+
+// Best `k` rows passing `accept`, best first, without sorting every score
+function topKRows(scores, k, accept) {
+  const top = [];
+  for (let row = 0; row < scores.length; row++) {
+    const score = scores[row];
+    if (top.length === k && score <= top[k - 1].score) {
+      continue;
+    }
+    if (!accept(row)) {
+      continue;
+    }
+    let i = top.length < k ? top.length : k - 1;
+    while (i > 0 && top[i - 1].score < score) {
+      top[i] = top[i - 1];
+      i--;
+    }
+    top[i] = { row, score };
   }
-  return dot / (Math.sqrt(normA) * Math.sqrt(normB));
+  return top;
 }
 
 export default async function handler(req, res) {
@@ -79,22 +154,16 @@ export default async function handler(req, res) {
     const patientEmbeddingTokens = await model(patientDescription, { pooling: 'mean', normalize: true });
     const patientEmbedding = patientEmbeddingTokens.data;
     
-    const nctIds = Object.keys(trialEmbeddings);
+    const nctIds = trialEmbeddings.ids;
 
     // Compute similarities
-    const similarities = nctIds.map(nctId => {
-        const trialEmbedding = trialEmbeddings[nctId];
-        return cosineSimilarity(patientEmbedding, trialEmbedding);
-    });
+    const similarities = scoreTrials(trialEmbeddings, patientEmbedding);
 
-    // Get topK indices
-    const topResults = similarities
-      .map((score, idx) => ({ score, idx }))
-      .sort((a, b) => b.score - a.score)
-      .slice(0, topK);
+    // Get topK rows; the binary export may cover trials missing from filtered_trials.csv
+    const topResults = topKRows(similarities, topK, row => trialsMap.has(nctIds[row]));
       
     const matches = topResults.map(item => {
-        const nctId = nctIds[item.idx];
+        const nctId = nctIds[item.row];
         const trial = trialsMap.get(nctId);
         return {
           ...trial, // Return all data from the CSV row
@@ -0,0 +1,272 @@
+"""
+Append-only audit log of match requests.
+
+Handlers only build a small record and put it on a bounded in-memory queue;
+a background thread drains the queue in batches and appends each batch as one
+gzip member to the current segment file.  Segments rotate by size and age:
+
+    audit-20261019T120000-<pid>-0001.jsonl.gz.open   still being written
+    audit-20261019T120000-<pid>-0001.jsonl.gz        sealed, never touched again
+
+Patient descriptions are never written.  A record keeps an HMAC-SHA256 of the
+text (keyed by MATCH_AUDIT_KEY, so equal descriptions can be correlated without
+being readable) plus its length, the request parameters, the outcome and the
+returned NCTIds.  Coordinates are rounded to whole degrees.  When the queue is
+full the record is dropped and counted rather than slowing the request down.
+
+The reader tolerates a torn last batch (crash mid-write), and load_test.py
+--trace replays a directory of segments as a traffic trace:
+
+    python audit.py audit_logs
+    python load_test.py --trace audit_logs --trace-speed 4
+"""
+import argparse
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import metrics
+
+AUDIT_EVENTS = metrics.REGISTRY.counter(
+    'audit_events_total', 'Audit records by outcome (queued, dropped, written, failed)', ['result'])
+AUDIT_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'audit_queue_depth', 'Audit records waiting for the background writer')
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+OPEN_SUFFIX = '.open'
+
+
+def redact(description: str, key: bytes) -> Dict:
+    return {
+        'hmac': hmac.new(key, description.encode('utf-8'), hashlib.sha256).hexdigest(),
+        'chars': len(description),
+        'words': len(description.split()),
+    }
+
+
+def coarse_location(location: Optional[Dict]) -> Optional[Dict]:
+    if not location:
+        return None
+    coarse = dict(location)
+    for name in ('latitude', 'longitude'):
+        if coarse.get(name) is not None:
+            coarse[name] = round(float(coarse[name]))
+    return coarse
+
+
+class AuditLog:
+    def __init__(self, directory: str, key: Optional[bytes] = None, max_queue: int = 10000,
+                 batch_size: int = 256, flush_interval: float = 1.0,
+                 segment_bytes: int = 16 * 2 ** 20, segment_seconds: float = 3600.0,
+                 service: str = 'bert_api'):
+        self.directory = directory
+        if not key:
+            print("MATCH_AUDIT_KEY not set; description hashes only correlate within this process")
+            key = os.urandom(32)
+        self.key = key
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.service = service
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._segment = None
+        self._segment_path = None
+        self._segment_opened = 0.0
+        self._sequence = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def start(self):
+        if self._thread is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._writer, name='audit-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def record(self, event: Dict) -> bool:
+        """Queue one record without blocking; False if it was dropped."""
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            AUDIT_EVENTS.inc(result='dropped')
+            return False
+        AUDIT_EVENTS.inc(result='queued')
+        AUDIT_QUEUE_DEPTH.inc()
+        return True
+
+    def record_match(self, endpoint: str, description: str, status: int, started: float,
+                     nct_ids: Sequence[str] = (), snapshot_version: Optional[str] = None,
+                     ok: Optional[bool] = None, **params) -> bool:
+        """`started` is the wall-clock (time.time()) arrival; params are the request options."""
+        if params.get('location') is not None:
+            params['location'] = coarse_location(params['location'])
+        return self.record({
+            'ts': started,
+            'service': self.service,
+            'endpoint': endpoint,
+            'status': status,
+            'ok': status < 400 if ok is None else ok,
+            'latency_ms': round((time.time() - started) * 1000, 3),
+            'snapshot_version': snapshot_version,
+            'description': redact(description, self.key),
+            'params': params,
+            'nct_ids': [str(i) for i in nct_ids],
+        })
+
+    def _writer(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if batch:
+                AUDIT_QUEUE_DEPTH.dec(len(batch))
+                self._write(batch)
+            elif self._segment is not None and self._segment_expired():
+                self._seal()
+        self._seal()
+
+    def _write(self, batch: List[Dict]):
+        lines = ''.join(json.dumps(e, separators=(',', ':')) + '\n' for e in batch)
+        # One gzip member per batch: a crash can only lose the member being written
+        data = gzip.compress(lines.encode('utf-8'))
+        try:
+            if self._segment is not None and self._segment_expired():
+                self._seal()
+            if self._segment is None:
+                self._open_segment()
+            self._segment.write(data)
+            self._segment.flush()
+        except OSError as e:
+            print(f"Error writing audit batch of {len(batch)}: {e}")
+            self.failed += len(batch)
+            AUDIT_EVENTS.inc(len(batch), result='failed')
+            self._seal()
+            return
+        self.written += len(batch)
+        AUDIT_EVENTS.inc(len(batch), result='written')
+
+    def _segment_expired(self) -> bool:
+        return (self._segment.tell() >= self.segment_bytes
+                or time.time() - self._segment_opened >= self.segment_seconds)
+
+    def _open_segment(self):
+        self._sequence += 1
+        self._segment_opened = time.time()
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(self._segment_opened))
+        name = f"audit-{stamp}-{os.getpid()}-{self._sequence:04d}{SEGMENT_SUFFIX}"
+        self._segment_path = os.path.join(self.directory, name)
+        self._segment = open(self._segment_path + OPEN_SUFFIX, 'ab')
+
+    def _seal(self):
+        if self._segment is None:
+            return
+        try:
+            self._segment.close()
+            os.replace(self._segment_path + OPEN_SUFFIX, self._segment_path)
+        except OSError as e:
+            print(f"Error sealing audit segment {self._segment_path}: {e}")
+        self._segment = None
+
+    def close(self, timeout: float = 10.0):
+        """Drain the queue, seal the current segment and stop the writer."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def status(self) -> Dict:
+        return {
+            'directory': self.directory,
+            'queued': self._queue.qsize(),
+            'max_queue': self._queue.maxsize,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+def segment_files(directory: str, include_open: bool = True) -> List[str]:
+    files = glob.glob(os.path.join(directory, f"audit-*{SEGMENT_SUFFIX}"))
+    if include_open:
+        files += glob.glob(os.path.join(directory, f"audit-*{SEGMENT_SUFFIX}{OPEN_SUFFIX}"))
+    return sorted(files)
+
+
+def read_segment(path: str) -> Iterator[Dict]:
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+    except (EOFError, gzip.BadGzipFile, zlib.error, json.JSONDecodeError) as e:
+        # A torn last member; everything before it was already yielded
+        print(f"Stopped reading {os.path.basename(path)} at a damaged batch: {e}")
+
+
+def read_events(directory: str, include_open: bool = True) -> Iterator[Dict]:
+    for path in segment_files(directory, include_open):
+        yield from read_segment(path)
+
+
+def load_trace(directory: str, endpoints: Optional[Sequence[str]] = None,
+               limit: Optional[int] = None) -> List[Dict]:
+    """Match records in arrival order, for replay by load_test.py."""
+    events = [e for e in read_events(directory) if endpoints is None or e.get('endpoint') in endpoints]
+    events.sort(key=lambda e: e['ts'])
+    return events[:limit] if limit else events
+
+
+def summarize(events: List[Dict]) -> Dict:
+    if not events:
+        return {'events': 0}
+    span = events[-1]['ts'] - events[0]['ts']
+    words = sorted(e['description']['words'] for e in events)
+    return {
+        'events': len(events),
+        'span_s': span,
+        'rate_rps': len(events) / span if span > 0 else None,
+        'endpoints': dict(Counter(e['endpoint'] for e in events)),
+        'status': dict(Counter(str(e['status']) for e in events)),
+        'engines': dict(Counter(str(e['params'].get('engine')) for e in events)),
+        'distinct_descriptions': len({e['description']['hmac'] for e in events}),
+        'median_words': words[len(words) // 2],
+        'returned_trials': sum(len(e['nct_ids']) for e in events),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize match audit segments")
+    parser.add_argument('directory', nargs='?', default='audit_logs')
+    parser.add_argument('--endpoint', action='append', help="only these endpoints (repeatable)")
+    args = parser.parse_args()
+
+    events = load_trace(args.directory, args.endpoint)
+    print(f"{len(segment_files(args.directory))} segments in {args.directory}")
+    for name, value in summarize(events).items():
+        print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
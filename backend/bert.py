@@ -2,37 +2,79 @@ import streamlit as st
 import pandas as pd
 import torch
 import numpy as np
-from transformers import BertTokenizer, BertModel
-from sklearn.metrics.pairwise import cosine_similarity
+import hashlib
+import os
+from transformers import BertTokenizerFast, BertModel
+
+MODEL_NAME = 'bert-base-uncased'
+TRIALS_CSV = "all_conditions_trials.csv"
+MAX_LENGTH = 512
+BATCH_SIZE = 16
+# Trial embeddings are keyed by CSV contents + model, so restarts skip the encode entirely
+EMBEDDINGS_CACHE_DIR = os.environ.get("BERT_DEMO_CACHE_DIR", ".bert_demo_cache")
 
 @st.cache_resource
 def load_bert_model():
-    tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
-    model = BertModel.from_pretrained('bert-base-uncased')
+    # The Rust-backed fast tokenizer batch-tokenizes far quicker than the pure-Python BertTokenizer
+    tokenizer = BertTokenizerFast.from_pretrained(MODEL_NAME)
+    model = BertModel.from_pretrained(MODEL_NAME)
     model.eval()
     return tokenizer, model
 
 tokenizer, model = load_bert_model()
 
+def encode_texts(texts, batch_size=BATCH_SIZE):
+    """Mean-pooled BERT embeddings, batched by token length so little work is spent on padding."""
+    lengths = [len(ids) for ids in tokenizer(texts, truncation=True, max_length=MAX_LENGTH)["input_ids"]]
+    order = np.argsort(lengths, kind="stable")
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+    for start in range(0, len(texts), batch_size):
+        batch = order[start:start + batch_size]
+        inputs = tokenizer([texts[i] for i in batch], return_tensors="pt", truncation=True,
+                           padding=True, max_length=MAX_LENGTH)
+        with torch.inference_mode():
+            hidden = model(**inputs).last_hidden_state
+        # Average real tokens only; padding must not dilute shorter texts in the batch
+        mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+        embeddings[batch] = ((hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)).numpy()
+    return embeddings
+
 def get_bert_embedding(text):
-    inputs = tokenizer(text, return_tensors="pt", truncation=True, padding=True, max_length=512)
-    with torch.no_grad():
-        outputs = model(**inputs)
-    return outputs.last_hidden_state.mean(dim=1).squeeze().numpy()
+    return encode_texts([text])[0]
+
+def embeddings_cache_path(csv_file):
+    digest = hashlib.sha1(f"{MODEL_NAME}:{MAX_LENGTH}:masked-mean".encode())
+    with open(csv_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return os.path.join(EMBEDDINGS_CACHE_DIR, f"trial_embeddings-{digest.hexdigest()[:16]}.npy")
 
-@st.cache_data
+@st.cache_resource
 def load_trials():
-    df = pd.read_csv("all_conditions_trials.csv")
+    df = pd.read_csv(TRIALS_CSV)
     df["full_text"] = (
         df["Condition"].fillna('') + " " +
         df["BriefSummary"].fillna('') + " " +
         df["InclusionCriteria"].fillna('') + " " +
         df["ExclusionCriteria"].fillna('')
     )
-    df["embedding"] = df["full_text"].apply(get_bert_embedding)
-    return df
+    
+    cache_path = embeddings_cache_path(TRIALS_CSV)
+    if os.path.exists(cache_path):
+        embeddings = np.load(cache_path)
+    else:
+        embeddings = encode_texts(df["full_text"].tolist())
+        os.makedirs(EMBEDDINGS_CACHE_DIR, exist_ok=True)
+        tmp_path = cache_path + ".tmp.npy"
+        np.save(tmp_path, embeddings)
+        os.replace(tmp_path, cache_path)
+    
+    # One resident, row-normalized matrix: a query is a single matrix-vector product
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return df, embeddings / norms
 
-df = load_trials()
+df, trial_matrix = load_trials()
 
 st.title("🧬 Match Patients to Clinical Trials using BERT")
 patient_description = st.text_area("Paste your clinical patient description below:", height=250)
@@ -41,9 +83,8 @@ if st.button("Find Matching Trials"):
     if not patient_description.strip():
         st.warning("Please enter a valid description.")
     else:
-        patient_emb = get_bert_embedding(patient_description).reshape(1, -1)
-        trial_embeddings = np.vstack(df["embedding"].to_numpy())
-        similarities = cosine_similarity(patient_emb, trial_embeddings)[0]
+        patient_emb = get_bert_embedding(patient_description)
+        similarities = trial_matrix @ (patient_emb / (np.linalg.norm(patient_emb) or 1.0))
         top_k = 5
         top_indices = similarities.argsort()[::-1][:top_k]
 
@@ -1,10 +1,22 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Optional
 import uvicorn
-from bert_matcher import ClinicalTrialMatcher
+from bert_matcher import ClinicalTrialMatcher, resolve_fields
+from serialization import FastJSONResponse, ndjson_response
+from profiler import MatchProfiler
+from snapshots import Snapshot, SnapshotBuilder, SnapshotManager
+from geo import GeoQuery
+from sharding import ShardUnavailable
+from inference import ExecutorSaturated, InferenceExecutor, InferenceTimeout
+from audit import AuditLog
+from contextlib import nullcontext
+import metrics
+import itertools
 import os
+import time
 
 app = FastAPI(title="Clinical Trial BERT Matcher API")
 
@@ -16,10 +28,44 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    metrics.INFLIGHT_REQUESTS.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.INFLIGHT_REQUESTS.dec()
+        # Label by route template so /trial/{nct_id} doesn't explode cardinality
+        route = request.scope.get("route")
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            path=getattr(route, "path", "unmatched"),
+            status=str(status),
+        )
+
+class PatientLocation(BaseModel):
+    latitude: float
+    longitude: float
+    radius_km: float = 100.0
+    # 0 only filters by radius; up to 1 blends proximity into the ranking (see geo.GeoQuery)
+    distance_weight: float = 0.0
+
 class PatientRequest(BaseModel):
     description: str
-    top_k: Optional[int] = 5
-    similarity_threshold: Optional[float] = 0.3
+    top_k: Optional[int] = Field(5, ge=1)
+    # None uses the engine's default: 0.3 for dense (and int8 / pq), 0.0 for tfidf and keyword
+    similarity_threshold: Optional[float] = None
+    # Projection, e.g. ["nct_id", "similarity"]; nct_id and similarity are always included
+    fields: Optional[List[str]] = None
+    # Scorer engine: dense (sentence-transformer), tfidf, keyword, or compressed dense (int8 / pq)
+    engine: str = 'dense'
+    # Only trials with a site within radius_km of the patient; needs MATCH_SITES_CSV
+    location: Optional[PatientLocation] = None
 
 class TrialResponse(BaseModel):
     nct_id: Optional[str]
@@ -39,70 +85,304 @@ class TrialResponse(BaseModel):
     lead_sponsor: Optional[str]
     sponsor_type: Optional[str]
     similarity: float
+    # Set for location queries: distance to the trial's nearest site and that site
+    distance_km: Optional[float] = None
+    nearest_site: Optional[Dict[str, Any]] = None
+    # NCTIds folded into this trial as near-duplicates (see dedup.py)
+    duplicates: Optional[List[str]] = None
 
 class MatchResponse(BaseModel):
     matches: List[TrialResponse]
     total_found: int
+    snapshot_version: Optional[str] = None
+
+SIMILAR_TRIAL_FIELDS = ['title', 'condition', 'status', 'phase', 'country']
+
+# Engines share the matcher's trial store, embeddings and model; only enabled ones build an index
+ENABLED_ENGINES = [e.strip() for e in os.environ.get('MATCH_ENGINES', 'dense,tfidf,keyword').split(',') if e.strip()]
+
+SNAPSHOT_HEADER = "X-Snapshot-Version"
 
-matcher = None
+snapshot_builder = SnapshotBuilder(
+    csv_file=os.environ.get('MATCH_TRIALS_CSV', 'all_conditions_trials.csv'),
+    embeddings_file=os.environ.get('MATCH_EMBEDDINGS_FILE', 'trial_embeddings.pt'),
+    # Built offline by similarity_graph.py; /trial/{nct_id}/similar is unavailable without it
+    neighbors_file=os.environ.get('MATCH_NEIGHBORS_FILE', 'trial_neighbors.npz'),
+    engines=ENABLED_ENGINES,
+    profiler=MatchProfiler.from_env(),
+    # >1 spreads dense matching over that many worker processes (other engines are disabled)
+    shards=int(os.environ.get('MATCH_SHARDS', '1')),
+    # int8 or pq: shard workers score compressed codes; with 0 re-rank candidates they drop the float matrix
+    shard_quantization=os.environ.get('MATCH_SHARD_QUANTIZATION') or None,
+    # Exact re-rank depth for int8 / pq, in-process or on shards (never less than top_k)
+    rerank_candidates=int(os.environ.get('MATCH_RERANK_CANDIDATES', '100')),
+    # Dense results for canonical queries and the most common conditions, rebuilt with each snapshot
+    result_cache=os.environ.get('MATCH_RESULT_CACHE', '1') != '0',
+    cache_queries_file=os.environ.get('MATCH_CACHE_QUERIES_FILE', 'canonical_queries.txt'),
+    cache_conditions=int(os.environ.get('MATCH_CACHE_CONDITIONS', '50')),
+    cache_min_similarity=float(os.environ.get('MATCH_CACHE_MIN_SIMILARITY', '0.97')),
+    # Per-site records from clinical_data_extraction.py, indexed for location queries
+    sites_file=os.environ.get('MATCH_SITES_CSV', 'all_conditions_sites.csv'),
+    # Fold near-duplicate trials into one indexed representative at load; off for a CSV from dedup.py
+    dedup=os.environ.get('MATCH_DEDUP', '0') != '0',
+    dedup_threshold=float(os.environ.get('MATCH_DEDUP_THRESHOLD', '0.8')),
+)
+snapshots = SnapshotManager(snapshot_builder.build)
+
+# CPU-heavy work runs here, never on the event loop; a full queue answers 429 instead of queueing
+inference = InferenceExecutor(
+    workers=int(os.environ.get('MATCH_INFERENCE_WORKERS', '0')) or None,
+    queue_size=int(os.environ.get('MATCH_INFERENCE_QUEUE', '32')),
+    timeout=float(os.environ.get('MATCH_REQUEST_TIMEOUT', '30')),
+    threads_per_worker=int(os.environ.get('MATCH_THREADS_PER_WORKER', '0')) or None,
+)
+
+# Every match request and the NCTIds it returned, written off the request path; unset disables
+audit_log = AuditLog(
+    os.environ['MATCH_AUDIT_DIR'],
+    key=os.environ.get('MATCH_AUDIT_KEY', '').encode('utf-8'),
+    max_queue=int(os.environ.get('MATCH_AUDIT_QUEUE', '10000')),
+    segment_bytes=int(os.environ.get('MATCH_AUDIT_SEGMENT_MB', '16')) * 2 ** 20,
+) if os.environ.get('MATCH_AUDIT_DIR') else None
 
 @app.on_event("startup")
 async def startup_event():
-    global matcher
     try:
-        matcher = ClinicalTrialMatcher()
-        csv_file = 'all_conditions_trials.csv'
-        
-        if not os.path.exists(csv_file):
-            raise FileNotFoundError(f"CSV file {csv_file} not found")
-        
-        matcher.load_trials_data(csv_file)
-        
-        embeddings_file = 'trial_embeddings.pt'
-        if not matcher.load_embeddings(embeddings_file):
-            print("Computing embeddings...")
-            matcher.compute_embeddings()
-            matcher.save_embeddings(embeddings_file)
-        
+        inference.start()
+        if audit_log is not None:
+            audit_log.start()
+        snapshots.reload(background=False)
+        # Picks up new CSV / embeddings / graph files without a restart; 0 disables
+        snapshots.watch(lambda: snapshot_builder.watched_files,
+                        interval=float(os.environ.get('MATCH_WATCH_INTERVAL', '10')))
         print("BERT API initialized successfully")
     except Exception as e:
         print(f"Error initializing BERT API: {e}")
         raise
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    if audit_log is not None:
+        audit_log.close()
+
+def _snapshot(response: Optional[Response] = None) -> Snapshot:
+    """The snapshot a request works against; read once so a reload can't change it mid-request."""
+    snapshot = snapshots.current
+    if snapshot is None:
+        raise HTTPException(status_code=500, detail="Matcher not initialized")
+    if response is not None:
+        response.headers[SNAPSHOT_HEADER] = snapshot.version
+    return snapshot
+
+async def _run(fn, *args, **kwargs):
+    """Run blocking match work on the inference pool, mapping saturation and timeouts to HTTP errors."""
+    try:
+        return await inference.run(fn, *args, **kwargs)
+    except ExecutorSaturated as e:
+        raise HTTPException(status_code=429, detail=f"Server busy: {e}", headers={"Retry-After": "1"})
+    except InferenceTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+def _audit(endpoint: str, request: PatientRequest, status: int, started: float,
+           nct_ids: List[str], snapshot: Optional[Snapshot]):
+    if audit_log is None:
+        return
+    location = request.location
+    audit_log.record_match(
+        endpoint, request.description, status, started, nct_ids,
+        snapshot_version=snapshot.version if snapshot is not None else None,
+        top_k=request.top_k,
+        similarity_threshold=request.similarity_threshold,
+        fields=request.fields,
+        engine=request.engine,
+        location={"latitude": location.latitude, "longitude": location.longitude,
+                  "radius_km": location.radius_km, "distance_weight": location.distance_weight}
+                 if location is not None else None
+    )
+
 @app.get("/")
 async def root():
     return {"message": "Clinical Trial BERT Matcher API", "status": "running"}
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy", "matcher_loaded": matcher is not None}
+    snapshot = snapshots.current
+    return {
+        "status": "healthy",
+        "matcher_loaded": snapshot is not None,
+        "engines": list(snapshot.matcher.engines) if snapshot is not None else [],
+        "snapshot_version": snapshot.version if snapshot is not None else None,
+        "inference": inference.status(),
+        "audit": audit_log.status() if audit_log is not None else None
+    }
+
+@app.get("/stats")
+async def get_stats(response: Response):
+    snapshot = _snapshot(response)
+    return {
+        **snapshot.stats(),
+        "engines": list(snapshot.matcher.engines),
+        "snapshot_version": snapshot.version
+    }
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/admin/reload", status_code=202)
+async def reload_snapshot(x_admin_token: Optional[str] = Header(None)):
+    expected = os.environ.get('MATCH_ADMIN_TOKEN')
+    # CORS is open, so without a configured token the endpoint stays closed
+    if not expected:
+        raise HTTPException(status_code=403, detail="Admin reload disabled: MATCH_ADMIN_TOKEN not set")
+    if x_admin_token != expected:
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    started = snapshots.reload(background=True)
+    return {"reload_started": started, **snapshots.status()}
+
+@app.get("/admin/snapshot")
+async def snapshot_status():
+    return snapshots.status()
 
 @app.post("/match", response_model=MatchResponse)
-async def match_trials(request: PatientRequest):
-    if matcher is None:
-        raise HTTPException(status_code=500, detail="Matcher not initialized")
+async def match_trials(request: PatientRequest, response: Response):
+    started = time.time()
+    snapshot, status, nct_ids = None, 500, []
+    try:
+        snapshot = _snapshot(response)
+        
+        fields = _validated_fields(request.fields)
+        _validate_engine(snapshot.matcher, request.engine)
+        near = _geo_query(snapshot.matcher, request.location)
+        result, nct_ids = await _run(_match, snapshot, request, fields, near)
+        status = 200
+        return result
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    finally:
+        _audit("/match", request, status, started, nct_ids, snapshot)
+
+def _match(snapshot: Snapshot, request: PatientRequest, fields: Optional[List[str]], near: Optional[GeoQuery]):
+    matcher = snapshot.matcher
+    profiling = nullcontext()
+    if matcher.profiler is not None:
+        profiling = matcher.profiler.profile(
+            'match', top_k=request.top_k, engine=request.engine,
+            description_chars=len(request.description))
     
     try:
-        matches = matcher.find_matches(
+        with profiling:
+            matches = matcher.find_matches(
+                request.description,
+                top_k=request.top_k,
+                similarity_threshold=request.similarity_threshold,
+                fields=fields,
+                engine=request.engine,
+                near=near
+            )
+            
+            if fields is not None:
+                # Projected rows don't fit TrialResponse; skip model validation entirely
+                return FastJSONResponse(
+                    {"matches": matches, "total_found": len(matches), "snapshot_version": snapshot.version},
+                    headers={SNAPSHOT_HEADER: snapshot.version}
+                ), [m['nct_id'] for m in matches]
+            
+            with metrics.stage('validate'):
+                return MatchResponse(
+                    matches=matches,
+                    total_found=len(matches),
+                    snapshot_version=snapshot.version
+                ), [m['nct_id'] for m in matches]
+    except ShardUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error matching trials: {str(e)}")
+
+@app.post("/match/stream")
+async def stream_matches(request: PatientRequest):
+    """Newline-delimited JSON, one match per line, materialized as the client reads."""
+    started = time.time()
+    snapshot = None
+    try:
+        snapshot = _snapshot()
+        
+        fields = _validated_fields(request.fields)
+        _validate_engine(snapshot.matcher, request.engine)
+        rows = snapshot.matcher.iter_matches(
             request.description,
             top_k=request.top_k,
-            similarity_threshold=request.similarity_threshold
-        )
-        
-        return MatchResponse(
-            matches=matches,
-            total_found=len(matches)
+            similarity_threshold=request.similarity_threshold,
+            fields=fields,
+            engine=request.engine,
+            near=_geo_query(snapshot.matcher, request.location)
         )
+        # Ranking happens on the first row; the rest is cheap per-row materialization
+        first = await _run(_first_row, rows)
+    except HTTPException as e:
+        _audit("/match/stream", request, e.status_code, started, [], snapshot)
+        raise
+    return ndjson_response(
+        _audited_rows(itertools.chain([first], rows) if first is not None else iter(()),
+                      request, started, snapshot),
+        headers={SNAPSHOT_HEADER: snapshot.version}
+    )
+
+def _first_row(rows):
+    """The first streamed row, with errors mapped to HTTP statuses before the stream starts."""
+    try:
+        return next(rows, None)
+    except ShardUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error matching trials: {str(e)}")
 
+def _audited_rows(rows, request: PatientRequest, started: float, snapshot: Snapshot):
+    """Pass rows through; the audit record is written once the stream ends or the client leaves."""
+    nct_ids, status = [], 200
+    try:
+        for row in rows:
+            nct_ids.append(row['nct_id'])
+            yield row
+    except Exception as e:
+        # The 200 header is already sent; the audit record still shows the failure
+        status = 503 if isinstance(e, ShardUnavailable) else 500
+        raise
+    finally:
+        _audit("/match/stream", request, status, started, nct_ids, snapshot)
+
+def _validated_fields(fields: Optional[List[str]]) -> Optional[List[str]]:
+    try:
+        return resolve_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _validate_engine(matcher: ClinicalTrialMatcher, engine: str):
+    if engine not in matcher.engines:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown or disabled engine '{engine}', available: {', '.join(matcher.engines)}"
+        )
+
+def _geo_query(matcher: ClinicalTrialMatcher, location: Optional[PatientLocation]) -> Optional[GeoQuery]:
+    if location is None:
+        return None
+    if matcher.site_index is None:
+        raise HTTPException(status_code=400, detail="Location search unavailable: trial sites not loaded")
+    try:
+        return GeoQuery(location.latitude, location.longitude, location.radius_km, location.distance_weight)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/trial/{nct_id}")
-async def get_trial_details(nct_id: str):
-    if matcher is None:
-        raise HTTPException(status_code=500, detail="Matcher not initialized")
+async def get_trial_details(nct_id: str, response: Response):
+    matcher = _snapshot(response).matcher
     
     try:
-        trial_details = matcher.get_trial_details(nct_id)
+        trial_details = await _run(matcher.get_trial_details, nct_id)
         if trial_details is None:
             raise HTTPException(status_code=404, detail="Trial not found")
         
@@ -112,5 +392,31 @@ async def get_trial_details(nct_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting trial details: {str(e)}")
 
+@app.get("/trial/{nct_id}/similar")
+async def get_similar_trials(nct_id: str, response: Response, limit: int = Query(10, ge=1),
+                             fields: Optional[List[str]] = Query(None)):
+    snapshot = _snapshot(response)
+    if snapshot.neighbor_graph is None:
+        raise HTTPException(status_code=503, detail="Similar-trials graph not loaded")
+    
+    fields = _validated_fields(fields or SIMILAR_TRIAL_FIELDS)
+    # The graph only holds representatives; a folded duplicate (dedup.py) uses its representative's row
+    idx = snapshot.matcher.row_index(nct_id)
+    graph_id = str(snapshot.matcher.trials_data['NCTId'].iat[idx]) if idx is not None else nct_id
+    neighbors = snapshot.neighbor_graph.neighbors(graph_id, min(limit, snapshot.neighbor_graph.k))
+    if neighbors is None:
+        raise HTTPException(status_code=404, detail="Trial not found")
+    
+    return {"nct_id": nct_id, "similar": await _run(_similar_rows, snapshot, neighbors, fields)}
+
+def _similar_rows(snapshot: Snapshot, neighbors, fields: List[str]) -> List[dict]:
+    similar = []
+    for neighbor_id, score in neighbors:
+        idx = snapshot.matcher.row_index(neighbor_id)
+        # The graph can lag the CSV until similarity_graph.py is re-run
+        if idx is not None:
+            similar.append(snapshot.matcher.materialize(idx, score, fields))
+    return similar
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8001) 
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -1,171 +1,278 @@
-import pandas as pd
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import torch
-from sklearn.metrics.pairwise import cosine_similarity
 import json
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional, Iterator, Union
 import pickle
 import os
+from contextlib import nullcontext
+import metrics
+from engines import DenseEngine, ENGINE_TYPES, ScorerEngine
+from embedding_export import export_embeddings
+from embedding_manifest import align_rows, load_manifest, manifest_path, save_manifest, text_digest
+from geo import GeoQuery, SiteIndex
+from dedup import deduplicate, read_trials
+from trial_rows import (DUPLICATES_COLUMN, duplicate_ids, resolve_fields, top_k_indices,
+                        materialize_row, trial_details, trial_text)
 
 class ClinicalTrialMatcher:
-    def __init__(self, model_name: str = 'all-MiniLM-L6-v2'):
+    def __init__(self, model_name: str = 'all-MiniLM-L6-v2', profiler=None, model=None):
         self.model_name = model_name
-        self.model = SentenceTransformer(model_name)
+        # Pass an existing model to share it between matchers (e.g. across snapshots)
+        self.model = model if model is not None else SentenceTransformer(model_name)
         self.trials_data = None
         self.trial_embeddings = None
         self.trial_texts = []
+        self.trial_digests = []
+        # {'ids', 'digests'} of the trials trial_embeddings' rows were encoded from (see embedding_manifest.py)
+        self.embedding_rows = None
+        self.nct_index = {}
+        # Scorer engines share this matcher's trial store, embeddings and model
+        self.engines: Dict[str, ScorerEngine] = {'dense': DenseEngine(self)}
+        # Optional profiler.MatchProfiler; None keeps the hot path free of profiling work
+        self.profiler = profiler
+        # Optional result_cache.ResultCache for dense queries, warmed per snapshot
+        self.result_cache = None
+        # Optional geo.SiteIndex over trial sites, for queries with a patient location
+        self.site_index = None
         
-    def load_trials_data(self, csv_file: str):
+    def load_trials_data(self, csv_file: Union[str, List[str]], dedup: bool = False,
+                         dedup_threshold: float = 0.8):
+        """Load one CSV or several (earlier files win); `dedup` folds near-duplicates first (see dedup.py)."""
         print(f"Loading trials data from {csv_file}...")
-        self.trials_data = pd.read_csv(csv_file)
+        self.trials_data = read_trials(csv_file)
+        if dedup:
+            self.trials_data, stats = deduplicate(self.trials_data, threshold=dedup_threshold)
+            print(f"Deduplicated trials: {stats}")
         
-        self.trial_texts = []
-        for _, trial in self.trials_data.iterrows():
-            trial_text = f"""
-            Condition: {trial.get('Condition', '')}
-            Title: {trial.get('BriefTitle', '')}
-            Summary: {trial.get('BriefSummary', '')}
-            Inclusion Criteria: {trial.get('InclusionCriteria', '')}
-            Exclusion Criteria: {trial.get('ExclusionCriteria', '')}
-            Intervention: {trial.get('InterventionName', '')}
-            Phase: {trial.get('Phase', '')}
-            Status: {trial.get('OverallStatus', '')}
-            Location: {trial.get('LocationCountry', '')}
-            Sponsor: {trial.get('LeadSponsor', '')}
-            """.strip()
-            
-            self.trial_texts.append(trial_text)
+        self.trial_texts = [trial_text(trial) for _, trial in self.trials_data.iterrows()]
+        self.trial_digests = [text_digest(text) for text in self.trial_texts]
+        
+        self.nct_index = {}
+        for i, nct_id in enumerate(self.trials_data['NCTId'].astype(str)):
+            self.nct_index.setdefault(nct_id, i)
+        if DUPLICATES_COLUMN in self.trials_data:
+            # Folded NCTIds resolve to their representative, for details, similar trials and sites
+            for i, value in enumerate(self.trials_data[DUPLICATES_COLUMN]):
+                for nct_id in duplicate_ids(value):
+                    self.nct_index.setdefault(nct_id, i)
         
+        metrics.CORPUS_SIZE.set(len(self.trials_data))
         print(f"Loaded {len(self.trials_data)} trials")
         
+        # Embedding-based engines are prepared lazily, once embeddings are loaded or computed
+        for engine in self.engines.values():
+            if not isinstance(engine, DenseEngine):
+                engine.ensure_prepared()
+    
+    def enable_engines(self, names: List[str]):
+        for name in names:
+            if name not in ENGINE_TYPES:
+                raise ValueError(f"Unknown engine: {name}")
+            if name not in self.engines:
+                self.engines[name] = ENGINE_TYPES[name](self)
+                if self.trials_data is not None and not isinstance(self.engines[name], DenseEngine):
+                    print(f"Preparing {name} engine...")
+                    self.engines[name].ensure_prepared()
+    
+    def get_engine(self, name: str) -> ScorerEngine:
+        engine = self.engines.get(name)
+        if engine is None:
+            raise ValueError(f"Unknown or disabled engine: {name}")
+        engine.ensure_prepared()
+        return engine
+        
     def compute_embeddings(self):
         print("Computing BERT embeddings for trials...")
+        metrics.MODEL_BATCH_SIZE.observe(len(self.trial_texts), caller='corpus')
         self.trial_embeddings = self.model.encode(
             self.trial_texts, 
             convert_to_tensor=True,
             show_progress_bar=True
         )
+        self.embedding_rows = self.corpus_rows()
         print("Embeddings computed successfully")
+    
+    def corpus_rows(self) -> Dict[str, List[str]]:
+        return {'ids': self.trials_data['NCTId'].astype(str).tolist(), 'digests': list(self.trial_digests)}
+    
+    def sync_embeddings(self, file_path: str) -> Dict[str, int]:
+        """
+        Load file_path and line its rows up with the loaded trials by NCTId and text,
+        encoding only new or changed trials; the file is rewritten if anything moved.
+        """
+        wanted = self.corpus_rows()
+        loaded = self.load_embeddings(file_path)
+        if loaded and self.embedding_rows is None:
+            print(f"{manifest_path(file_path)} is missing, so rows can't be matched to trials")
+        positions = align_rows(self.embedding_rows if loaded else None, wanted['ids'], wanted['digests'])
+        missing = np.flatnonzero(positions < 0)
+        stats = {'reused': int(len(positions) - len(missing)), 'encoded': int(len(missing)), 'saved': 0}
+        if self.embedding_rows == wanted:
+            return stats
         
-    def save_embeddings(self, file_path: str):
+        if len(missing) == len(positions):
+            self.compute_embeddings()
+        else:
+            embeddings = self.trial_embeddings[torch.as_tensor(np.maximum(positions, 0))].clone()
+            if len(missing):
+                print(f"Encoding {len(missing)} new or changed trials...")
+                metrics.MODEL_BATCH_SIZE.observe(len(missing), caller='corpus')
+                encoded = self.model.encode([self.trial_texts[i] for i in missing], convert_to_tensor=True)
+                embeddings[torch.as_tensor(missing)] = encoded.to(device=embeddings.device, dtype=embeddings.dtype)
+            self.trial_embeddings = embeddings
+            self.embedding_rows = wanted
+        self.save_embeddings(file_path)
+        stats['saved'] = 1
+        return stats
+        
+    def save_embeddings(self, file_path: str, export_prefix: Optional[str] = None,
+                        export_dtype: str = 'float32'):
         print(f"Saving embeddings to {file_path}...")
         torch.save(self.trial_embeddings, file_path)
+        if self.embedding_rows is not None:
+            save_manifest(file_path, self.embedding_rows['ids'], self.embedding_rows['digests'])
         print("Embeddings saved successfully")
+        if export_prefix:
+            self.export_embeddings(export_prefix, export_dtype)
+    
+    def export_embeddings(self, prefix: str, dtype: str = 'float32') -> Dict[str, int]:
+        """Binary export for api/bert-match.js (see embedding_export.py); only changed rows are rewritten."""
+        stats = export_embeddings(prefix, self.trials_data['NCTId'].astype(str).tolist(),
+                                  self.trial_embeddings.cpu().numpy(), dtype)
+        print(f"Exported embeddings to {prefix}.bin: {stats}")
+        return stats
         
     def load_embeddings(self, file_path: str):
         print(f"Loading embeddings from {file_path}...")
         if os.path.exists(file_path):
-            self.trial_embeddings = torch.load(file_path)
+            self.trial_embeddings = torch.load(file_path, map_location='cpu')
+            self.embedding_rows = load_manifest(file_path, len(self.trial_embeddings))
+            metrics.record_cache('embeddings_file', hit=True)
             print("Embeddings loaded successfully")
             return True
         else:
+            metrics.record_cache('embeddings_file', hit=False)
             print("Embeddings file not found")
             return False
     
-    def find_matches(self, patient_description: str, top_k: int = 5, similarity_threshold: float = 0.3) -> List[Dict]:
-        if self.trial_embeddings is None:
-            raise ValueError("Trial embeddings not computed. Call compute_embeddings() first.")
-        
-        patient_embedding = self.model.encode([patient_description], convert_to_tensor=True)
-        
-        similarities = cosine_similarity(
-            patient_embedding.cpu().numpy(), 
-            self.trial_embeddings.cpu().numpy()
-        )[0]
-        
-        top_indices = np.argsort(similarities)[::-1][:top_k]
-        
-        matches = []
-        for idx in top_indices:
-            similarity_score = similarities[idx]
-            
-            if similarity_score >= similarity_threshold:
-                trial = self.trials_data.iloc[idx]
-                
-                def get_contact_value(val):
-                    if pd.isna(val) or val == 'N/A' or val == '':
-                        return None
-                    return str(val).strip()
-                
-                match = {
-                    'nct_id': get_contact_value(trial.get('NCTId')),
-                    'title': get_contact_value(trial.get('BriefTitle')),
-                    'condition': get_contact_value(trial.get('Condition')),
-                    'summary': get_contact_value(trial.get('BriefSummary')),
-                    'inclusion': get_contact_value(trial.get('InclusionCriteria')),
-                    'exclusion': get_contact_value(trial.get('ExclusionCriteria')),
-                    'country': get_contact_value(trial.get('LocationCountry')),
-                    'status': get_contact_value(trial.get('OverallStatus')),
-                    'phase': get_contact_value(trial.get('Phase')),
-                    'enrollment': get_contact_value(trial.get('EnrollmentCount')),
-                    'contact_name': get_contact_value(trial.get('ContactName')),
-                    'contact_role': get_contact_value(trial.get('ContactRole')),
-                    'contact_phone': get_contact_value(trial.get('ContactPhone')),
-                    'contact_email': get_contact_value(trial.get('ContactEmail')),
-                    'lead_sponsor': get_contact_value(trial.get('LeadSponsor')),
-                    'sponsor_type': get_contact_value(trial.get('SponsorType')),
-                    'similarity': float(similarity_score)
-                }
-                
-                matches.append(match)
-        
-        return matches
+    def encode_query(self, text: str) -> np.ndarray:
+        return np.asarray(self.model.encode([text])[0], dtype=np.float32)
+    
+    def rank(self, patient_description: str, top_k: int = 5, similarity_threshold: Optional[float] = None,
+             engine: str = 'dense', near: Optional[GeoQuery] = None) -> List[Tuple[int, float]]:
+        return self._rank(patient_description, top_k, similarity_threshold, engine, near)[0]
+    
+    def _rank(self, patient_description: str, top_k: int, similarity_threshold: Optional[float], engine: str,
+              near: Optional[GeoQuery]) -> Tuple[List[Tuple[int, float]], Optional[Tuple[np.ndarray, np.ndarray]]]:
+        """Ranked (row, similarity) pairs plus, for a geo query, per-trial (distance_km, nearest site)."""
+        if similarity_threshold is None:
+            similarity_threshold = self.get_engine(engine).default_threshold
+        query = None
+        if engine == 'dense' and self.result_cache is not None and near is None:
+            cached, query = self.result_cache.lookup(patient_description, top_k, similarity_threshold)
+            if cached is not None:
+                return cached, None
+        
+        scorer = self.get_engine(engine)
+        # A geo query re-ranks by distance, so any row may still make its top-k
+        depth = top_k if near is None else None
+        similarities = (scorer.score(patient_description, depth) if query is None
+                        else scorer.score_vector(query, depth))
+        
+        geo = None
+        ranking = similarities
+        if near is not None:
+            if self.site_index is None:
+                raise ValueError("Trial site locations not loaded")
+            with metrics.stage('geo'):
+                geo = self.site_index.trial_distances(near.latitude, near.longitude, near.radius_km)
+                ranking = near.ranking(similarities, geo[0])
+                # A blended ranking can lift nearby trials below the threshold into the top-k
+                ranking[similarities < similarity_threshold] = -np.inf
+        
+        with metrics.stage('topk'):
+            top_indices = top_k_indices(ranking, top_k)
+        
+        return [(int(idx), float(similarities[idx])) for idx in top_indices
+                if similarities[idx] >= similarity_threshold and ranking[idx] > -np.inf], geo
+    
+    def find_matches(self, patient_description: str, top_k: int = 5, similarity_threshold: Optional[float] = None,
+                     fields: Optional[List[str]] = None, engine: str = 'dense',
+                     near: Optional[GeoQuery] = None) -> List[Dict]:
+        fields = resolve_fields(fields)
+        profiling = nullcontext()
+        if self.profiler is not None:
+            profiling = self.profiler.profile(
+                'find_matches', top_k=top_k, engine=engine, description_chars=len(patient_description))
+        
+        with profiling:
+            ranked, geo = self._rank(patient_description, top_k, similarity_threshold, engine, near)
+            with metrics.stage('materialize'):
+                return [self.materialize(idx, score, fields, geo) for idx, score in ranked]
+    
+    def iter_matches(self, patient_description: str, top_k: int = 5, similarity_threshold: Optional[float] = None,
+                     fields: Optional[List[str]] = None, engine: str = 'dense',
+                     near: Optional[GeoQuery] = None) -> Iterator[Dict]:
+        """Like find_matches, but rows are materialized one at a time as the caller consumes them."""
+        fields = resolve_fields(fields)
+        profiling = nullcontext()
+        if self.profiler is not None:
+            profiling = self.profiler.profile(
+                'iter_matches', top_k=top_k, engine=engine, description_chars=len(patient_description))
+        
+        with profiling:
+            ranked, geo = self._rank(patient_description, top_k, similarity_threshold, engine, near)
+        for idx, score in ranked:
+            yield self.materialize(idx, score, fields, geo)
+    
+    def materialize(self, idx: int, similarity: float, fields: Optional[List[str]] = None,
+                    geo: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> Dict:
+        row = materialize_row(self.trials_data, idx, similarity, fields)
+        if geo is not None:
+            distances, nearest = geo
+            row['distance_km'] = float(distances[idx])
+            row['nearest_site'] = self.site_index.site(int(nearest[idx]))
+        return row
+    
+    def load_sites(self, csv_file: str):
+        """Index trial sites (see clinical_data_extraction.py) for geo queries; needs trials loaded first."""
+        print(f"Loading trial sites from {csv_file}...")
+        self.site_index = SiteIndex.from_csv(csv_file, self.nct_index, len(self.trials_data))
+        print(f"Indexed {len(self.site_index)} geocoded sites")
+    
+    def row_index(self, nct_id: str) -> Optional[int]:
+        return self.nct_index.get(nct_id)
     
     def get_trial_details(self, nct_id: str) -> Dict:
         if self.trials_data is None:
             raise ValueError("Trials data not loaded")
         
-        trial = self.trials_data[self.trials_data['NCTId'] == nct_id]
-        
-        if trial.empty:
+        idx = self.row_index(nct_id)
+        if idx is None:
             return None
         
-        trial = trial.iloc[0]
-        
-        def get_value(val):
-            if pd.isna(val) or val == 'N/A' or val == '':
-                return None
-            return str(val).strip()
-        
+        return trial_details(self.trials_data.iloc[idx])
+    
+    @property
+    def corpus_size(self) -> int:
+        return 0 if self.trials_data is None else len(self.trials_data)
+    
+    def stats(self, top: int = 10) -> Dict:
         return {
-            'nct_id': get_value(trial.get('NCTId')),
-            'title': get_value(trial.get('BriefTitle')),
-            'official_title': get_value(trial.get('OfficialTitle')),
-            'condition': get_value(trial.get('Condition')),
-            'summary': get_value(trial.get('BriefSummary')),
-            'inclusion': get_value(trial.get('InclusionCriteria')),
-            'exclusion': get_value(trial.get('ExclusionCriteria')),
-            'country': get_value(trial.get('LocationCountry')),
-            'status': get_value(trial.get('OverallStatus')),
-            'phase': get_value(trial.get('Phase')),
-            'enrollment': get_value(trial.get('EnrollmentCount')),
-            'study_type': get_value(trial.get('StudyType')),
-            'start_date': get_value(trial.get('StartDate')),
-            'completion_date': get_value(trial.get('CompletionDate')),
-            'intervention': get_value(trial.get('InterventionName')),
-            'primary_outcome': get_value(trial.get('PrimaryOutcomeMeasure')),
-            'contact_name': get_value(trial.get('ContactName')),
-            'contact_role': get_value(trial.get('ContactRole')),
-            'contact_phone': get_value(trial.get('ContactPhone')),
-            'contact_email': get_value(trial.get('ContactEmail')),
-            'lead_sponsor': get_value(trial.get('LeadSponsor')),
-            'sponsor_type': get_value(trial.get('SponsorType')),
-            'gender': get_value(trial.get('Gender')),
-            'min_age': get_value(trial.get('MinimumAge')),
-            'max_age': get_value(trial.get('MaximumAge')),
-            'age_groups': get_value(trial.get('StdAges')),
-            'healthy_volunteers': get_value(trial.get('HealthyVolunteers'))
+            'total_trials': self.corpus_size,
+            'conditions': self.trials_data['Condition'].value_counts().head(top).to_dict(),
+            'countries': self.trials_data['LocationCountry'].value_counts().head(top).to_dict(),
         }
+    
+    def close(self):
+        """Release worker resources; a no-op for the in-process matcher."""
 
 def main():
     matcher = ClinicalTrialMatcher()
     matcher.load_trials_data('all_conditions_trials.csv')
     
-    embeddings_file = 'trial_embeddings.pt'
-    if not matcher.load_embeddings(embeddings_file):
-        matcher.compute_embeddings()
-        matcher.save_embeddings(embeddings_file)
+    matcher.sync_embeddings('trial_embeddings.pt')
     
     test_descriptions = [
         "I have heart failure and need treatment options",
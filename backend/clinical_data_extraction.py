@@ -2,7 +2,9 @@ import requests
 import pandas as pd
 import json
 import time
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
+
+SITE_COLUMNS = ['NCTId', 'Facility', 'City', 'State', 'Zip', 'Country', 'SiteStatus', 'Latitude', 'Longitude']
 
 def parse_eligibility_criteria(criteria_text):
     if not criteria_text or criteria_text == 'N/A':
@@ -30,6 +32,24 @@ def parse_eligibility_criteria(criteria_text):
     exclusion = ' '.join(exclusion_criteria) if exclusion_criteria else 'N/A'
     return inclusion, exclusion
 
+def extract_sites(nct_id: str, contacts: Dict) -> List[Dict]:
+    """One record per trial site, keeping the facility's coordinates when the registry has them."""
+    sites = []
+    for loc in contacts.get('locations', []):
+        geo = loc.get('geoPoint') or {}
+        sites.append({
+            'NCTId': nct_id,
+            'Facility': loc.get('facility', 'N/A'),
+            'City': loc.get('city', 'N/A'),
+            'State': loc.get('state', 'N/A'),
+            'Zip': loc.get('zip', 'N/A'),
+            'Country': loc.get('country', 'N/A'),
+            'SiteStatus': loc.get('status', 'N/A'),
+            'Latitude': geo.get('lat'),
+            'Longitude': geo.get('lon'),
+        })
+    return sites
+
 def get_study_details(nct_id: str) -> Optional[Dict]:
     try:
         url = f"https://clinicaltrials.gov/api/v2/studies/{nct_id}"
@@ -54,6 +74,10 @@ def get_study_details(nct_id: str) -> Optional[Dict]:
         return None
 
 def get_clinical_trials_data():
+    trials, _ = get_clinical_trials_and_sites()
+    return trials
+
+def get_clinical_trials_and_sites() -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame]]:
     url = "https://clinicaltrials.gov/api/v2/studies"
     params = {
         'pageSize': 1000,
@@ -67,11 +91,12 @@ def get_clinical_trials_data():
 
         if 'studies' not in data:
             print("No studies key in response.")
-            return None
+            return None, None
 
         studies = data['studies']
         print(f"Fetched {len(studies)} studies.")
         results = []
+        sites = []
 
         for study in studies:
             section = study.get('protocolSection', {})
@@ -137,20 +162,24 @@ def get_clinical_trials_data():
                 time.sleep(0.1)
 
             results.append(study_data)
+            if study_data['NCTId'] != 'N/A':
+                sites.extend(extract_sites(study_data['NCTId'], contacts))
 
-        return pd.DataFrame(results)
+        return pd.DataFrame(results), pd.DataFrame(sites, columns=SITE_COLUMNS)
 
     except Exception as e:
         print(f"Error: {e}")
-        return None
+        return None, None
 
 def main():
     print("Starting clinical trial data extraction for all conditions...")
-    df = get_clinical_trials_data()
+    df, sites = get_clinical_trials_and_sites()
 
     if df is not None and not df.empty:
         df.to_csv("all_conditions_trials.csv", index=False)
         print(f"✅ Saved {len(df)} studies to all_conditions_trials.csv")
+        sites.to_csv("all_conditions_sites.csv", index=False)
+        print(f"✅ Saved {len(sites)} sites ({sites['Latitude'].notna().sum()} geocoded) to all_conditions_sites.csv")
         print(df.head(3))
     else:
         print("❌ Failed to fetch clinical trial data.")
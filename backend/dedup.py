@@ -0,0 +1,235 @@
+"""
+Near-duplicate detection and canonicalization for the ingested trial corpus.
+
+all_conditions_trials.csv, heart_disease_trials.csv and filtered_trials.csv
+overlap, and the registry itself has studies re-registered with the same text.
+Every copy costs an embedding and can crowd real alternatives out of a top-k.
+
+Each trial's text (trial_rows.trial_text) is shingled into 5-word windows and
+reduced to a 128-value MinHash signature, in parallel worker processes.  LSH
+banding then proposes candidate pairs -- only trials sharing a band bucket are
+ever compared -- and a candidate is kept when its estimated Jaccard similarity
+reaches `threshold`.  Rows with the same NCTId are always merged.  Matches are
+clustered with union-find; the earliest row of a cluster (so the first CSV
+listed wins) is the representative and the others' NCTIds go into its
+DuplicateNCTIds column.  Only representatives are embedded and indexed.
+
+    python dedup.py all_conditions_trials.csv heart_disease_trials.csv ../filtered_trials.csv \
+        --out all_conditions_trials.csv
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from trial_rows import DUPLICATES_COLUMN, duplicate_ids, trial_text
+
+MERSENNE_PRIME = (1 << 31) - 1
+# Below this many trials, starting worker processes costs more than it saves
+PARALLEL_MIN_ROWS = 2000
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def shingle_hashes(text: str, size: int = 5) -> np.ndarray:
+    """crc32 of every distinct `size`-word window of the normalized text."""
+    words = _TOKEN.findall(text.lower())
+    if len(words) < size:
+        grams = {' '.join(words)} if words else set()
+    else:
+        grams = {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def _permutations(num_perm: int, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signatures(texts: Sequence[str], num_perm: int = 128, shingle_size: int = 5,
+                       seed: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """(signatures [n, num_perm] uint32, shingle count per text)."""
+    a, b = _permutations(num_perm, seed)
+    signatures = np.full((len(texts), num_perm), MERSENNE_PRIME, dtype=np.uint32)
+    counts = np.zeros(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        hashes = shingle_hashes(text, shingle_size) % MERSENNE_PRIME
+        counts[i] = len(hashes)
+        if len(hashes):
+            # Both factors are < 2**31, so the products fit in uint64
+            signatures[i] = ((np.outer(hashes, a) + b) % MERSENNE_PRIME).min(axis=0)
+    return signatures, counts
+
+
+def _signature_chunk(args):
+    return minhash_signatures(*args)
+
+
+def parallel_signatures(texts: Sequence[str], num_perm: int = 128, shingle_size: int = 5,
+                        seed: int = 1, workers: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """minhash_signatures split over worker processes; identical output for any worker count."""
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(texts) < PARALLEL_MIN_ROWS:
+        return minhash_signatures(texts, num_perm, shingle_size, seed)
+    texts = list(texts)
+    step = -(-len(texts) // (workers * 4))
+    chunks = [(texts[i:i + step], num_perm, shingle_size, seed) for i in range(0, len(texts), step)]
+    # spawn, like the shard workers: forking a process that has torch loaded is unsafe
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        parts = list(pool.map(_signature_chunk, chunks))
+    return np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])
+
+
+def lsh_params(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """
+    (bands, rows) with bands * rows == num_perm whose S-curve midpoint is the
+    highest one at or below threshold.  Erring low only costs extra candidate
+    checks; erring high silently misses duplicates.
+    """
+    options = [(b, num_perm // b) for b in range(1, num_perm + 1) if num_perm % b == 0]
+    below = [o for o in options if (1.0 / o[0]) ** (1.0 / o[1]) <= threshold]
+    return max(below, key=lambda o: (1.0 / o[0]) ** (1.0 / o[1])) if below else options[-1]
+
+
+class DisjointSet:
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, x: int) -> int:
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x: int, y: int) -> bool:
+        rx, ry = self.find(x), self.find(y)
+        if rx == ry:
+            return False
+        # The lower row stays the root, so it ends up as the cluster representative
+        if ry < rx:
+            rx, ry = ry, rx
+        self.parent[ry] = rx
+        return True
+
+
+def near_duplicate_pairs(signatures: np.ndarray, eligible: np.ndarray, threshold: float,
+                         bands: int, rows: int) -> Tuple[List[Tuple[int, int]], int]:
+    """
+    (pairs sharing an LSH bucket whose estimated Jaccard similarity is >= threshold,
+    number of signature comparisons the buckets led to).
+    """
+    pairs = set()
+    checks = 0
+    candidates = np.flatnonzero(eligible)
+    for band in range(bands):
+        keys = np.ascontiguousarray(signatures[candidates, band * rows:(band + 1) * rows])
+        keys = keys.view(np.dtype((np.void, keys.dtype.itemsize * rows))).ravel()
+        _, bucket, sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        order = np.argsort(bucket.ravel(), kind='stable')
+        starts = np.cumsum(sizes) - sizes
+        for b in np.flatnonzero(sizes > 1):
+            members = candidates[order[starts[b]:starts[b] + sizes[b]]]
+            # Compare each member against the bucket's cluster leaders only, not every other member
+            leaders = [members[0]]
+            for member in members[1:]:
+                checks += len(leaders)
+                agreement = (signatures[leaders] == signatures[member]).mean(axis=1)
+                matched = np.flatnonzero(agreement >= threshold)
+                if len(matched):
+                    pairs.add((int(leaders[matched[0]]), int(member)))
+                else:
+                    leaders.append(member)
+    return sorted(pairs), checks
+
+
+def read_trials(csv_files: Union[str, Sequence[str]]) -> pd.DataFrame:
+    """One frame from one or more trial CSVs, in the order given."""
+    if isinstance(csv_files, str):
+        csv_files = [csv_files]
+    return pd.concat([pd.read_csv(f) for f in csv_files], ignore_index=True)
+
+
+def deduplicate(trials: pd.DataFrame, threshold: float = 0.8, num_perm: int = 128,
+                shingle_size: int = 5, min_shingles: int = 10, workers: Optional[int] = None,
+                seed: int = 1) -> Tuple[pd.DataFrame, Dict]:
+    """
+    (canonical frame, stats).  The frame keeps one row per cluster, in input order,
+    with DuplicateNCTIds listing the NCTIds folded into it.
+    """
+    trials = trials.reset_index(drop=True)
+    nct_ids = trials['NCTId'].astype(str).to_numpy()
+    clusters = DisjointSet(len(trials))
+
+    exact = 0
+    for rows in pd.Series(np.arange(len(trials))).groupby(nct_ids).groups.values():
+        rows = list(rows)
+        for row in rows[1:]:
+            exact += clusters.union(rows[0], row)
+
+    texts = [trial_text(trial) for _, trial in trials.iterrows()]
+    signatures, counts = parallel_signatures(texts, num_perm, shingle_size, seed, workers)
+    bands, rows = lsh_params(num_perm, threshold)
+    # Very short texts are mostly the field labels, so their signatures collide regardless of content
+    pairs, checks = near_duplicate_pairs(signatures, counts >= min_shingles, threshold, bands, rows)
+    near = sum(clusters.union(x, y) for x, y in pairs)
+
+    roots = np.array([clusters.find(i) for i in range(len(trials))])
+    keep = roots == np.arange(len(trials))
+    duplicates: Dict[int, List[str]] = {}
+    for row in np.flatnonzero(~keep):
+        root = int(roots[row])
+        if nct_ids[row] != nct_ids[root] and nct_ids[row] not in duplicates.setdefault(root, []):
+            duplicates[root].append(nct_ids[row])
+    # Re-canonicalizing an already canonical frame keeps the duplicates found last time
+    if DUPLICATES_COLUMN in trials:
+        for row, value in trials[DUPLICATES_COLUMN].items():
+            for nct_id in duplicate_ids(value):
+                root = int(roots[row])
+                if nct_id != nct_ids[root] and nct_id not in duplicates.setdefault(root, []):
+                    duplicates[root].append(nct_id)
+
+    canonical = trials[keep].copy()
+    canonical[DUPLICATES_COLUMN] = [';'.join(duplicates.get(int(row), [])) for row in np.flatnonzero(keep)]
+    canonical = canonical.reset_index(drop=True)
+    stats = {
+        'input_rows': len(trials),
+        'canonical_rows': len(canonical),
+        'same_nct_merges': int(exact),
+        'near_duplicate_merges': int(near),
+        'candidate_checks': checks,
+        'verified_pairs': len(pairs),
+        'lsh_bands': bands,
+        'lsh_rows': rows,
+    }
+    return canonical, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge trial CSVs and fold near-duplicate trials together")
+    parser.add_argument('csv_files', nargs='+', help="trial CSVs; earlier files win ties")
+    parser.add_argument('--out', default='all_conditions_trials.csv')
+    parser.add_argument('--threshold', type=float, default=0.8, help="Jaccard similarity to merge at")
+    parser.add_argument('--num-perm', type=int, default=128)
+    parser.add_argument('--shingle-size', type=int, default=5)
+    parser.add_argument('--workers', type=int, help="signature processes (default: all cores)")
+    args = parser.parse_args()
+
+    trials = read_trials(args.csv_files)
+    canonical, stats = deduplicate(trials, args.threshold, args.num_perm, args.shingle_size,
+                                   workers=args.workers)
+    canonical.to_csv(args.out, index=False)
+    print(f"Wrote {len(canonical)} canonical trials to {args.out}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Compact binary export of the trial embeddings for the serverless matcher.
+
+api/bert-match.js used to JSON.parse a pretty-printed trial_embeddings.json on
+every cold start.  This writes the same corpus as
+
+    <prefix>.bin       row-major little-endian vectors, L2-normalized, no header
+    <prefix>.ids.json  {"dtype", "dim", "count", "scales", "ids"} -- the id table
+    <prefix>.digests   8-byte digest per exported row (only read by the exporter)
+
+so the function can wrap the .bin file in a Float32Array / Int8Array directly.
+int8 rows store round(v / scales[d]) with one scale per dimension; the dot
+product is sum(code[d] * query[d] * scales[d]).
+
+Re-exports are incremental: when the id table only grew or rows changed in
+place, just those rows are rewritten; an unchanged corpus isn't touched at all.
+
+    python embedding_export.py --csv all_conditions_trials.csv --out ../trial_embeddings --dtype int8
+
+The deployed function encodes queries with the Xenova model used by
+generate-embeddings.js, which now writes this export itself; --from-json
+converts an existing trial_embeddings.json from that script instead.
+
+    python embedding_export.py --from-json ../trial_embeddings.json --out ../trial_embeddings
+"""
+import argparse
+import json
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from similarity_graph import embedding_digests, load_corpus, normalize_rows
+
+EXPORT_DTYPES = {'float32': np.dtype('<f4'), 'int8': np.dtype('i1')}
+
+
+def _paths(prefix: str) -> Dict[str, str]:
+    return {'bin': f"{prefix}.bin", 'ids': f"{prefix}.ids.json", 'digests': f"{prefix}.digests"}
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def read_manifest(prefix: str) -> Optional[Dict]:
+    paths = _paths(prefix)
+    if not all(os.path.exists(p) for p in paths.values()):
+        return None
+    with open(paths['ids']) as f:
+        manifest = json.load(f)
+    with open(paths['digests'], 'rb') as f:
+        manifest['digests'] = np.frombuffer(f.read(), dtype='S8')
+    if len(manifest['digests']) != manifest['count'] or os.path.getsize(paths['bin']) != (
+            manifest['count'] * manifest['dim'] * EXPORT_DTYPES[manifest['dtype']].itemsize):
+        return None
+    return manifest
+
+
+def _encode(normalized: np.ndarray, dtype: str, scales: Optional[np.ndarray]) -> np.ndarray:
+    if dtype == 'float32':
+        return normalized.astype(EXPORT_DTYPES['float32'])
+    return np.clip(np.rint(normalized / scales), -127, 127).astype(EXPORT_DTYPES['int8'])
+
+
+def _int8_scales(normalized: np.ndarray, previous: Optional[Dict]) -> np.ndarray:
+    scales = np.abs(normalized).max(axis=0) / 127.0
+    scales[scales == 0] = 1.0
+    if previous is not None and previous.get('scales') is not None:
+        old = np.asarray(previous['scales'], dtype=np.float32)
+        # Keep the old scales while every value still fits, so existing rows stay valid
+        if len(old) == len(scales) and (scales <= old).all():
+            return old
+    return scales.astype(np.float32)
+
+
+def export_embeddings(prefix: str, nct_ids: Sequence[str], embeddings: np.ndarray,
+                      dtype: str = 'float32') -> Dict[str, int]:
+    """Write (or update) the binary export; returns counts of what was written."""
+    if dtype not in EXPORT_DTYPES:
+        raise ValueError(f"Unknown export dtype: {dtype}, available: {', '.join(EXPORT_DTYPES)}")
+    nct_ids = [str(i) for i in nct_ids]
+    if len(nct_ids) != len(embeddings):
+        raise ValueError(f"{len(embeddings)} embeddings for {len(nct_ids)} trials")
+
+    paths = _paths(prefix)
+    previous = read_manifest(prefix)
+    normalized = normalize_rows(embeddings)
+    scales = _int8_scales(normalized, previous) if dtype == 'int8' else None
+    rows = _encode(normalized, dtype, scales)
+    digests = embedding_digests(rows.view(np.uint8))
+
+    manifest = {
+        'dtype': dtype,
+        'dim': int(rows.shape[1]),
+        'count': len(rows),
+        'scales': scales.tolist() if scales is not None else None,
+        'ids': nct_ids,
+    }
+    stats = {'rows': len(rows), 'written': len(rows), 'appended': 0, 'unchanged': 0}
+
+    compatible = (previous is not None
+                  and previous['dtype'] == dtype
+                  and previous['dim'] == manifest['dim']
+                  and previous['scales'] == manifest['scales']
+                  and previous['count'] <= len(rows)
+                  and previous['ids'] == nct_ids[:previous['count']])
+    if compatible:
+        old_count = previous['count']
+        changed = np.flatnonzero(previous['digests'] != digests[:old_count])
+        stats.update(written=len(changed), appended=len(rows) - old_count,
+                     unchanged=old_count - len(changed))
+        if not len(changed) and old_count == len(rows):
+            return stats
+        row_bytes = rows.shape[1] * rows.itemsize
+        with open(paths['bin'], 'r+b') as f:
+            for i in changed:
+                f.seek(int(i) * row_bytes)
+                f.write(rows[i].tobytes())
+            f.seek(old_count * row_bytes)
+            f.write(rows[old_count:].tobytes())
+    else:
+        _write_atomic(paths['bin'], rows.tobytes())
+
+    # The id table goes last: a reader never sees a count larger than the .bin file
+    _write_atomic(paths['digests'], digests.tobytes())
+    _write_atomic(paths['ids'], json.dumps(manifest, separators=(',', ':')).encode('utf-8'))
+    return stats
+
+
+def load_export(prefix: str) -> Dict:
+    """Read an export back as float32 rows, mirroring what api/bert-match.js does."""
+    paths = _paths(prefix)
+    with open(paths['ids']) as f:
+        manifest = json.load(f)
+    rows = np.fromfile(paths['bin'], dtype=EXPORT_DTYPES[manifest['dtype']])
+    rows = rows.reshape(manifest['count'], manifest['dim']).astype(np.float32)
+    if manifest['scales'] is not None:
+        rows *= np.asarray(manifest['scales'], dtype=np.float32)
+    return {'ids': manifest['ids'], 'vectors': rows}
+
+
+def load_json_embeddings(file_path: str) -> Tuple[List[str], np.ndarray]:
+    """(nct_ids, vectors) from generate-embeddings.js's {nct_id: vector} JSON."""
+    with open(file_path) as f:
+        data = json.load(f)
+    return list(data), np.asarray(list(data.values()), dtype=np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export trial embeddings for api/bert-match.js")
+    parser.add_argument('--csv', default='all_conditions_trials.csv')
+    parser.add_argument('--embeddings', default='trial_embeddings.pt')
+    parser.add_argument('--from-json', help="convert a trial_embeddings.json instead of --csv/--embeddings")
+    parser.add_argument('--out', default='../trial_embeddings', help="output prefix")
+    parser.add_argument('--dtype', default='float32', choices=sorted(EXPORT_DTYPES))
+    args = parser.parse_args()
+
+    if args.from_json:
+        nct_ids, embeddings = load_json_embeddings(args.from_json)
+    else:
+        nct_ids, embeddings = load_corpus(args.csv, args.embeddings)
+    stats = export_embeddings(args.out, nct_ids, embeddings, args.dtype)
+    size = os.path.getsize(f"{args.out}.bin") + os.path.getsize(f"{args.out}.ids.json")
+    print(f"Exported {stats['rows']} trials to {args.out}.bin ({size / 2 ** 20:.2f} MB): {stats}")
+
+
+if __name__ == "__main__":
+    main()
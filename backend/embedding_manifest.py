@@ -0,0 +1,66 @@
+"""
+Which trial each row of a stored embedding matrix belongs to.
+
+trial_embeddings.pt is a bare [N, dim] tensor, so pairing its rows with the CSV
+by position serves another trial's vector whenever a refreshed CSV keeps the
+same row count but reorders or replaces trials.  Saving embeddings also writes
+
+    trial_embeddings.rows.json   {"ids": [NCTId, ...], "digests": [text digest, ...]}
+
+and readers look rows up by (NCTId, text digest) instead of by position:
+unchanged trials keep their vectors, new or edited ones are re-encoded.
+"""
+import hashlib
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+def manifest_path(embeddings_file: str) -> str:
+    return f"{os.path.splitext(embeddings_file)[0]}.rows.json"
+
+
+def text_digest(text: str) -> str:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def save_manifest(embeddings_file: str, nct_ids: Sequence[str], digests: Sequence[str]):
+    path = manifest_path(embeddings_file)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'ids': [str(i) for i in nct_ids], 'digests': list(digests)}, f)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(embeddings_file: str, rows: Optional[int] = None) -> Optional[Dict[str, List[str]]]:
+    """The saved ids and digests, or None if missing or not describing `rows` rows."""
+    path = manifest_path(embeddings_file)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if len(manifest['ids']) != len(manifest['digests']) or (rows is not None and len(manifest['ids']) != rows):
+        return None
+    return manifest
+
+
+def align_rows(manifest: Optional[Dict[str, List[str]]], nct_ids: Sequence[str],
+               digests: Sequence[str]) -> np.ndarray:
+    """For each wanted (NCTId, digest), the stored row holding its vector, or -1 if there is none."""
+    positions = np.full(len(nct_ids), -1, dtype=np.int64)
+    if manifest is None:
+        return positions
+    stored = defaultdict(list)
+    for row, key in enumerate(zip(manifest['ids'], manifest['digests'])):
+        stored[key].append(row)
+    used = defaultdict(int)
+    for i, key in enumerate(zip((str(n) for n in nct_ids), digests)):
+        rows = stored.get(key)
+        if rows:
+            # Repeated rows with the same id and text take the stored copies in order
+            positions[i] = rows[min(used[key], len(rows) - 1)]
+            used[key] += 1
+    return positions
@@ -0,0 +1,203 @@
+"""
+Pluggable scorer engines for ClinicalTrialMatcher.
+
+Every engine scores a patient description against the matcher's single trial
+store and returns one similarity per trial row; ranking, thresholds and row
+materialization stay in the matcher, so all engines share one DataFrame, one
+embedding matrix and one model instance and return the same response schema.
+
+    dense    sentence-transformer cosine similarity (was bert_api.py / main.py)
+    tfidf    TF-IDF cosine similarity (was main_fixed.py)
+    keyword  Jaccard keyword overlap (was heart_api.py)
+    int8     dense similarity over int8-quantized embeddings, exact re-rank of the top candidates
+    pq       dense similarity over product-quantized embeddings, exact re-rank of the top candidates
+"""
+import re
+from typing import Dict, Optional, Type
+
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+
+import metrics
+from quantization import CompressedIndex, rerank, rerank_depth
+
+WORD_PATTERN = r'\b\w+\b'
+
+
+def _joined_columns(trials_data, columns, fill: Dict[str, str] = None):
+    fill = fill or {}
+    text = None
+    for column in columns:
+        values = trials_data[column].fillna(fill.get(column, '')).astype(str) if column in trials_data else ''
+        text = values if text is None else text + " " + values
+    return text.tolist()
+
+
+class ScorerEngine:
+    name = None
+    # Used when a request doesn't set similarity_threshold; scores aren't comparable across engines
+    default_threshold = 0.3
+
+    def __init__(self, matcher):
+        self.matcher = matcher
+        self._source = None
+
+    def source(self):
+        """The matcher state this engine's index is derived from."""
+        if self.matcher.trials_data is None:
+            raise ValueError("Trials data not loaded")
+        return self.matcher.trials_data
+
+    def ensure_prepared(self):
+        source = self.source()
+        if source is not self._source:
+            self.prepare()
+            self._source = source
+
+    def prepare(self):
+        """Build any per-corpus state; re-run whenever the trial store is replaced."""
+
+    def score(self, patient_description: str, top_k: Optional[int] = None) -> np.ndarray:
+        """One score per trial row; `top_k` is how many rows the caller will keep (None: all)."""
+        raise NotImplementedError
+
+
+class DenseEngine(ScorerEngine):
+    name = 'dense'
+
+    def __init__(self, matcher):
+        super().__init__(matcher)
+        self._matrix = None
+        self._norms = None
+
+    def source(self):
+        if self.matcher.trial_embeddings is None:
+            raise ValueError("Trial embeddings not computed. Call compute_embeddings() first.")
+        return self.matcher.trial_embeddings
+
+    def prepare(self):
+        # A CPU tensor's .numpy() is a view, so the matrix is shared with the matcher, not copied
+        self._matrix = self.matcher.trial_embeddings.cpu().numpy()
+        norms = np.linalg.norm(self._matrix, axis=1)
+        norms[norms == 0] = 1.0
+        self._norms = norms
+
+    def score(self, patient_description: str, top_k: Optional[int] = None) -> np.ndarray:
+        metrics.MODEL_BATCH_SIZE.observe(1, caller='query')
+        with metrics.stage('encode'):
+            query = self.matcher.encode_query(patient_description)
+        return self.score_vector(query, top_k)
+
+    def score_vector(self, query: np.ndarray, top_k: Optional[int] = None) -> np.ndarray:
+        """Score an already-encoded query (e.g. one the result cache encoded but missed on)."""
+        with metrics.stage('similarity'):
+            query_norm = np.linalg.norm(query) or 1.0
+            return (self._matrix @ query) / (self._norms * query_norm)
+
+
+class QuantizedEngine(DenseEngine):
+    """
+    Scores against compressed codes of the matcher's embeddings.
+
+    With `rerank_candidates` > 0 the best approximate candidates are re-scored
+    exactly from the float matrix and every other row is dropped; with 0 only the
+    codes are read, which is what lets a worker hold a corpus it couldn't in float32.
+    """
+    kind = None
+    rerank_candidates = 100
+
+    def __init__(self, matcher):
+        super().__init__(matcher)
+        self.index = None
+
+    def prepare(self):
+        super().prepare()
+        self.index = CompressedIndex.build(self._matrix, self.kind)
+
+    def score_vector(self, query: np.ndarray, top_k: Optional[int] = None) -> np.ndarray:
+        with metrics.stage('similarity'):
+            scores = self.index.scores(query)
+        if not self.rerank_candidates:
+            return scores
+        with metrics.stage('rerank'):
+            return rerank(scores, query, self._matrix, self._norms,
+                          rerank_depth(self.rerank_candidates, top_k))
+
+
+class Int8Engine(QuantizedEngine):
+    name = 'int8'
+    kind = 'int8'
+
+
+class PQEngine(QuantizedEngine):
+    name = 'pq'
+    kind = 'pq'
+
+
+class TfidfEngine(ScorerEngine):
+    name = 'tfidf'
+    # main_fixed.py returned the top_k with no cut-off
+    default_threshold = 0.0
+    text_columns = ('Condition', 'BriefSummary', 'InclusionCriteria', 'ExclusionCriteria')
+
+    def __init__(self, matcher):
+        super().__init__(matcher)
+        self.vectorizer = None
+        self.trial_vectors = None
+
+    def prepare(self):
+        self.vectorizer = TfidfVectorizer(
+            max_features=5000,
+            stop_words='english',
+            ngram_range=(1, 2),
+            min_df=1,
+            max_df=0.95
+        )
+        # TfidfVectorizer rows are L2-normalized, so a sparse dot product is the cosine similarity
+        self.trial_vectors = self.vectorizer.fit_transform(
+            _joined_columns(self.matcher.trials_data, self.text_columns))
+
+    def score(self, patient_description: str, top_k: Optional[int] = None) -> np.ndarray:
+        with metrics.stage('encode'):
+            patient_vector = self.vectorizer.transform([patient_description])
+        with metrics.stage('similarity'):
+            return (self.trial_vectors @ patient_vector.T).toarray().ravel()
+
+
+class KeywordEngine(ScorerEngine):
+    name = 'keyword'
+    # Jaccard overlap rarely passes 0.1; heart_api.py returned the top 5 with no cut-off
+    default_threshold = 0.0
+    text_columns = ('Condition', 'BriefSummary', 'InclusionCriteria')
+    fill_values = {
+        'Condition': 'Unknown',
+        'BriefSummary': 'No summary available',
+        'InclusionCriteria': 'No inclusion criteria specified',
+    }
+
+    def __init__(self, matcher):
+        super().__init__(matcher)
+        self.vectorizer = None
+        self.trial_words = None
+        self.trial_word_counts = None
+
+    def prepare(self):
+        self.vectorizer = CountVectorizer(token_pattern=WORD_PATTERN, lowercase=True, binary=True)
+        self.trial_words = self.vectorizer.fit_transform(
+            _joined_columns(self.matcher.trials_data, self.text_columns, self.fill_values)).tocsr()
+        self.trial_word_counts = np.asarray(self.trial_words.sum(axis=1)).ravel()
+
+    def score(self, patient_description: str, top_k: Optional[int] = None) -> np.ndarray:
+        with metrics.stage('encode'):
+            patient_words = set(re.findall(WORD_PATTERN, patient_description.lower()))
+            patient_vector = self.vectorizer.transform([" ".join(patient_words)])
+        with metrics.stage('similarity'):
+            # |A & B| / |A | B| for every trial at once
+            overlap = np.asarray((self.trial_words @ patient_vector.T).todense()).ravel()
+            union = self.trial_word_counts + len(patient_words) - overlap
+            return np.divide(overlap, union, out=np.zeros(len(union), dtype=np.float64), where=union > 0)
+
+
+ENGINE_TYPES: Dict[str, Type[ScorerEngine]] = {
+    engine.name: engine for engine in (DenseEngine, TfidfEngine, KeywordEngine, Int8Engine, PQEngine)
+}
@@ -0,0 +1,106 @@
+"""
+Trial-site spatial index for proximity filtering and ranking.
+
+Sites come from the per-site CSV written by clinical_data_extraction.py
+(one row per facility with latitude/longitude).  They are loaded into a
+haversine BallTree once per snapshot, so a patient query touches only the
+sites inside its radius instead of every site in Python.  Per-trial distance
+is the distance to the trial's nearest site, reduced in one vectorized pass.
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+EARTH_RADIUS_KM = 6371.0088
+SITE_FIELDS = {
+    'facility': 'Facility',
+    'city': 'City',
+    'state': 'State',
+    'country': 'Country',
+    'status': 'SiteStatus',
+    'latitude': 'Latitude',
+    'longitude': 'Longitude',
+}
+
+
+class GeoQuery:
+    """
+    Patient location for a match.  Trials without a site inside `radius_km` are
+    dropped; `distance_weight` in [0, 1] blends proximity into the ranking:
+
+        rank = (1 - w) * similarity + w * (1 - distance / radius)
+    """
+
+    def __init__(self, latitude: float, longitude: float, radius_km: float = 100.0,
+                 distance_weight: float = 0.0):
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            raise ValueError("Latitude must be within [-90, 90] and longitude within [-180, 180]")
+        if radius_km <= 0:
+            raise ValueError("radius_km must be positive")
+        if not 0 <= distance_weight <= 1:
+            raise ValueError("distance_weight must be within [0, 1]")
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius_km = radius_km
+        self.distance_weight = distance_weight
+
+    def ranking(self, similarities: np.ndarray, distances: np.ndarray) -> np.ndarray:
+        within = np.isfinite(distances)
+        ranking = np.full(len(similarities), -np.inf)
+        proximity = 1.0 - distances[within] / self.radius_km
+        ranking[within] = ((1.0 - self.distance_weight) * similarities[within]
+                           + self.distance_weight * proximity)
+        return ranking
+
+
+class SiteIndex:
+    def __init__(self, sites: pd.DataFrame, nct_index: Dict[str, int], n_trials: int):
+        sites = sites.dropna(subset=['Latitude', 'Longitude'])
+        rows = sites['NCTId'].astype(str).map(nct_index)
+        # Sites of trials not in this corpus can't be ranked
+        sites = sites[rows.notna()].reset_index(drop=True)
+        self.sites = sites
+        self.trial_rows = rows.dropna().to_numpy(dtype=np.int64)
+        self.n_trials = n_trials
+        coordinates = np.radians(sites[['Latitude', 'Longitude']].to_numpy(dtype=np.float64))
+        self.tree = BallTree(coordinates, metric='haversine') if len(sites) else None
+
+    def __len__(self):
+        return len(self.sites)
+
+    @classmethod
+    def from_csv(cls, file_path: str, nct_index: Dict[str, int], n_trials: int) -> 'SiteIndex':
+        return cls(pd.read_csv(file_path), nct_index, n_trials)
+
+    def trial_distances(self, latitude: float, longitude: float,
+                        radius_km: float) -> Tuple[np.ndarray, np.ndarray]:
+        """(km to each trial's nearest site, that site's position); inf / -1 when none is in range."""
+        distances = np.full(self.n_trials, np.inf)
+        nearest = np.full(self.n_trials, -1, dtype=np.int64)
+        if self.tree is None:
+            return distances, nearest
+        point = np.radians([[latitude, longitude]])
+        indices, arcs = self.tree.query_radius(point, r=radius_km / EARTH_RADIUS_KM,
+                                               return_distance=True, sort_results=True)
+        indices, site_km = indices[0], arcs[0] * EARTH_RADIUS_KM
+        if not len(indices):
+            return distances, nearest
+        rows = self.trial_rows[indices]
+        # Results are nearest-first, so the first occurrence of each trial is its closest site
+        rows, first = np.unique(rows, return_index=True)
+        distances[rows] = site_km[first]
+        nearest[rows] = indices[first]
+        return distances, nearest
+
+    def site(self, position: int) -> Optional[Dict]:
+        if position < 0:
+            return None
+        row = self.sites.iloc[position]
+        site = {}
+        for field, column in SITE_FIELDS.items():
+            value = row.get(column)
+            site[field] = None if pd.isna(value) else (float(value) if field in ('latitude', 'longitude')
+                                                         else str(value))
+        return site
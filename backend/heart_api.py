@@ -1,8 +1,13 @@
+# Superseded by bert_api.py, which serves this scorer as engine="keyword" from a shared trial store.
+
 from fastapi import FastAPI
 from pydantic import BaseModel
 import pandas as pd
 from fastapi.middleware.cors import CORSMiddleware
+from audit import AuditLog
+import os
 import re
+import time
 
 app = FastAPI()
 
@@ -18,6 +23,18 @@ app.add_middleware(
 # Global variable for data
 df = None
 
+# Same append-only match audit as bert_api.py; unset MATCH_AUDIT_DIR disables it
+audit_log = AuditLog(
+    os.environ['MATCH_AUDIT_DIR'],
+    key=os.environ.get('MATCH_AUDIT_KEY', '').encode('utf-8'),
+    service='heart_api',
+).start() if os.environ.get('MATCH_AUDIT_DIR') else None
+
+@app.on_event("shutdown")
+def close_audit_log():
+    if audit_log is not None:
+        audit_log.close()
+
 def load_heart_disease_data():
     """Load and process heart disease clinical trials data"""
     global df
@@ -80,6 +97,9 @@ def simple_text_match(patient_desc, trial_texts):
 @app.post("/match")
 def match_trials(request: PatientRequest):
     global df
+    started = time.time()
+    matches = []
+    ok = False
     
     try:
         print(f"Received request: {request.description}")
@@ -119,6 +139,7 @@ def match_trials(request: PatientRequest):
             })
 
         print(f"Returning {len(matches)} matches")
+        ok = True
         return {"matches": matches}
     
     except Exception as e:
@@ -126,6 +147,12 @@ def match_trials(request: PatientRequest):
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
         return {"error": f"Server error: {str(e)}"}
+    
+    finally:
+        # Errors are reported as 200 + {"error": ...} here, so record the outcome separately
+        if audit_log is not None:
+            audit_log.record_match("/match", request.description, 200, started,
+                                   [m["nct_id"] for m in matches], ok=ok, top_k=5)
 
 @app.get("/")
 def read_root():
@@ -0,0 +1,119 @@
+"""
+Bounded execution layer for CPU-heavy match work.
+
+Encoding, scoring and row materialization run on a small dedicated thread
+pool instead of the event loop, so /health, /metrics and other cheap endpoints
+keep answering while matches are in flight.  Admission is bounded: once
+`workers + queue_size` jobs are running or waiting, new ones are rejected
+immediately (the API turns that into a 429) rather than piling up latency.
+
+Torch and BLAS each default to one thread per core *per call*; with several
+workers running at once that oversubscribes the machine.  `configure_thread_budget`
+caps the intra-op threads so that workers x threads stays within the cores.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import metrics
+
+INFERENCE_PENDING = metrics.REGISTRY.gauge(
+    'inference_pending_jobs', 'Jobs running or queued on the inference pool')
+INFERENCE_REJECTED = metrics.REGISTRY.counter(
+    'inference_rejected_total', 'Jobs refused or abandoned by the inference pool', ['reason'])
+
+_BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+class ExecutorSaturated(Exception):
+    """All workers are busy and the wait queue is full."""
+
+
+class InferenceTimeout(Exception):
+    """A job did not finish within its deadline."""
+
+
+def default_workers() -> int:
+    return max(1, min(4, os.cpu_count() or 1))
+
+
+def configure_thread_budget(threads: int):
+    """Cap torch and BLAS intra-op threads (process-wide) to `threads`."""
+    threads = max(1, threads)
+    # Only affects native libraries loaded after this point; threadpoolctl handles the rest
+    for name in _BLAS_ENV_VARS:
+        os.environ.setdefault(name, str(threads))
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads)
+    except ImportError:
+        pass
+    print(f"Thread budget: {threads} intra-op threads per worker")
+
+
+class InferenceExecutor:
+    def __init__(self, workers: Optional[int] = None, queue_size: int = 32, timeout: float = 30.0,
+                 threads_per_worker: Optional[int] = None):
+        self.workers = workers or default_workers()
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+
+    def start(self):
+        if self._pool is None:
+            configure_thread_budget(self.threads_per_worker)
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inference')
+        return self
+
+    def _release(self, _future=None):
+        INFERENCE_PENDING.dec()
+        self._slots.release()
+
+    async def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        """Run fn on the pool; raises ExecutorSaturated or InferenceTimeout instead of waiting."""
+        if self._pool is None:
+            self.start()
+        if not self._slots.acquire(blocking=False):
+            INFERENCE_REJECTED.inc(reason='saturated')
+            raise ExecutorSaturated(f"{self.workers} workers busy and {self.queue_size} jobs queued")
+        INFERENCE_PENDING.inc()
+        # run_in_executor doesn't carry contextvars over; metrics.track_stages relies on them
+        context = contextvars.copy_context()
+        try:
+            future = self._pool.submit(context.run, functools.partial(fn, *args, **kwargs))
+        except BaseException:
+            self._release()
+            raise
+        # The slot is held until the job really finishes, even if the caller gave up on it
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            # A thread can't be interrupted: a queued job is dropped, a running one finishes unobserved
+            future.cancel()
+            INFERENCE_REJECTED.inc(reason='timeout')
+            raise InferenceTimeout(f"Job did not finish within {timeout or self.timeout}s")
+
+    def status(self):
+        return {
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'threads_per_worker': self.threads_per_worker,
+            'pending': int(INFERENCE_PENDING.value()),
+        }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,433 @@
+"""
+Load generator for the matching APIs (bert_api, heart_api, main, main_fixed).
+
+Drives an app either in-process through httpx's ASGI transport or over HTTP
+against a locally running uvicorn, and reports throughput, latency histograms,
+error rates and event-loop lag.
+
+    python load_test.py --app bert_api:app --concurrency 1,4,16 --duration 30
+    python load_test.py --url http://127.0.0.1:8001 --concurrency 8 --slo-p95-ms 500
+    python load_test.py --trace audit_logs --trace-speed 2
+
+--trace replays match audit segments (see audit.py) open-loop at their recorded
+arrival times.  Descriptions are redacted in the log, so each one is replaced
+by a generated description of the same word count.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+SAMPLE_PHRASES = [
+    "I have heart failure and need treatment options",
+    "Patient with congenital heart disease looking for clinical trials",
+    "Heart attack survivor seeking rehabilitation studies",
+    "Elderly patient with atrial fibrillation",
+    "62 year old male with type 2 diabetes and chronic kidney disease stage 3",
+    "History of hypertension controlled on lisinopril and amlodipine",
+    "Recently diagnosed with stage II breast cancer, HER2 positive",
+    "Previous chemotherapy with carboplatin and paclitaxel completed last year",
+    "No history of stroke or transient ischemic attack",
+    "Ejection fraction of 35 percent on last echocardiogram",
+    "Currently taking metformin, atorvastatin and low dose aspirin",
+    "Non-smoker, drinks alcohol occasionally, BMI around 31",
+    "Persistent shortness of breath on exertion and ankle swelling",
+    "Underwent total knee arthroplasty six months ago",
+    "Diagnosed with moderate asthma, uses an inhaled corticosteroid daily",
+    "Interested in trials near Boston or anywhere in the United States",
+    "Not pregnant and not planning pregnancy during the study period",
+    "Mild cognitive impairment noted by neurologist last spring",
+]
+
+# (name, min words, max words, weight) -- roughly what the patient form produces
+LENGTH_PROFILES = [
+    ("short", 8, 30, 0.5),
+    ("medium", 60, 120, 0.35),
+    ("long", 250, 400, 0.15),
+]
+
+HISTOGRAM_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class DescriptionGenerator:
+    """Builds patient descriptions with a realistic mix of lengths."""
+
+    def __init__(self, seed: int = 0, corpus_csv: Optional[str] = None):
+        self.rng = random.Random(seed)
+        self.sentences = list(SAMPLE_PHRASES)
+        if corpus_csv and os.path.exists(corpus_csv):
+            self.sentences.extend(self._load_sentences(corpus_csv))
+
+    @staticmethod
+    def _load_sentences(csv_file: str, limit: int = 2000) -> List[str]:
+        import csv
+
+        sentences = []
+        with open(csv_file, newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                for sentence in str(row.get('BriefSummary') or '').split('. '):
+                    if 5 <= len(sentence.split()) <= 40:
+                        sentences.append(sentence.strip())
+                if len(sentences) >= limit:
+                    break
+        return sentences
+
+    def next(self, words: Optional[int] = None) -> str:
+        if words is None:
+            profile = self.rng.choices(LENGTH_PROFILES, weights=[p[3] for p in LENGTH_PROFILES])[0]
+            words = self.rng.randint(profile[1], profile[2])
+        parts = []
+        count = 0
+        while count < words:
+            sentence = self.rng.choice(self.sentences)
+            parts.append(sentence)
+            count += len(sentence.split())
+        return ". ".join(parts)
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples_ms: List[float] = []
+        self.errors = 0
+        self.status_counts: Dict[str, int] = {}
+
+    def record(self, latency_ms: float, status: str, ok: bool):
+        self.samples_ms.append(latency_ms)
+        self.status_counts[status] = self.status_counts.get(status, 0) + 1
+        if not ok:
+            self.errors += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.samples_ms:
+            return 0.0
+        ordered = sorted(self.samples_ms)
+        rank = max(0, min(len(ordered) - 1, math.ceil(q / 100.0 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def histogram(self) -> Dict[str, int]:
+        counts = {}
+        for bound in HISTOGRAM_BUCKETS_MS:
+            counts[f"<={bound}ms"] = sum(1 for s in self.samples_ms if s <= bound)
+        counts["+Inf"] = len(self.samples_ms)
+        return counts
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a fixed-interval sleep."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags_ms: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags_ms.append(max(0.0, (loop.time() - start - self.interval) * 1000))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def summary(self) -> Dict[str, float]:
+        if not self.lags_ms:
+            return {"mean_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+        ordered = sorted(self.lags_ms)
+        return {
+            "mean_ms": sum(ordered) / len(ordered),
+            "p99_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+            "max_ms": ordered[-1],
+        }
+
+
+def is_error_response(response: httpx.Response) -> bool:
+    # main.py, main_fixed.py and heart_api.py report failures as 200 + {"error": ...}
+    if response.status_code >= 400:
+        return True
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and "error" in body
+
+
+async def run_level(client: httpx.AsyncClient, generator: DescriptionGenerator, concurrency: int,
+                    duration: float, max_requests: Optional[int], top_k: int,
+                    health_path: str, health_interval: float) -> Dict:
+    recorder = LatencyRecorder()
+    health = LatencyRecorder()
+    lag = LoopLagMonitor()
+    deadline = time.perf_counter() + duration
+    issued = 0
+
+    def take_slot() -> bool:
+        nonlocal issued
+        if time.perf_counter() >= deadline:
+            return False
+        if max_requests is not None and issued >= max_requests:
+            return False
+        issued += 1
+        return True
+
+    async def worker():
+        while take_slot():
+            await post_match(client, "/match", {"description": generator.next(), "top_k": top_k}, recorder)
+
+    lag.start()
+    started = time.perf_counter()
+    probe = asyncio.ensure_future(
+        health_probe(client, health_path, health_interval, health, lambda: time.perf_counter() < deadline))
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await stop_probe(probe)
+    await lag.stop()
+    return summarize_level(concurrency, recorder, health, lag, elapsed)
+
+
+async def post_match(client: httpx.AsyncClient, path: str, payload: Dict, recorder: LatencyRecorder):
+    start = time.perf_counter()
+    try:
+        response = await client.post(path, json=payload)
+        status, ok = str(response.status_code), not is_error_response(response)
+    except httpx.HTTPError as e:
+        status, ok = type(e).__name__, False
+    recorder.record((time.perf_counter() - start) * 1000, status, ok)
+
+
+async def health_probe(client: httpx.AsyncClient, path: str, interval: float,
+                       recorder: LatencyRecorder, running: Callable[[], bool]):
+    # Cheap endpoints stall when a handler blocks the server's event loop
+    while running():
+        start = time.perf_counter()
+        try:
+            response = await client.get(path)
+            status, ok = str(response.status_code), response.status_code < 400
+        except httpx.HTTPError as e:
+            status, ok = type(e).__name__, False
+        recorder.record((time.perf_counter() - start) * 1000, status, ok)
+        await asyncio.sleep(interval)
+
+
+async def stop_probe(probe: asyncio.Future):
+    probe.cancel()
+    try:
+        await probe
+    except asyncio.CancelledError:
+        pass
+
+
+def trace_payload(event: Dict, generator: DescriptionGenerator) -> Dict:
+    payload = {"description": generator.next(words=max(1, event["description"]["words"]))}
+    payload.update((k, v) for k, v in event.get("params", {}).items() if v is not None)
+    return payload
+
+
+async def run_trace(client: httpx.AsyncClient, generator: DescriptionGenerator, events: List[Dict],
+                    speed: float, health_path: str, health_interval: float) -> Dict:
+    """Open-loop replay: each request goes out at its recorded offset / speed, however slow the server is."""
+    recorder = LatencyRecorder()
+    health = LatencyRecorder()
+    lag = LoopLagMonitor()
+    replaying = True
+    in_flight = []
+
+    lag.start()
+    started = time.perf_counter()
+    probe = asyncio.ensure_future(
+        health_probe(client, health_path, health_interval, health, lambda: replaying))
+    first = events[0]["ts"] if events else 0.0
+    for event in events:
+        delay = (event["ts"] - first) / speed - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # heart_api only serves /match
+        path = event["endpoint"] if event.get("service", "bert_api") == "bert_api" else "/match"
+        in_flight.append(asyncio.ensure_future(
+            post_match(client, path, trace_payload(event, generator), recorder)))
+    await asyncio.gather(*in_flight)
+    elapsed = time.perf_counter() - started
+    replaying = False
+    await stop_probe(probe)
+    await lag.stop()
+    return summarize_level(f"trace x{speed:g}", recorder, health, lag, elapsed)
+
+
+def summarize_level(concurrency, recorder: LatencyRecorder, health: LatencyRecorder,
+                    lag: LoopLagMonitor, elapsed: float) -> Dict:
+    total = len(recorder.samples_ms)
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "elapsed_s": elapsed,
+        "throughput_rps": total / elapsed if elapsed > 0 else 0.0,
+        "error_rate": recorder.errors / total if total else 0.0,
+        "status_counts": recorder.status_counts,
+        "latency_ms": {
+            "p50": recorder.percentile(50),
+            "p90": recorder.percentile(90),
+            "p95": recorder.percentile(95),
+            "p99": recorder.percentile(99),
+            "max": max(recorder.samples_ms) if recorder.samples_ms else 0.0,
+        },
+        "histogram": recorder.histogram(),
+        "health_latency_ms": {
+            "p50": health.percentile(50),
+            "p99": health.percentile(99),
+            "max": max(health.samples_ms) if health.samples_ms else 0.0,
+        },
+        "event_loop_lag": lag.summary(),
+    }
+
+
+def load_app(spec: str):
+    module_name, _, attr = spec.partition(":")
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    if backend_dir not in sys.path:
+        sys.path.insert(0, backend_dir)
+    module = importlib.import_module(module_name)
+    return getattr(module, attr or "app")
+
+
+async def run(args) -> List[Dict]:
+    generator = DescriptionGenerator(seed=args.seed, corpus_csv=args.corpus)
+    levels = [int(c) for c in str(args.concurrency).split(",") if c.strip()]
+    timeout = httpx.Timeout(args.timeout)
+    events = None
+    if args.trace:
+        from audit import load_trace
+        events = load_trace(args.trace, limit=args.requests)
+        print(f"Replaying {len(events)} audited requests from {args.trace} at x{args.trace_speed:g}")
+
+    async def drive(client: httpx.AsyncClient) -> List[Dict]:
+        if events is not None:
+            return [await run_trace(client, generator, events, args.trace_speed,
+                                    args.health_path, args.health_interval)]
+        return [await run_level(client, generator, concurrency, args.duration, args.requests,
+                                args.top_k, args.health_path, args.health_interval)
+                for concurrency in levels]
+
+    if args.url:
+        # A replayed burst isn't bounded by a concurrency level; let httpx pool as needed
+        limits = httpx.Limits(max_connections=None if events is not None else max(levels) + 1)
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout, limits=limits) as client:
+            return await drive(client)
+
+    # In-process: the app shares our event loop, so the lag monitor sees handler blocking directly
+    app = load_app(args.app)
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest",
+                                     timeout=timeout) as client:
+            return await drive(client)
+
+
+def check_slo(result: Dict, args) -> List[str]:
+    violations = []
+    if args.slo_p95_ms is not None and result["latency_ms"]["p95"] > args.slo_p95_ms:
+        violations.append(f"p95 {result['latency_ms']['p95']:.1f}ms > {args.slo_p95_ms}ms")
+    if args.slo_p99_ms is not None and result["latency_ms"]["p99"] > args.slo_p99_ms:
+        violations.append(f"p99 {result['latency_ms']['p99']:.1f}ms > {args.slo_p99_ms}ms")
+    if args.slo_error_rate is not None and result["error_rate"] > args.slo_error_rate:
+        violations.append(f"error rate {result['error_rate']:.2%} > {args.slo_error_rate:.2%}")
+    if args.slo_min_rps is not None and result["throughput_rps"] < args.slo_min_rps:
+        violations.append(f"throughput {result['throughput_rps']:.1f} rps < {args.slo_min_rps} rps")
+    return violations
+
+
+def print_report(results: List[Dict], args) -> bool:
+    target = args.url or args.app
+    print(f"\n{'='*60}")
+    print(f"Load test report: {target}")
+    print(f"{'='*60}")
+    passed = True
+    for result in results:
+        latency = result["latency_ms"]
+        print(f"\nConcurrency {result['concurrency']}: {result['requests']} requests "
+              f"in {result['elapsed_s']:.1f}s")
+        print(f"  Throughput: {result['throughput_rps']:.2f} req/s")
+        print(f"  Errors: {result['error_rate']:.2%} {result['status_counts']}")
+        print(f"  Latency ms: p50={latency['p50']:.1f} p90={latency['p90']:.1f} "
+              f"p95={latency['p95']:.1f} p99={latency['p99']:.1f} max={latency['max']:.1f}")
+        total = result["requests"] or 1
+        previous = 0
+        for bucket, count in result["histogram"].items():
+            width = int(40 * (count - previous) / total)
+            print(f"    {bucket:>10} {count - previous:>7} {'#' * width}")
+            previous = count
+        health = result["health_latency_ms"]
+        print(f"  {args.health_path} latency ms: p50={health['p50']:.1f} p99={health['p99']:.1f} "
+              f"max={health['max']:.1f}")
+        lag = result["event_loop_lag"]
+        scope = "client" if args.url else "server"
+        print(f"  Event loop lag ({scope}) ms: mean={lag['mean_ms']:.1f} p99={lag['p99_ms']:.1f} "
+              f"max={lag['max_ms']:.1f}")
+        violations = check_slo(result, args)
+        result["slo_violations"] = violations
+        if violations:
+            passed = False
+            print(f"  SLO: FAIL ({'; '.join(violations)})")
+        elif any(v is not None for v in (args.slo_p95_ms, args.slo_p99_ms,
+                                         args.slo_error_rate, args.slo_min_rps)):
+            print("  SLO: PASS")
+    return passed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the clinical trial matching APIs")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--app", default="bert_api:app",
+                        help="module:attribute of the FastAPI app to drive in-process")
+    target.add_argument("--url", help="base URL of a running server, e.g. http://127.0.0.1:8001")
+    parser.add_argument("--concurrency", default="1,4,16",
+                        help="comma-separated concurrency levels to sweep")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per level")
+    parser.add_argument("--requests", type=int, help="stop each level after this many requests")
+    parser.add_argument("--trace", help="replay the match audit segments in this directory instead")
+    parser.add_argument("--trace-speed", type=float, default=1.0,
+                        help="replay this many times faster than recorded")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--health-path", default="/",
+                        help="cheap endpoint probed during the run (every app serves /)")
+    parser.add_argument("--health-interval", type=float, default=0.25)
+    parser.add_argument("--corpus", default="all_conditions_trials.csv",
+                        help="CSV whose summaries seed the description generator")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the full report to this file")
+    parser.add_argument("--slo-p95-ms", type=float)
+    parser.add_argument("--slo-p99-ms", type=float)
+    parser.add_argument("--slo-error-rate", type=float)
+    parser.add_argument("--slo-min-rps", type=float)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    passed = print_report(results, args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"target": args.url or args.app, "levels": results}, f, indent=2)
+        print(f"\nReport written to {args.json}")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
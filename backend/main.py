@@ -1,10 +1,20 @@
-from fastapi import FastAPI
+# Superseded by bert_api.py, which serves this scorer as engine="dense" from a shared trial store.
+
+from fastapi import FastAPI, HTTPException
+import itertools
+import os
 from pydantic import BaseModel
 import pandas as pd
 import numpy as np
 from sentence_transformers import SentenceTransformer, util
 import torch
 from fastapi.middleware.cors import CORSMiddleware
+from typing import List, Optional
+from serialization import FastJSONResponse, ndjson_response
+from inference import ExecutorSaturated, InferenceExecutor, InferenceTimeout
+
+# Match work runs on a bounded pool, so a burst gets 429s and the cheap endpoints stay responsive
+inference = InferenceExecutor(timeout=float(os.environ.get('MATCH_REQUEST_TIMEOUT', '30')))
 
 # Setup CORS for React frontend
 app = FastAPI()
@@ -16,6 +26,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_inference():
+    inference.start()
+
+async def run_inference(fn, *args):
+    """Run blocking match work on the inference pool, mapping saturation and timeouts to HTTP errors."""
+    try:
+        return await inference.run(fn, *args)
+    except ExecutorSaturated as e:
+        raise HTTPException(status_code=429, detail=f"Server busy: {e}", headers={"Retry-After": "1"})
+    except InferenceTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
 # Load SentenceTransformer model (much simpler and more reliable)
 print("Loading SentenceTransformer model...")
 model = SentenceTransformer('all-MiniLM-L6-v2')
@@ -42,59 +65,91 @@ print("Backend ready!")
 # Request format
 class PatientRequest(BaseModel):
     description: str
+    top_k: int = 5
+    # Projection, e.g. ["nct_id", "similarity"]; nct_id and similarity are always included
+    fields: Optional[List[str]] = None
+
+# Response field -> CSV column
+MATCH_FIELDS = {
+    "nct_id": "NCTId",
+    "title": "BriefTitle",
+    "condition": "Condition",
+    "summary": "BriefSummary",
+    "inclusion": "InclusionCriteria",
+    "exclusion": "ExclusionCriteria",
+    "country": "LocationCountry",
+}
+
+def resolve_fields(fields):
+    if fields is None:
+        return list(MATCH_FIELDS)
+    unknown = [f for f in fields if f not in MATCH_FIELDS and f != "similarity"]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return ["nct_id"] + [f for f in dict.fromkeys(fields) if f in MATCH_FIELDS and f != "nct_id"]
+
+def iter_matches(patient_description, top_k, fields):
+    # Encode patient description
+    patient_embedding = model.encode(patient_description, convert_to_tensor=True).cpu()
+
+    # Convert stored NumPy embeddings back to torch tensors for comparison
+    trial_embeddings = torch.stack([torch.tensor(emb) for emb in df["embedding"]]).cpu()
+
+    # Compute cosine similarity
+    cosine_scores = util.pytorch_cos_sim(patient_embedding, trial_embeddings)[0]
+
+    top_results = torch.topk(cosine_scores, k=min(top_k, len(cosine_scores)))
+
+    for score, idx in zip(top_results.values, top_results.indices):
+        idx = int(idx)
+
+        # Handle potential NaN or infinite values in similarity score
+        similarity_score = float(score.item())
+        if not (similarity_score == similarity_score):  # Check for NaN
+            similarity_score = 0.0
+        elif similarity_score == float('inf') or similarity_score == float('-inf'):
+            similarity_score = 1.0 if similarity_score > 0 else 0.0
+
+        # Only touch the requested columns instead of materializing the whole row
+        match = {}
+        for field in fields:
+            value = df[MATCH_FIELDS[field]].iat[idx]
+            match[field] = str(value) if pd.notna(value) else ""
+        match["similarity"] = similarity_score
+        yield match
 
 @app.post("/match")
-def match_trials(request: PatientRequest):
+async def match_trials(request: PatientRequest):
     try:
         if not request.description.strip():
             return {"error": "Empty description provided"}
 
-        patient_description = request.description
-        
-        # Encode patient description
-        patient_embedding = model.encode(patient_description, convert_to_tensor=True).cpu()
-
-        # Convert stored NumPy embeddings back to torch tensors for comparison
-        trial_embeddings = torch.stack([torch.tensor(emb) for emb in df["embedding"]]).cpu()
-
-        # Compute cosine similarity
-        cosine_scores = util.pytorch_cos_sim(patient_embedding, trial_embeddings)[0]
-
-        # Get top 5 matches
-        top_k = 5
-        top_results = torch.topk(cosine_scores, k=top_k)
-
-        matches = []
-        for score, idx in zip(top_results.values, top_results.indices):
-            idx = int(idx)
-            trial = df.iloc[idx]
-            
-            # Handle potential NaN or infinite values in similarity score
-            similarity_score = float(score.item())
-            if not (similarity_score == similarity_score):  # Check for NaN
-                similarity_score = 0.0
-            elif similarity_score == float('inf') or similarity_score == float('-inf'):
-                similarity_score = 1.0 if similarity_score > 0 else 0.0
-            
-            matches.append({
-                "nct_id": str(trial["NCTId"]) if pd.notna(trial["NCTId"]) else "",
-                "title": str(trial["BriefTitle"]) if pd.notna(trial["BriefTitle"]) else "",
-                "similarity": similarity_score,
-                "condition": str(trial["Condition"]) if pd.notna(trial["Condition"]) else "",
-                "summary": str(trial["BriefSummary"]) if pd.notna(trial["BriefSummary"]) else "",
-                "inclusion": str(trial["InclusionCriteria"]) if pd.notna(trial["InclusionCriteria"]) else "",
-                "exclusion": str(trial["ExclusionCriteria"]) if pd.notna(trial["ExclusionCriteria"]) else "",
-                "country": str(trial["LocationCountry"]) if pd.notna(trial["LocationCountry"]) else ""
-            })
-
-        return {"matches": matches}
+        fields = resolve_fields(request.fields)
+        matches = await run_inference(list, iter_matches(request.description, request.top_k, fields))
+        return FastJSONResponse({"matches": matches})
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in match_trials: {str(e)}")
         return {"error": f"Server error: {str(e)}"}
 
+@app.post("/match/stream")
+async def stream_matches(request: PatientRequest):
+    if not request.description.strip():
+        return {"error": "Empty description provided"}
+    try:
+        fields = resolve_fields(request.fields)
+    except ValueError as e:
+        return {"error": str(e)}
+    rows = iter_matches(request.description, request.top_k, fields)
+    # Encoding and scoring happen before the first row; the rest is cheap per-row materialization
+    first = await run_inference(next, rows, None)
+    # One match per line (NDJSON), encoded as the client reads
+    return ndjson_response(itertools.chain([first], rows) if first is not None else iter(()))
+
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Clinical Trials Matching API is running!", "status": "healthy"}
 
 if __name__ == "__main__":
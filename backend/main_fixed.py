@@ -1,10 +1,17 @@
-from fastapi import FastAPI
+# Superseded by bert_api.py, which serves this scorer as engine="tfidf" from a shared trial store.
+
+from fastapi import FastAPI, HTTPException
+import os
 from pydantic import BaseModel
 import pandas as pd
 import numpy as np
 from fastapi.middleware.cors import CORSMiddleware
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
+from inference import ExecutorSaturated, InferenceExecutor, InferenceTimeout
+
+# Match work runs on a bounded pool, so a burst gets 429s and the cheap endpoints stay responsive
+inference = InferenceExecutor(timeout=float(os.environ.get('MATCH_REQUEST_TIMEOUT', '30')))
 
 # Setup CORS for React frontend
 app = FastAPI()
@@ -16,6 +23,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def start_inference():
+    inference.start()
+
+async def run_inference(fn, *args):
+    """Run blocking match work on the inference pool, mapping saturation and timeouts to HTTP errors."""
+    try:
+        return await inference.run(fn, *args)
+    except ExecutorSaturated as e:
+        raise HTTPException(status_code=429, detail=f"Server busy: {e}", headers={"Retry-After": "1"})
+    except InferenceTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
 # Global variables for data and vectorizer
 df = None
 vectorizer = None
@@ -70,8 +90,21 @@ else:
 class PatientRequest(BaseModel):
     description: str
 
+def rank_trials(patient_description):
+    """Top 5 (row, similarity) pairs for a description; runs on the inference pool."""
+    # Convert patient description to vector
+    patient_vector = vectorizer.transform([patient_description])
+    
+    # Compute cosine similarity
+    similarities = cosine_similarity(patient_vector, trial_vectors)[0]
+    
+    # Get top 5 matches
+    top_k = 5
+    top_indices = similarities.argsort()[::-1][:top_k]
+    return [(idx, float(similarities[idx])) for idx in top_indices]
+
 @app.post("/match")
-def match_trials(request: PatientRequest):
+async def match_trials(request: PatientRequest):
     global df, vectorizer, trial_vectors
     
     try:
@@ -85,22 +118,12 @@ def match_trials(request: PatientRequest):
 
         patient_description = request.description
         print("Processing patient description...")
-        
-        # Convert patient description to vector
-        patient_vector = vectorizer.transform([patient_description])
-        
-        # Compute cosine similarity
-        similarities = cosine_similarity(patient_vector, trial_vectors)[0]
-        
-        # Get top 5 matches
-        top_k = 5
-        top_indices = similarities.argsort()[::-1][:top_k]
+        ranked = await run_inference(rank_trials, patient_description)
         
         print("Building response...")
         matches = []
-        for idx in top_indices:
+        for idx, similarity_score in ranked:
             trial = df.iloc[idx]
-            similarity_score = float(similarities[idx])
             
             matches.append({
                 "nct_id": trial["NCTId"],
@@ -116,6 +139,8 @@ def match_trials(request: PatientRequest):
         print(f"Returning {len(matches)} matches")
         return {"matches": matches}
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in match_trials: {str(e)}")
         import traceback
@@ -123,11 +148,11 @@ def match_trials(request: PatientRequest):
         return {"error": f"Server error: {str(e)}"}
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Clinical Trials Matching API is running!", "status": "healthy"}
 
 @app.get("/stats")
-def get_stats():
+async def get_stats():
     """Get statistics about the loaded data"""
     global df
     if df is not None:
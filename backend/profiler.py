@@ -0,0 +1,153 @@
+"""
+Opt-in sampling profiler for slow match requests.
+
+A single background thread periodically snapshots the stacks of threads that
+are currently inside a profiled request (`sys._current_frames`) and folds them
+into collapsed-stack counts.  When a request finishes and was either picked by
+the sample rate or ran longer than the latency threshold, its profile is written
+to the output directory as:
+
+    <timestamp>-<label>-<id>.folded   collapsed stacks (flamegraph.pl, speedscope, inferno)
+    <timestamp>-<label>-<id>.json     elapsed time, per-stage timings and request info
+
+When no profiler is configured callers keep `None` and skip it entirely, so the
+disabled cost is a single attribute check.
+
+    MATCH_PROFILE_DIR=profiles MATCH_PROFILE_THRESHOLD_MS=500 python bert_api.py
+"""
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import metrics
+
+
+class _ActiveRequest:
+    __slots__ = ('thread_id', 'label', 'info', 'start', 'sampled', 'stacks', 'samples')
+
+    def __init__(self, thread_id: int, label: str, info: Dict, sampled: bool):
+        self.thread_id = thread_id
+        self.label = label
+        self.info = info
+        self.start = time.perf_counter()
+        self.sampled = sampled
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+
+def _fold_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class MatchProfiler:
+    def __init__(self, output_dir: str, sample_rate: float = 0.0,
+                 threshold_ms: Optional[float] = None, interval_ms: float = 5.0):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000.0
+        self._active: Dict[int, _ActiveRequest] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._sampler = None
+        self._local = threading.local()
+        os.makedirs(output_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional['MatchProfiler']:
+        output_dir = os.environ.get('MATCH_PROFILE_DIR')
+        sample_rate = float(os.environ.get('MATCH_PROFILE_SAMPLE_RATE', '0') or 0)
+        threshold = os.environ.get('MATCH_PROFILE_THRESHOLD_MS')
+        if not output_dir or (sample_rate <= 0 and not threshold):
+            return None
+        return cls(
+            output_dir,
+            sample_rate=sample_rate,
+            threshold_ms=float(threshold) if threshold else None,
+            interval_ms=float(os.environ.get('MATCH_PROFILE_INTERVAL_MS', '5')),
+        )
+
+    @contextmanager
+    def profile(self, label: str, **info):
+        """Profile the enclosed block; nested calls on the same thread are no-ops."""
+        if getattr(self._local, 'active', False):
+            yield None
+            return
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and self.threshold_ms is None:
+            yield None
+            return
+
+        request = _ActiveRequest(threading.get_ident(), label, info, sampled)
+        self._local.active = True
+        with self._lock:
+            self._active[request.thread_id] = request
+        self._ensure_sampler()
+        try:
+            with metrics.track_stages() as timings:
+                yield request
+        finally:
+            with self._lock:
+                self._active.pop(request.thread_id, None)
+            self._local.active = False
+            elapsed_ms = (time.perf_counter() - request.start) * 1000
+            slow = self.threshold_ms is not None and elapsed_ms >= self.threshold_ms
+            if request.sampled or slow:
+                self._dump(request, elapsed_ms, timings, 'threshold' if slow else 'sample')
+
+    def _ensure_sampler(self):
+        if self._sampler is not None and self._sampler.is_alive():
+            return
+        with self._lock:
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._sample_loop, name='match-profiler',
+                                                 daemon=True)
+                self._sampler.start()
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.values())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for request in active:
+                frame = frames.get(request.thread_id)
+                if frame is not None:
+                    request.stacks[_fold_stack(frame)] += 1
+                    request.samples += 1
+            del frames
+
+    def _dump(self, request: _ActiveRequest, elapsed_ms: float, timings: Dict[str, float], reason: str):
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        base = os.path.join(self.output_dir, f"{stamp}-{request.label}-{next(self._ids)}")
+        try:
+            with open(base + '.folded', 'w') as f:
+                for stack, count in request.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            with open(base + '.json', 'w') as f:
+                json.dump({
+                    'label': request.label,
+                    'reason': reason,
+                    'elapsed_ms': elapsed_ms,
+                    'stage_timings_ms': {k: v * 1000 for k, v in timings.items()},
+                    'samples': request.samples,
+                    'interval_ms': self.interval * 1000,
+                    'info': request.info,
+                }, f, indent=2)
+            print(f"Wrote {reason} profile ({elapsed_ms:.0f} ms) to {base}.folded")
+        except OSError as e:
+            print(f"Error writing profile {base}: {e}")
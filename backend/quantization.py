@@ -0,0 +1,282 @@
+"""
+Compressed trial embeddings for corpora that don't fit comfortably per worker.
+
+Two codecs over L2-normalized vectors, both scored asymmetrically (the query
+stays float32, only the corpus is compressed):
+
+    int8  one byte per dimension with a per-dimension offset and scale (4x smaller)
+    pq    product quantization: the vector is split into subspaces and each is
+          replaced by the id of its nearest of 256 centroids (48 subspaces -> 32x smaller)
+
+For pq a per-query lookup table holds the query's dot product with every
+centroid, so scoring a trial is one table lookup per subspace.  Approximate
+scores can be re-ranked exactly for the top candidates when the float vectors
+are still available.
+
+    python quantization.py --csv all_conditions_trials.csv --embeddings trial_embeddings.pt
+"""
+import argparse
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from trial_rows import top_k_indices
+
+DEFAULT_SUBSPACES = 48
+# Rows decoded per step so scoring never materializes the whole corpus as floats
+SCORE_BLOCK_ROWS = 16384
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class ScalarQuantizer:
+    kind = 'int8'
+
+    def __init__(self, offset: Optional[np.ndarray] = None, scale: Optional[np.ndarray] = None):
+        self.offset = offset
+        self.scale = scale
+
+    def fit(self, vectors: np.ndarray) -> 'ScalarQuantizer':
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        scale = (high - low) / 255.0
+        scale[scale == 0] = 1.0
+        self.offset, self.scale = low.astype(np.float32), scale.astype(np.float32)
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((vectors - self.offset) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale + self.offset
+
+    def lookup_table(self, query: np.ndarray) -> Tuple[np.ndarray, float]:
+        # q . (code * scale + offset) == code . (q * scale) + q . offset
+        return (query * self.scale).astype(np.float32), float(query @ self.offset)
+
+    def score_block(self, codes: np.ndarray, table: Tuple[np.ndarray, float]) -> np.ndarray:
+        weights, bias = table
+        return codes.astype(np.float32) @ weights + bias
+
+    def params(self) -> Dict[str, np.ndarray]:
+        return {'offset': self.offset, 'scale': self.scale}
+
+
+class ProductQuantizer:
+    kind = 'pq'
+
+    def __init__(self, n_subspaces: int = DEFAULT_SUBSPACES, n_centroids: int = 256,
+                 train_size: int = 20000, seed: int = 0, centroids: Optional[np.ndarray] = None):
+        if n_centroids > 256:
+            raise ValueError("n_centroids must fit in one byte (<= 256)")
+        self.n_subspaces = n_subspaces
+        self.n_centroids = n_centroids
+        self.train_size = train_size
+        self.seed = seed
+        # (n_subspaces, n_centroids, sub_dim)
+        self.centroids = centroids
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        n, dim = vectors.shape
+        if dim % self.n_subspaces:
+            raise ValueError(f"Dimension {dim} is not divisible into {self.n_subspaces} subspaces")
+        return vectors.reshape(n, self.n_subspaces, dim // self.n_subspaces)
+
+    def fit(self, vectors: np.ndarray) -> 'ProductQuantizer':
+        from sklearn.cluster import KMeans
+
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > self.train_size:
+            vectors = vectors[rng.choice(len(vectors), self.train_size, replace=False)]
+        parts = self._split(vectors)
+        k = min(self.n_centroids, len(vectors))
+        centroids = np.zeros((self.n_subspaces, self.n_centroids, parts.shape[2]), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            kmeans = KMeans(n_clusters=k, n_init=1, max_iter=50, random_state=self.seed)
+            centroids[j, :k] = kmeans.fit(parts[:, j]).cluster_centers_
+            # Unused slots (tiny corpora) repeat a real centroid so no code can point at zeros
+            centroids[j, k:] = centroids[j, 0]
+        self.centroids = centroids
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.n_subspaces), dtype=np.uint8)
+        centroid_norms = (self.centroids ** 2).sum(axis=2)
+        for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+            parts = self._split(vectors[start:start + SCORE_BLOCK_ROWS])
+            # argmin ||x - c||^2 == argmin ||c||^2 - 2 x.c per subspace
+            dots = np.einsum('nsd,skd->nsk', parts, self.centroids)
+            codes[start:start + len(parts)] = np.argmin(centroid_norms[None] - 2 * dots, axis=2)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        parts = self.centroids[np.arange(self.n_subspaces)[None, :], codes]
+        return parts.reshape(len(codes), -1)
+
+    def lookup_table(self, query: np.ndarray) -> np.ndarray:
+        return np.einsum('skd,sd->sk', self.centroids, query.reshape(self.n_subspaces, -1))
+
+    def score_block(self, codes: np.ndarray, table: np.ndarray) -> np.ndarray:
+        return table[np.arange(self.n_subspaces)[None, :], codes].sum(axis=1)
+
+    def params(self) -> Dict[str, np.ndarray]:
+        return {'centroids': self.centroids}
+
+
+QUANTIZER_TYPES = {quantizer.kind: quantizer for quantizer in (ScalarQuantizer, ProductQuantizer)}
+
+
+class CompressedIndex:
+    """Quantizer plus the uint8 codes of every trial, in row order."""
+
+    def __init__(self, quantizer, codes: np.ndarray):
+        self.quantizer = quantizer
+        self.codes = np.ascontiguousarray(codes, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, kind: str = 'pq', **params) -> 'CompressedIndex':
+        if kind not in QUANTIZER_TYPES:
+            raise ValueError(f"Unknown quantization: {kind}, available: {', '.join(QUANTIZER_TYPES)}")
+        normalized = _normalize(embeddings)
+        quantizer = QUANTIZER_TYPES[kind](**params).fit(normalized)
+        return cls(quantizer, quantizer.encode(normalized))
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + sum(p.nbytes for p in self.quantizer.params().values())
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        """Approximate cosine similarity of the query to every trial."""
+        table = self.quantizer.lookup_table(_normalize(query))
+        out = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), SCORE_BLOCK_ROWS):
+            block = self.codes[start:start + SCORE_BLOCK_ROWS]
+            out[start:start + len(block)] = self.quantizer.score_block(block, table)
+        return out
+
+    def save(self, file_path: str):
+        with open(file_path, 'wb') as f:
+            np.savez(f, kind=np.array(self.quantizer.kind), codes=self.codes, **self.quantizer.params())
+
+    @classmethod
+    def load(cls, file_path: str) -> 'CompressedIndex':
+        with np.load(file_path) as data:
+            kind = str(data['kind'])
+            if kind == 'int8':
+                quantizer = ScalarQuantizer(data['offset'], data['scale'])
+            else:
+                centroids = data['centroids']
+                quantizer = ProductQuantizer(centroids.shape[0], centroids.shape[1], centroids=centroids)
+            return cls(quantizer, data['codes'])
+
+
+def rerank_depth(candidates: int, top_k: Optional[int]) -> Optional[int]:
+    """Candidates to re-rank so a top_k request is never cut short; None re-ranks every row."""
+    return None if top_k is None else max(candidates, top_k)
+
+
+def rerank(approximate: np.ndarray, query: np.ndarray, matrix: np.ndarray, norms: np.ndarray,
+           candidates: Optional[int]) -> np.ndarray:
+    """Exact cosine for the top `candidates` approximate scores; every other row drops to -inf."""
+    top = top_k_indices(approximate, candidates)
+    exact = np.full(len(approximate), -np.inf, dtype=np.float32)
+    query_norm = np.linalg.norm(query) or 1.0
+    exact[top] = (matrix[top] @ query) / (norms[top] * query_norm)
+    return exact
+
+
+def _recall(expected: List[np.ndarray], got: List[np.ndarray]) -> float:
+    hits = sum(len(np.intersect1d(e, g)) for e, g in zip(expected, got))
+    return hits / max(1, sum(len(e) for e in expected))
+
+
+def benchmark(embeddings: np.ndarray, queries: np.ndarray, top_k: int = 10,
+              configs: Optional[List[Tuple[str, Dict]]] = None,
+              rerank_candidates: Tuple[int, ...] = (0, 100)) -> List[Dict]:
+    """Memory, per-query latency and recall@k against exact float32 search for each codec."""
+    configs = configs or [('int8', {}), ('pq', {'n_subspaces': DEFAULT_SUBSPACES}),
+                          ('pq', {'n_subspaces': 96})]
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1)
+    norms[norms == 0] = 1.0
+
+    started = time.perf_counter()
+    expected = [top_k_indices((matrix @ q) / (norms * np.linalg.norm(q)), top_k) for q in queries]
+    rows = [{'codec': 'float32', 'rerank': 0, 'bytes_per_trial': matrix.nbytes / len(matrix),
+             'total_mb': matrix.nbytes / 2 ** 20, 'build_s': 0.0,
+             'ms_per_query': (time.perf_counter() - started) / len(queries) * 1000, 'recall': 1.0}]
+
+    for kind, params in configs:
+        started = time.perf_counter()
+        try:
+            index = CompressedIndex.build(matrix, kind, **params)
+        except ValueError as e:
+            print(f"Skipping {kind} {params}: {e}")
+            continue
+        build_s = time.perf_counter() - started
+        label = kind if kind == 'int8' else f"pq{index.quantizer.n_subspaces}"
+        for candidates in rerank_candidates:
+            started = time.perf_counter()
+            got = []
+            for q in queries:
+                scores = index.scores(q)
+                if candidates:
+                    scores = rerank(scores, q, matrix, norms, max(candidates, top_k))
+                got.append(top_k_indices(scores, top_k))
+            rows.append({
+                'codec': label,
+                'rerank': candidates,
+                # Codebooks are a fixed cost, so per-trial bytes count the codes only
+                'bytes_per_trial': index.codes.nbytes / len(index),
+                # Re-ranking keeps the float vectors resident as well
+                'total_mb': (index.nbytes + (matrix.nbytes if candidates else 0)) / 2 ** 20,
+                'build_s': build_s,
+                'ms_per_query': (time.perf_counter() - started) / len(queries) * 1000,
+                'recall': _recall(expected, got),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compressed embeddings against exact search")
+    parser.add_argument('--csv', default='all_conditions_trials.csv')
+    parser.add_argument('--embeddings', default='trial_embeddings.pt')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--rerank', default='0,100', help="comma-separated re-rank candidate counts")
+    parser.add_argument('--save', help="also write a compressed index (e.g. trial_embeddings.pq.npz)")
+    parser.add_argument('--kind', default='pq', choices=sorted(QUANTIZER_TYPES))
+    args = parser.parse_args()
+
+    from similarity_graph import load_corpus
+
+    _, embeddings = load_corpus(args.csv, args.embeddings)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    rng = np.random.default_rng(0)
+    # Perturbed trial vectors stand in for patient queries: realistic norms, clear neighbours
+    picks = rng.integers(len(embeddings), size=args.queries)
+    queries = (embeddings[picks] + rng.normal(0, 0.05, (args.queries, embeddings.shape[1]))).astype(np.float32)
+
+    rows = benchmark(embeddings, queries, args.top_k,
+                     rerank_candidates=tuple(int(c) for c in args.rerank.split(',') if c))
+    print(f"{len(embeddings)} trials, {embeddings.shape[1]} dims, {args.queries} queries, recall@{args.top_k}")
+    print(f"{'codec':<8} {'rerank':>6} {'B/trial':>8} {'MB':>8} {'build s':>8} {'ms/query':>9} {'recall':>7}")
+    for row in rows:
+        print(f"{row['codec']:<8} {row['rerank']:>6} {row['bytes_per_trial']:>8.1f} {row['total_mb']:>8.2f} "
+              f"{row['build_s']:>8.2f} {row['ms_per_query']:>9.3f} {row['recall']:>7.3f}")
+
+    if args.save:
+        CompressedIndex.build(embeddings, args.kind).save(args.save)
+        print(f"Saved {args.kind} index to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Precomputed dense-engine rankings for the queries most traffic looks like.
+
+The cache is warmed once per snapshot from a list of canonical queries plus
+the most common `Condition` values in the corpus.  For each one it stores the
+top `depth` (row, score) pairs.  An incoming description is served from the
+cache when its normalized text matches a cached query exactly (no encode at
+all) or when its embedding is within `min_similarity` cosine of one (no scan).
+Because the cache lives on the snapshot's matcher, a reload starts a fresh one.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import metrics
+from trial_rows import top_k_indices
+
+CACHE_NAME = 'match_results'
+
+# The sample patients from bert_matcher.main, plus the conditions we see most
+CANONICAL_QUERIES = [
+    "I have heart failure and need treatment options",
+    "Patient with congenital heart disease looking for clinical trials",
+    "Heart attack survivor seeking rehabilitation studies",
+    "Elderly patient with atrial fibrillation",
+    "heart failure",
+    "atrial fibrillation",
+    "congenital heart disease",
+]
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def load_queries(file_path: str) -> List[str]:
+    """One canonical query per line; blank lines and # comments are skipped."""
+    with open(file_path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+class ResultCache:
+    def __init__(self, matcher, min_similarity: float = 0.97, depth: int = 50):
+        self.matcher = matcher
+        self.min_similarity = min_similarity
+        self.depth = depth
+        self.queries: List[str] = []
+        self._texts: Dict[str, int] = {}
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._rankings: List[Tuple[np.ndarray, np.ndarray]] = []
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.queries)
+
+    def warm(self, queries: Sequence[str]):
+        """Encode and rank every query (one batched encode), replacing previous entries."""
+        queries = list(dict.fromkeys(q for q in queries if q and q.strip()))
+        engine = self.matcher.get_engine('dense')
+        if not queries:
+            return
+        metrics.MODEL_BATCH_SIZE.observe(len(queries), caller='cache_warm')
+        vectors = np.asarray(self.matcher.model.encode(queries), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+
+        rankings = []
+        for vector in vectors:
+            scores = engine.score_vector(vector)
+            top = top_k_indices(scores, self.depth)
+            rankings.append((top.astype(np.int64), scores[top].astype(np.float32)))
+
+        self.queries = queries
+        self._texts = {normalize_text(q): i for i, q in enumerate(queries)}
+        self._vectors = vectors / norms
+        self._rankings = rankings
+        print(f"Warmed result cache with {len(queries)} queries")
+
+    def lookup(self, text: str, top_k: int, similarity_threshold: float
+               ) -> Tuple[Optional[List[Tuple[int, float]]], Optional[np.ndarray]]:
+        """
+        (ranked, query) -- `ranked` is set on a hit; on a miss `query` is the
+        encoded description, so the caller can score it without encoding again.
+        """
+        # Only 1..depth is answerable from a stored ranking; anything else takes the uncached path
+        if top_k is None or top_k < 1 or top_k > self.depth or not self.queries:
+            self._record(False)
+            return None, None
+
+        entry = self._texts.get(normalize_text(text))
+        query = None
+        if entry is None:
+            metrics.MODEL_BATCH_SIZE.observe(1, caller='query')
+            with metrics.stage('encode'):
+                query = self.matcher.encode_query(text)
+            with metrics.stage('cache_lookup'):
+                similarities = self._vectors @ (query / (np.linalg.norm(query) or 1.0))
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.min_similarity:
+                    entry = best
+
+        self._record(entry is not None)
+        if entry is None:
+            return None, query
+        indices, scores = self._rankings[entry]
+        return [(int(i), float(s)) for i, s in zip(indices[:top_k], scores[:top_k])
+                if s >= similarity_threshold], query
+
+    def _record(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.record_cache(CACHE_NAME, hit)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.queries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+        }
+
+
+def build_result_cache(matcher, extra_queries: Sequence[str] = (), conditions: int = 50,
+                       min_similarity: float = 0.97, depth: int = 50) -> ResultCache:
+    """Cache warmed from CANONICAL_QUERIES, `extra_queries` and the top `conditions` Condition values."""
+    queries = list(CANONICAL_QUERIES) + list(extra_queries)
+    if conditions:
+        queries += [str(c) for c in matcher.trials_data['Condition'].value_counts().head(conditions).index]
+    cache = ResultCache(matcher, min_similarity=min_similarity, depth=depth)
+    cache.warm(queries)
+    return cache
@@ -0,0 +1,41 @@
+"""
+Fast JSON encoding for match responses.
+
+Uses orjson when it is installed and falls back to the standard library, so the
+APIs keep working on a bare install.  `ndjson_stream` turns an iterator of
+matches into newline-delimited JSON chunks for StreamingResponse, encoding one
+row at a time so memory stays flat regardless of top_k.
+"""
+import json
+from typing import Any, Iterable, Iterator
+
+from fastapi.responses import JSONResponse, StreamingResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson; returning it skips response_model validation."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def ndjson_stream(rows: Iterable[Any]) -> Iterator[bytes]:
+    for row in rows:
+        yield dumps(row) + b"\n"
+
+
+def ndjson_response(rows: Iterable[Any], **kwargs) -> StreamingResponse:
+    return StreamingResponse(ndjson_stream(rows), media_type=NDJSON_MEDIA_TYPE, **kwargs)
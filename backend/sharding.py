@@ -0,0 +1,475 @@
+"""
+Sharded dense matching across local worker processes.
+
+Trials are partitioned by a stable hash of their NCTId.  The parent splits the
+CSV (in chunks) and the memory-mapped embedding matrix, whose rows it finds by
+NCTId, into one file pair per shard, so each worker process loads only its own
+partition.  A query is encoded once in the parent, written to a slot of a
+shared-memory block, and its slot number is broadcast to every shard.  Each
+shard scores its rows, materializes its local top-k and replies; the parent
+merges the already-sorted shard lists with a heap.
+
+Workers can hold their partition as compressed codes (see quantization.py)
+instead of float32, optionally re-ranking the best candidates exactly.
+
+    MATCH_SHARDS=4 python bert_api.py
+    python sharding.py --shards 4    # self-check against a single-process scan
+"""
+import argparse
+import heapq
+import itertools
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from contextlib import nullcontext
+from multiprocessing import shared_memory
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+import metrics
+from embedding_manifest import align_rows, load_manifest, manifest_path, text_digest
+from engines import DenseEngine
+from quantization import CompressedIndex, rerank, rerank_depth
+from trial_rows import materialize_row, resolve_fields, top_k_indices, trial_details, trial_text
+
+SHARD_REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    'shard_request_seconds', 'Scatter-gather latency across all shards')
+SHARD_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'shard_pending_requests', 'Queries waiting on shard replies')
+
+
+def shard_of(nct_id: str, n_shards: int) -> int:
+    # crc32 is stable across processes, unlike hash() with PYTHONHASHSEED randomization
+    return zlib.crc32(str(nct_id).encode('utf-8')) % n_shards
+
+
+def _load_embeddings(embeddings_file: str) -> np.ndarray:
+    import torch
+
+    try:
+        # Memory-mapped, so slicing out each shard doesn't materialize the whole matrix at once
+        return torch.load(embeddings_file, map_location='cpu', mmap=True).numpy()
+    except (TypeError, RuntimeError):
+        # Older torch, or a file saved in the legacy (non-zip) format
+        return torch.load(embeddings_file, map_location='cpu').numpy()
+
+
+def write_partitions(csv_file: str, embeddings_file: str, n_shards: int, directory: str,
+                     chunksize: int = 5000) -> List[Dict[str, str]]:
+    """
+    Split the corpus into one CSV + .npy pair per shard, reading the CSV in chunks,
+    so each worker loads only its own rows instead of the whole corpus.  Vectors
+    are looked up by NCTId and text (see embedding_manifest.py), never by position.
+    """
+    import pandas as pd
+
+    paths = [{'csv': os.path.join(directory, f'shard-{i}.csv'),
+              'embeddings': os.path.join(directory, f'shard-{i}.npy')} for i in range(n_shards)]
+    owners, nct_ids, digests = [], [], []
+    for chunk in pd.read_csv(csv_file, chunksize=chunksize):
+        chunk_ids = chunk['NCTId'].astype(str).tolist()
+        chunk_owners = np.array([shard_of(n, n_shards) for n in chunk_ids], dtype=np.int64)
+        for shard_id in range(n_shards):
+            owned = chunk_owners == shard_id
+            chunk[owned].to_csv(paths[shard_id]['csv'], mode='a', index=False,
+                                header=not os.path.exists(paths[shard_id]['csv']))
+        owners.append(chunk_owners)
+        nct_ids.extend(chunk_ids)
+        digests.extend(text_digest(trial_text(trial)) for _, trial in chunk.iterrows())
+    owners = np.concatenate(owners) if owners else np.empty(0, dtype=np.int64)
+
+    embeddings = _load_embeddings(embeddings_file)
+    manifest = load_manifest(embeddings_file, len(embeddings))
+    if manifest is None:
+        raise ValueError(f"{manifest_path(embeddings_file)} is missing, so {embeddings_file} rows "
+                         f"can't be matched to trials")
+    positions = align_rows(manifest, nct_ids, digests)
+    missing = int((positions < 0).sum())
+    if missing:
+        raise ValueError(f"{missing} trials in {csv_file} have no row in {embeddings_file}; re-sync it first")
+    for shard_id in range(n_shards):
+        indices = positions[owners == shard_id]
+        np.save(paths[shard_id]['embeddings'], np.ascontiguousarray(embeddings[indices], dtype=np.float32))
+    return paths
+
+
+def _load_partition(partition: Dict[str, str]):
+    import pandas as pd
+
+    trials_data = pd.read_csv(partition['csv'])
+    matrix = np.load(partition['embeddings'])
+    if len(matrix) != len(trials_data):
+        raise ValueError(f"{partition['embeddings']} has {len(matrix)} rows for {len(trials_data)} trials")
+    return trials_data, matrix
+
+
+def _shard_worker(shard_id: int, partition: Dict[str, str],
+                  shm_name: str, slots: int, dim: int, requests, replies,
+                  quantization: Optional[str] = None, rerank_candidates: int = 0):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        queries = np.ndarray((slots, dim), dtype=np.float32, buffer=shm.buf)
+        trials_data, matrix = _load_partition(partition)
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = 1.0
+        index = None
+        if quantization:
+            index = CompressedIndex.build(matrix, quantization)
+            if not rerank_candidates:
+                matrix = None
+        nct_index = {}
+        for i, nct_id in enumerate(trials_data['NCTId'].astype(str)):
+            nct_index.setdefault(nct_id, i)
+        replies.put(('ready', shard_id, {
+            'total_trials': len(trials_data),
+            'embedding_bytes': (0 if matrix is None else matrix.nbytes) + (0 if index is None else index.nbytes),
+            'conditions': trials_data['Condition'].value_counts().to_dict(),
+            'countries': trials_data['LocationCountry'].value_counts().to_dict(),
+        }))
+
+        while True:
+            message = requests.get()
+            if message is None:
+                break
+            kind, request_id = message[0], message[1]
+            try:
+                if kind == 'match':
+                    _, _, slot, top_k, threshold, fields = message
+                    query = queries[slot]
+                    if index is None:
+                        scores = (matrix @ query) / (norms * (np.linalg.norm(query) or 1.0))
+                    else:
+                        scores = index.scores(query)
+                        if rerank_candidates:
+                            scores = rerank(scores, query, matrix, norms, rerank_depth(rerank_candidates, top_k))
+                    results = [(float(scores[i]), materialize_row(trials_data, i, scores[i], fields))
+                               for i in top_k_indices(scores, top_k) if scores[i] >= threshold]
+                    replies.put(('match', request_id, results))
+                elif kind == 'details':
+                    idx = nct_index.get(message[2])
+                    replies.put(('details', request_id, None if idx is None else trial_details(trials_data.iloc[idx])))
+            except Exception as e:
+                replies.put(('error', request_id, f"shard {shard_id}: {type(e).__name__}: {e}"))
+    except Exception as e:
+        replies.put(('failed', shard_id, f"{type(e).__name__}: {e}"))
+    finally:
+        shm.close()
+
+
+class ShardUnavailable(RuntimeError):
+    """A shard process has exited, so requests that need it can't be answered."""
+
+
+class _Pending:
+    __slots__ = ('expected', 'results', 'errors', 'done', 'slot')
+
+    def __init__(self, expected: int, slot: Optional[int]):
+        self.expected = expected
+        self.results = []
+        self.errors = []
+        self.done = threading.Event()
+        self.slot = slot
+
+
+class ShardedMatcher:
+    """Drop-in for ClinicalTrialMatcher's dense search with trials spread over N processes."""
+
+    engines = ('dense',)
+    site_index = None
+
+    def __init__(self, csv_file: str, embeddings_file: str, n_shards: int, model=None,
+                 model_name: str = 'all-MiniLM-L6-v2', slots: int = 64, timeout: float = 30.0,
+                 profiler=None, quantization: Optional[str] = None, rerank_candidates: int = 100):
+        self.csv_file = csv_file
+        self.embeddings_file = embeddings_file
+        self.n_shards = n_shards
+        self.model = model
+        self.model_name = model_name
+        self.slots = slots
+        self.timeout = timeout
+        self.profiler = profiler
+        self.quantization = quantization
+        self.rerank_candidates = rerank_candidates
+        self.shard_stats: Dict[int, Dict] = {}
+        self._processes = []
+        self._request_queues = []
+        self._replies = None
+        self._shm = None
+        self._queries = None
+        self._free_slots = queue.Queue()
+        self._pending: Dict[int, _Pending] = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._collector = None
+        self._closed = False
+        self._partition_dir = None
+
+    def start(self, dim: Optional[int] = None):
+        if dim is None:
+            if self.model is None:
+                from sentence_transformers import SentenceTransformer
+                self.model = SentenceTransformer(self.model_name)
+            dim = self.model.get_sentence_embedding_dimension()
+
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * dim * 4)
+        self._queries = np.ndarray((self.slots, dim), dtype=np.float32, buffer=self._shm.buf)
+        for slot in range(self.slots):
+            self._free_slots.put(slot)
+
+        self._partition_dir = tempfile.mkdtemp(prefix='match-shards-')
+        try:
+            partitions = write_partitions(self.csv_file, self.embeddings_file, self.n_shards, self._partition_dir)
+        except Exception:
+            self.close()
+            raise
+
+        # spawn, not fork: the parent already holds torch thread pools that don't survive fork
+        context = multiprocessing.get_context('spawn')
+        self._replies = context.Queue()
+        for shard_id in range(self.n_shards):
+            requests = context.Queue()
+            process = context.Process(
+                target=_shard_worker,
+                args=(shard_id, partitions[shard_id],
+                      self._shm.name, self.slots, dim, requests, self._replies,
+                      self.quantization, self.rerank_candidates),
+                name=f'match-shard-{shard_id}', daemon=True)
+            process.start()
+            self._request_queues.append(requests)
+            self._processes.append(process)
+
+        deadline = time.monotonic() + max(self.timeout, 300.0)
+        while len(self.shard_stats) < self.n_shards:
+            try:
+                kind, shard_id, payload = self._replies.get(timeout=1.0)
+            except queue.Empty:
+                # A worker killed while loading (e.g. out of memory) never reports 'failed'
+                dead = [i for i in self.dead_shards() if i not in self.shard_stats]
+                if dead or time.monotonic() >= deadline:
+                    self.close()
+                    raise RuntimeError(f"Shard(s) {dead} exited while loading" if dead
+                                       else "Shards did not finish loading in time")
+                continue
+            if kind == 'failed':
+                self.close()
+                raise RuntimeError(f"Shard {shard_id} failed to load: {payload}")
+            self.shard_stats[shard_id] = payload
+        print(f"Started {self.n_shards} shards: "
+              f"{[self.shard_stats[i]['total_trials'] for i in range(self.n_shards)]} trials, "
+              f"{sum(s['embedding_bytes'] for s in self.shard_stats.values()) / 2 ** 20:.1f} MB of embeddings"
+              + (f" ({self.quantization})" if self.quantization else ""))
+
+        self._collector = threading.Thread(target=self._collect, name='shard-collector', daemon=True)
+        self._collector.start()
+        return self
+
+    def _collect(self):
+        while not self._closed:
+            try:
+                kind, request_id, payload = self._replies.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                pending = self._pending.get(request_id)
+                if pending is None:
+                    continue
+                if kind == 'error':
+                    pending.errors.append(payload)
+                else:
+                    pending.results.append(payload)
+                if len(pending.results) + len(pending.errors) >= pending.expected:
+                    del self._pending[request_id]
+                    SHARD_QUEUE_DEPTH.dec()
+                    # Only now is it safe to reuse the slot: every shard has read it
+                    if pending.slot is not None:
+                        self._free_slots.put(pending.slot)
+                    pending.done.set()
+
+    def dead_shards(self, shards: Optional[List[int]] = None) -> List[int]:
+        shards = range(self.n_shards) if shards is None else shards
+        return [i for i in shards if not self._processes[i].is_alive()]
+
+    def _abandon(self, request_id: int) -> bool:
+        """Forget a request that won't complete; late replies to it are ignored by _collect."""
+        with self._pending_lock:
+            pending = self._pending.pop(request_id, None)
+            if pending is None:
+                return False
+            SHARD_QUEUE_DEPTH.dec()
+            # A slow shard may still read this slot, but its reply is dropped, so reuse is safe
+            if pending.slot is not None:
+                self._free_slots.put(pending.slot)
+        return True
+
+    def _dispatch(self, shards: List[int], build_message, slot: Optional[int] = None) -> List:
+        request_id = next(self._ids)
+        pending = _Pending(len(shards), slot)
+        with self._pending_lock:
+            self._pending[request_id] = pending
+            SHARD_QUEUE_DEPTH.inc()
+        dead = self.dead_shards(shards)
+        if dead:
+            self._abandon(request_id)
+            raise ShardUnavailable(f"Shard process(es) {dead} exited")
+        for shard_id in shards:
+            self._request_queues[shard_id].put(build_message(request_id))
+        deadline = time.monotonic() + self.timeout
+        while not pending.done.wait(min(0.5, max(0.0, deadline - time.monotonic()))):
+            dead = self.dead_shards(shards)
+            if not dead and time.monotonic() < deadline:
+                continue
+            if not self._abandon(request_id):
+                break  # the last reply landed while we were checking
+            if dead:
+                raise ShardUnavailable(f"Shard process(es) {dead} exited")
+            raise TimeoutError(f"Shards did not reply within {self.timeout}s")
+        if pending.errors:
+            raise RuntimeError("; ".join(pending.errors))
+        return pending.results
+
+    def match_vector(self, query: np.ndarray, top_k: int = 5, similarity_threshold: Optional[float] = None,
+                     fields: Optional[List[str]] = None) -> List[Dict]:
+        if self._closed or self._shm is None:
+            raise ValueError("Sharded matcher is not running")
+        if similarity_threshold is None:
+            similarity_threshold = DenseEngine.default_threshold
+        try:
+            slot = self._free_slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"All {self.slots} query slots stayed busy for {self.timeout}s")
+        self._queries[slot] = query
+        started = time.perf_counter()
+        try:
+            shard_results = self._dispatch(
+                list(range(self.n_shards)),
+                lambda request_id: ('match', request_id, slot, top_k, similarity_threshold, fields),
+                slot=slot)
+        finally:
+            SHARD_REQUEST_SECONDS.observe(time.perf_counter() - started)
+        with metrics.stage('merge'):
+            # Each shard list is sorted best-first, so a heap merge yields the global order
+            merged = heapq.merge(*shard_results, key=lambda item: -item[0])
+            return [match for _, match in itertools.islice(merged, top_k)]
+
+    def find_matches(self, patient_description: str, top_k: int = 5, similarity_threshold: Optional[float] = None,
+                     fields: Optional[List[str]] = None, engine: str = 'dense', near=None) -> List[Dict]:
+        if engine not in self.engines:
+            raise ValueError(f"Unknown or disabled engine: {engine}")
+        if near is not None:
+            raise ValueError("Location queries are not supported with sharded matching")
+        fields = resolve_fields(fields)
+        profiling = nullcontext()
+        if self.profiler is not None:
+            profiling = self.profiler.profile(
+                'find_matches', top_k=top_k, engine=engine, shards=self.n_shards,
+                description_chars=len(patient_description))
+        with profiling:
+            metrics.MODEL_BATCH_SIZE.observe(1, caller='query')
+            with metrics.stage('encode'):
+                query = np.asarray(self.model.encode([patient_description])[0], dtype=np.float32)
+            with metrics.stage('scatter_gather'):
+                return self.match_vector(query, top_k, similarity_threshold, fields)
+
+    def iter_matches(self, patient_description: str, top_k: int = 5, similarity_threshold: Optional[float] = None,
+                     fields: Optional[List[str]] = None, engine: str = 'dense', near=None) -> Iterator[Dict]:
+        # Shards materialize their own rows, so there is nothing left to defer here
+        yield from self.find_matches(patient_description, top_k, similarity_threshold, fields, engine, near)
+
+    def get_trial_details(self, nct_id: str) -> Optional[Dict]:
+        shard_id = shard_of(nct_id, self.n_shards)
+        return self._dispatch([shard_id], lambda request_id: ('details', request_id, nct_id))[0]
+
+    @property
+    def corpus_size(self) -> int:
+        return sum(stats['total_trials'] for stats in self.shard_stats.values())
+
+    def stats(self, top: int = 10) -> Dict:
+        conditions, countries = Counter(), Counter()
+        for stats in self.shard_stats.values():
+            conditions.update(stats['conditions'])
+            countries.update(stats['countries'])
+        return {
+            'total_trials': self.corpus_size,
+            'conditions': dict(conditions.most_common(top)),
+            'countries': dict(countries.most_common(top)),
+        }
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for requests in self._request_queues:
+            try:
+                requests.put(None)
+            except (OSError, ValueError):
+                pass
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        if self._partition_dir is not None:
+            shutil.rmtree(self._partition_dir, ignore_errors=True)
+            self._partition_dir = None
+
+
+def _self_check(args):
+    """Compare sharded top-k against an exact single-process scan using random query vectors."""
+    import pandas as pd
+    import torch
+
+    trials_data = pd.read_csv(args.csv)
+    embeddings = torch.load(args.embeddings, map_location='cpu').numpy().astype(np.float32)
+    norms = np.linalg.norm(embeddings, axis=1)
+    norms[norms == 0] = 1.0
+    rng = np.random.default_rng(0)
+
+    matcher = ShardedMatcher(args.csv, args.embeddings, args.shards,
+                             quantization=args.quantization, rerank_candidates=args.rerank)
+    matcher.start(dim=embeddings.shape[1])
+    try:
+        mismatches = 0
+        hits = 0
+        started = time.perf_counter()
+        for _ in range(args.queries):
+            # Perturbed trial vectors look like real queries and have clear nearest neighbours
+            query = embeddings[rng.integers(len(embeddings))] + rng.normal(0, 0.05, embeddings.shape[1])
+            query = query.astype(np.float32)
+            expected_scores = (embeddings @ query) / (norms * np.linalg.norm(query))
+            expected = [str(trials_data['NCTId'].iloc[i]) for i in top_k_indices(expected_scores, args.top_k)]
+            got = [m['nct_id'] for m in matcher.match_vector(query, args.top_k, -1.0, ['nct_id'])]
+            if got != expected:
+                mismatches += 1
+            hits += len(set(got) & set(expected))
+        elapsed = time.perf_counter() - started
+        print(f"{args.queries} queries over {args.shards} shards: {mismatches} mismatches, "
+              f"recall@{args.top_k} {hits / (args.queries * args.top_k):.3f}, "
+              f"{elapsed / args.queries * 1000:.2f} ms/query")
+        # Approximate codes without re-ranking are expected to differ from the exact scan
+        return 1 if mismatches and not (args.quantization and not args.rerank) else 0
+    finally:
+        matcher.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Self-check sharded matching against a single-process scan")
+    parser.add_argument('--csv', default='all_conditions_trials.csv')
+    parser.add_argument('--embeddings', default='trial_embeddings.pt')
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--quantization', choices=['int8', 'pq'])
+    parser.add_argument('--rerank', type=int, default=100, help="exact re-rank candidates with --quantization")
+    raise SystemExit(_self_check(parser.parse_args()))
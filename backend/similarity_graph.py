@@ -0,0 +1,262 @@
+"""
+Precomputed trial-to-trial nearest neighbours for the "similar trials" endpoint.
+
+The graph is built offline from the stored trial embeddings in row blocks, so
+the full N x N similarity matrix never exists in memory, and blocks are scored
+on a thread pool (numpy releases the GIL inside matmul).  Each trial keeps its
+top-k neighbours in CSR form (indptr / int32 indices / float16 scores) together
+with a digest of its embedding, which lets `refresh` recompute only the rows
+affected when trials are added, removed or re-embedded.
+
+    python similarity_graph.py --csv all_conditions_trials.csv --embeddings trial_embeddings.pt
+"""
+import argparse
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from embedding_manifest import load_manifest
+
+DEFAULT_K = 20
+# Upper bound on the per-block similarity matrix so memory stays flat as N grows
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+def embedding_digests(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    return np.array([hashlib.blake2b(row.tobytes(), digest_size=8).digest() for row in embeddings],
+                    dtype='S8')
+
+
+def _rows_per_block(n_columns: int, block_size: int) -> int:
+    return max(1, min(block_size, BLOCK_BYTES // max(1, 4 * n_columns)))
+
+
+def _block_top_k(queries: np.ndarray, corpus: np.ndarray, k: int,
+                 self_columns: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k columns of queries @ corpus.T per row, best first; self matches excluded."""
+    sims = queries @ corpus.T
+    if self_columns is not None:
+        rows = np.arange(len(queries))
+        valid = self_columns >= 0
+        sims[rows[valid], self_columns[valid]] = -np.inf
+    k = min(k, sims.shape[1])
+    if k == 0:
+        return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+    if k < sims.shape[1]:
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    else:
+        top = np.tile(np.arange(sims.shape[1]), (len(queries), 1))
+    scores = np.take_along_axis(sims, top, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def _rows_top_k(normalized: np.ndarray, rows: np.ndarray, k: int, block_size: int,
+                workers: Optional[int]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Exact top-k neighbours for the given row positions, scored block by block."""
+    step = _rows_per_block(len(normalized), block_size)
+    blocks = [rows[i:i + step] for i in range(0, len(rows), step)]
+
+    def score(block):
+        return _block_top_k(normalized[block], normalized, k, self_columns=block)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return list(pool.map(score, blocks))
+
+
+class NeighborGraph:
+    def __init__(self, nct_ids: Sequence[str], indptr: np.ndarray, indices: np.ndarray,
+                 scores: np.ndarray, digests: np.ndarray, k: int):
+        self.nct_ids = np.asarray(nct_ids, dtype=str)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float16)
+        self.digests = np.asarray(digests, dtype='S8')
+        self.k = int(k)
+        self._positions = {nct_id: i for i, nct_id in enumerate(self.nct_ids)}
+
+    def __len__(self):
+        return len(self.nct_ids)
+
+    @classmethod
+    def from_rows(cls, nct_ids, rows: List[Tuple[np.ndarray, np.ndarray]], digests, k) -> 'NeighborGraph':
+        counts = np.array([len(indices) for indices, _ in rows], dtype=np.int64)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        indices = np.concatenate([r[0] for r in rows]) if rows else np.empty(0)
+        scores = np.concatenate([r[1] for r in rows]) if rows else np.empty(0)
+        return cls(nct_ids, indptr, indices, scores, digests, k)
+
+    def row(self, position: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, stop = self.indptr[position], self.indptr[position + 1]
+        return self.indices[start:stop], self.scores[start:stop]
+
+    def neighbors(self, nct_id: str, limit: Optional[int] = None) -> Optional[List[Tuple[str, float]]]:
+        position = self._positions.get(nct_id)
+        if position is None:
+            return None
+        indices, scores = self.row(position)
+        if limit is not None:
+            indices, scores = indices[:limit], scores[:limit]
+        return [(str(self.nct_ids[i]), float(s)) for i, s in zip(indices, scores)]
+
+    def save(self, file_path: str):
+        with open(file_path, 'wb') as f:
+            np.savez(f, nct_ids=self.nct_ids, indptr=self.indptr, indices=self.indices,
+                     scores=self.scores, digests=self.digests, k=np.array(self.k))
+
+    @classmethod
+    def load(cls, file_path: str) -> 'NeighborGraph':
+        with np.load(file_path) as data:
+            return cls(data['nct_ids'], data['indptr'], data['indices'], data['scores'],
+                       data['digests'], int(data['k']))
+
+    def is_current(self, nct_ids: Sequence[str], embeddings: np.ndarray) -> bool:
+        return (len(nct_ids) == len(self.nct_ids)
+                and np.array_equal(np.asarray(nct_ids, dtype=str), self.nct_ids)
+                and np.array_equal(embedding_digests(embeddings), self.digests))
+
+
+def build_neighbor_graph(nct_ids: Sequence[str], embeddings: np.ndarray, k: int = DEFAULT_K,
+                         block_size: int = 1024, workers: Optional[int] = None) -> NeighborGraph:
+    normalized = normalize_rows(embeddings)
+    rows = np.arange(len(normalized))
+    per_row = []
+    for indices, scores in _rows_top_k(normalized, rows, k, block_size, workers):
+        per_row.extend(zip(indices.astype(np.int32), scores.astype(np.float16)))
+    return NeighborGraph.from_rows(nct_ids, per_row, embedding_digests(embeddings), k)
+
+
+def refresh_neighbor_graph(graph: NeighborGraph, nct_ids: Sequence[str], embeddings: np.ndarray,
+                           k: Optional[int] = None, block_size: int = 1024,
+                           workers: Optional[int] = None) -> Tuple[NeighborGraph, Dict[str, int]]:
+    """
+    Update `graph` for a new corpus, recomputing only what changed.
+
+    Rows whose neighbour list referenced a removed or re-embedded trial are
+    recomputed against the whole corpus.  Every other unchanged row keeps its
+    list and only merges in candidates from the new/changed trials.
+    """
+    k = graph.k if k is None else k
+    nct_ids = [str(i) for i in nct_ids]
+    digests = embedding_digests(embeddings)
+    normalized = normalize_rows(embeddings)
+    old_positions = graph._positions
+
+    unchanged = np.array([old_positions.get(nct_id) is not None
+                          and graph.digests[old_positions[nct_id]] == digest
+                          for nct_id, digest in zip(nct_ids, digests)], dtype=bool)
+    if k != graph.k:
+        unchanged[:] = False
+
+    new_positions = {nct_id: i for i, nct_id in enumerate(nct_ids)}
+    stale_old = np.ones(len(graph), dtype=bool)  # old rows that no longer exist as-is
+    for nct_id, i in new_positions.items():
+        old = old_positions.get(nct_id)
+        if old is not None and unchanged[i]:
+            stale_old[old] = False
+
+    old_to_new = np.full(len(graph), -1, dtype=np.int64)
+    for nct_id, old in old_positions.items():
+        new = new_positions.get(nct_id)
+        if new is not None and unchanged[new]:
+            old_to_new[old] = new
+
+    recompute = ~unchanged
+    for i in np.flatnonzero(unchanged):
+        indices, _ = graph.row(old_positions[nct_ids[i]])
+        if stale_old[indices].any():
+            recompute[i] = True
+
+    rows: List[Optional[Tuple[np.ndarray, np.ndarray]]] = [None] * len(nct_ids)
+
+    full_rows = np.flatnonzero(recompute)
+    if len(full_rows):
+        done = 0
+        for indices, scores in _rows_top_k(normalized, full_rows, k, block_size, workers):
+            for j in range(len(indices)):
+                rows[full_rows[done + j]] = (indices[j].astype(np.int32), scores[j].astype(np.float16))
+            done += len(indices)
+
+    # Unchanged rows: old neighbours remain valid, merge in candidates from the changed trials
+    changed = np.flatnonzero(~unchanged)
+    merge_rows = np.flatnonzero(~recompute)
+    step = _rows_per_block(max(1, len(changed)), block_size)
+    for start in range(0, len(merge_rows), step):
+        block = merge_rows[start:start + step]
+        if len(changed):
+            new_idx, new_scores = _block_top_k(normalized[block], normalized[changed], k)
+            new_idx = changed[new_idx]
+        for j, i in enumerate(block):
+            old_idx, old_scores = graph.row(old_positions[nct_ids[i]])
+            idx = old_to_new[old_idx]
+            scores = old_scores.astype(np.float32)
+            if len(changed):
+                idx = np.concatenate([idx, new_idx[j]])
+                scores = np.concatenate([scores, new_scores[j]])
+            order = np.argsort(-scores, kind='stable')[:k]
+            rows[i] = (idx[order].astype(np.int32), scores[order].astype(np.float16))
+
+    stats = {
+        'trials': len(nct_ids),
+        'changed': int(len(changed)),
+        'removed': int(sum(1 for nct_id in old_positions if nct_id not in new_positions)),
+        'recomputed_rows': int(len(full_rows)),
+        'merged_rows': int(len(merge_rows)),
+    }
+    return NeighborGraph.from_rows(nct_ids, rows, digests, k), stats
+
+
+def load_corpus(csv_file: str, embeddings_file: str) -> Tuple[List[str], np.ndarray]:
+    import pandas as pd
+    import torch
+
+    nct_ids = pd.read_csv(csv_file, usecols=['NCTId'])['NCTId'].astype(str).tolist()
+    embeddings = torch.load(embeddings_file, map_location='cpu')
+    embeddings = embeddings.numpy() if hasattr(embeddings, 'numpy') else np.asarray(embeddings)
+    if len(embeddings) != len(nct_ids):
+        raise ValueError(f"{embeddings_file} has {len(embeddings)} rows but {csv_file} has {len(nct_ids)} trials")
+    manifest = load_manifest(embeddings_file, len(embeddings))
+    if manifest is not None and manifest['ids'] != nct_ids:
+        raise ValueError(f"{embeddings_file} rows belong to different trials than {csv_file}; "
+                         f"re-sync it with bert_matcher.py")
+    return nct_ids, embeddings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the trial-to-trial neighbour graph")
+    parser.add_argument('--csv', default='all_conditions_trials.csv')
+    parser.add_argument('--embeddings', default='trial_embeddings.pt')
+    parser.add_argument('--out', default='trial_neighbors.npz')
+    parser.add_argument('--k', type=int, default=DEFAULT_K)
+    parser.add_argument('--block-size', type=int, default=1024)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--full', action='store_true', help="rebuild even if a previous graph exists")
+    args = parser.parse_args()
+
+    nct_ids, embeddings = load_corpus(args.csv, args.embeddings)
+    if os.path.exists(args.out) and not args.full:
+        print(f"Refreshing neighbour graph {args.out}...")
+        graph, stats = refresh_neighbor_graph(NeighborGraph.load(args.out), nct_ids, embeddings,
+                                              k=args.k, block_size=args.block_size, workers=args.workers)
+        print(f"Refresh stats: {stats}")
+    else:
+        print(f"Building neighbour graph for {len(nct_ids)} trials (k={args.k})...")
+        graph = build_neighbor_graph(nct_ids, embeddings, k=args.k, block_size=args.block_size,
+                                     workers=args.workers)
+    graph.save(args.out)
+    print(f"Saved {len(graph)} trials / {len(graph.indices)} edges to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
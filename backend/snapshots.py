@@ -0,0 +1,314 @@
+"""
+Immutable corpus snapshots with atomic hot-reload.
+
+A Snapshot bundles everything derived from the data files: the trial store,
+embeddings, engine indexes and the similar-trials graph.  SnapshotManager
+builds a new snapshot in a background thread, validates it, and then swaps it
+in with a single reference assignment.  Request handlers read `manager.current`
+once and keep using that object, so in-flight requests finish on the snapshot
+they started with while new requests see the new one.  The sentence-transformer
+model is shared across snapshots and never reloaded.
+
+Reloads are triggered by `reload()` (the admin endpoint) or by a polling file
+watcher that fires once a changed file has stopped changing.
+
+With `shards > 1` the snapshot's matcher is a sharding.ShardedMatcher whose
+worker processes are shut down a grace period after the snapshot is replaced.
+"""
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import metrics
+from bert_matcher import ClinicalTrialMatcher
+from embedding_manifest import manifest_path
+from engines import QuantizedEngine
+from result_cache import build_result_cache, load_queries
+from sharding import ShardedMatcher
+from similarity_graph import NeighborGraph, refresh_neighbor_graph
+
+SNAPSHOT_RELOADS = metrics.REGISTRY.counter(
+    'snapshot_reloads_total', 'Snapshot reload attempts by result', ['result'])
+SNAPSHOT_INFO = metrics.REGISTRY.gauge(
+    'snapshot_info', 'Currently served corpus snapshot (value is load time)', ['version'])
+
+VALIDATION_QUERY = "Patient with heart failure looking for clinical trials"
+# How long a replaced snapshot's shard processes stay up for requests still using it
+RETIRE_GRACE_SECONDS = 60.0
+
+
+def file_signature(paths: List[str]) -> Dict[str, Optional[tuple]]:
+    signature = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature[path] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            signature[path] = None
+    return signature
+
+
+class Snapshot:
+    def __init__(self, version: str, matcher: ClinicalTrialMatcher,
+                 neighbor_graph: Optional[NeighborGraph], sources: Dict[str, Optional[tuple]]):
+        self.version = version
+        self.matcher = matcher
+        self.neighbor_graph = neighbor_graph
+        self.sources = sources
+        self.loaded_at = time.time()
+        self._stats = None
+
+    def stats(self) -> Dict:
+        # Computed once per snapshot so /stats stays cheap enough to serve on the event loop
+        if self._stats is None:
+            self._stats = self.matcher.stats()
+        return self._stats
+
+    def info(self) -> Dict:
+        return {
+            'version': self.version,
+            'loaded_at': self.loaded_at,
+            'trials': self.matcher.corpus_size,
+            'engines': list(self.matcher.engines),
+            'similar_trials': self.neighbor_graph is not None,
+            'sites': len(self.matcher.site_index) if self.matcher.site_index is not None else 0,
+            'result_cache': (self.matcher.result_cache.stats()
+                             if getattr(self.matcher, 'result_cache', None) is not None else None),
+        }
+
+
+class SnapshotBuilder:
+    """Loads a snapshot from the configured files, sharing one model across builds."""
+
+    def __init__(self, csv_file: str, embeddings_file: str, neighbors_file: Optional[str] = None,
+                 engines: Optional[List[str]] = None, model_name: str = 'all-MiniLM-L6-v2',
+                 profiler=None, refresh_neighbors: bool = True, shards: int = 1,
+                 shard_quantization: Optional[str] = None, rerank_candidates: int = 100,
+                 result_cache: bool = False, cache_queries_file: Optional[str] = None,
+                 cache_conditions: int = 50, cache_min_similarity: float = 0.97,
+                 sites_file: Optional[str] = None, dedup: bool = False, dedup_threshold: float = 0.8):
+        self.csv_file = csv_file
+        self.embeddings_file = embeddings_file
+        self.neighbors_file = neighbors_file
+        self.engines = engines or ['dense']
+        self.model_name = model_name
+        self.profiler = profiler
+        self.refresh_neighbors = refresh_neighbors
+        self.shards = shards
+        self.shard_quantization = shard_quantization
+        self.rerank_candidates = rerank_candidates
+        self.result_cache = result_cache
+        self.cache_queries_file = cache_queries_file
+        self.cache_conditions = cache_conditions
+        self.cache_min_similarity = cache_min_similarity
+        self.sites_file = sites_file
+        self.dedup = dedup
+        self.dedup_threshold = dedup_threshold
+        self.model = None
+        self._builds = 0
+
+    @property
+    def watched_files(self) -> List[str]:
+        return [p for p in (self.csv_file, self.embeddings_file, manifest_path(self.embeddings_file),
+                            self.neighbors_file, self.cache_queries_file, self.sites_file) if p]
+
+    def build(self) -> Snapshot:
+        sources = file_signature(self.watched_files)
+        if not os.path.exists(self.csv_file):
+            raise FileNotFoundError(f"CSV file {self.csv_file} not found")
+
+        matcher = ClinicalTrialMatcher(self.model_name, profiler=self.profiler, model=self.model)
+        self.model = matcher.model
+        # Sharded snapshots only use this matcher to bring the embeddings file in sync with the CSV
+        matcher.enable_engines(self.engines if self.shards <= 1 else ['dense'])
+        for engine in matcher.engines.values():
+            if isinstance(engine, QuantizedEngine):
+                engine.rerank_candidates = self.rerank_candidates
+        if self.dedup and self.shards > 1:
+            print(f"Shard workers read {self.csv_file} as is; canonicalize it with dedup.py instead")
+        matcher.load_trials_data(self.csv_file, dedup=self.dedup and self.shards <= 1,
+                                 dedup_threshold=self.dedup_threshold)
+        if self.sites_file and os.path.exists(self.sites_file) and self.shards <= 1:
+            matcher.load_sites(self.sites_file)
+
+        # Rows are matched to trials by NCTId and text, never by position: a refreshed CSV
+        # usually has the same row count as the old one
+        stats = matcher.sync_embeddings(self.embeddings_file)
+        if stats['saved']:
+            print(f"Synced {self.embeddings_file} with {self.csv_file}: {stats}")
+            sources = file_signature(self.watched_files)
+
+        if self.shards > 1:
+            # The embeddings file is now in sync with the CSV, so each worker can load its own slice
+            if self.engines != ['dense']:
+                print(f"Sharded matching serves the dense engine only, ignoring {self.engines}")
+            sharded = ShardedMatcher(self.csv_file, self.embeddings_file, self.shards,
+                                     model=self.model, profiler=self.profiler,
+                                     quantization=self.shard_quantization,
+                                     rerank_candidates=self.rerank_candidates)
+            sharded.start()
+            return self._snapshot(sharded, None, sources)
+
+        neighbor_graph = self._load_neighbor_graph(matcher)
+        if neighbor_graph is not None and self.neighbors_file:
+            sources = file_signature(self.watched_files)
+        if self.result_cache:
+            # A fresh cache per snapshot: rankings are row positions in this snapshot's corpus
+            queries = []
+            if self.cache_queries_file and os.path.exists(self.cache_queries_file):
+                queries = load_queries(self.cache_queries_file)
+            matcher.result_cache = build_result_cache(
+                matcher, queries, conditions=self.cache_conditions, min_similarity=self.cache_min_similarity)
+        return self._snapshot(matcher, neighbor_graph, sources)
+
+    def _snapshot(self, matcher, neighbor_graph, sources) -> Snapshot:
+        self._builds += 1
+        digest = hashlib.sha1(repr(sorted(sources.items())).encode()).hexdigest()[:8]
+        return Snapshot(f"v{self._builds}-{digest}", matcher, neighbor_graph, sources)
+
+    def _load_neighbor_graph(self, matcher: ClinicalTrialMatcher) -> Optional[NeighborGraph]:
+        if not self.neighbors_file or not os.path.exists(self.neighbors_file):
+            return None
+        graph = NeighborGraph.load(self.neighbors_file)
+        if self.refresh_neighbors:
+            nct_ids = matcher.trials_data['NCTId'].astype(str).tolist()
+            embeddings = matcher.trial_embeddings.cpu().numpy()
+            if not graph.is_current(nct_ids, embeddings):
+                graph, stats = refresh_neighbor_graph(graph, nct_ids, embeddings)
+                graph.save(self.neighbors_file)
+                print(f"Refreshed similar-trials graph: {stats}")
+        print(f"Loaded similar-trials graph for {len(graph)} trials")
+        return graph
+
+
+def validate_snapshot(snapshot: Snapshot):
+    """Raise ValueError if the snapshot is not safe to serve."""
+    matcher = snapshot.matcher
+    if isinstance(matcher, ShardedMatcher):
+        if matcher.corpus_size == 0:
+            raise ValueError("Snapshot has no trials")
+        if len(matcher.find_matches(VALIDATION_QUERY, top_k=1, similarity_threshold=-1.0)) != 1:
+            raise ValueError("Validation query returned no results from shards")
+        return
+    if matcher.trials_data is None or len(matcher.trials_data) == 0:
+        raise ValueError("Snapshot has no trials")
+    embeddings = matcher.trial_embeddings.cpu().numpy()
+    if embeddings.shape[0] != len(matcher.trials_data):
+        raise ValueError(f"{embeddings.shape[0]} embeddings for {len(matcher.trials_data)} trials")
+    if matcher.embedding_rows != matcher.corpus_rows():
+        raise ValueError("Embeddings were computed for different trials than the loaded CSV")
+    expected_dim = matcher.model.get_sentence_embedding_dimension()
+    if expected_dim is not None and embeddings.shape[1] != expected_dim:
+        raise ValueError(f"Embedding dimension {embeddings.shape[1]} != model dimension {expected_dim}")
+    if not np.isfinite(embeddings).all():
+        raise ValueError("Embeddings contain NaN or infinite values")
+    for engine in matcher.engines:
+        ranked = matcher.rank(VALIDATION_QUERY, top_k=1, similarity_threshold=-1.0, engine=engine)
+        if len(ranked) != 1:
+            raise ValueError(f"Validation query returned no results for engine {engine}")
+
+
+class SnapshotManager:
+    def __init__(self, build: Callable[[], Snapshot], validate: Callable[[Snapshot], None] = validate_snapshot):
+        self._build = build
+        self._validate = validate
+        self._current: Optional[Snapshot] = None
+        self._reload_lock = threading.Lock()
+        self._reloading = False
+        self._watcher = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def current(self) -> Optional[Snapshot]:
+        return self._current
+
+    def _begin_reload(self) -> bool:
+        with self._reload_lock:
+            if self._reloading:
+                return False
+            self._reloading = True
+            return True
+
+    def reload(self, background: bool = True) -> bool:
+        """Build, validate and swap in a new snapshot; False if a reload is already running."""
+        if not self._begin_reload():
+            return False
+        if background:
+            threading.Thread(target=self._reload, name='snapshot-reload', daemon=True).start()
+        else:
+            self._reload(raise_errors=True)
+        return True
+
+    def _reload(self, raise_errors: bool = False):
+        try:
+            started = time.perf_counter()
+            snapshot = self._build()
+            try:
+                self._validate(snapshot)
+            except Exception:
+                snapshot.matcher.close()
+                raise
+            snapshot.stats()
+            previous, self._current = self._current, snapshot
+            if previous is not None:
+                SNAPSHOT_INFO.set(0, version=previous.version)
+                self._retire(previous)
+            SNAPSHOT_INFO.set(snapshot.loaded_at, version=snapshot.version)
+            metrics.CORPUS_SIZE.set(snapshot.matcher.corpus_size)
+            SNAPSHOT_RELOADS.inc(result='success')
+            self.last_error = None
+            print(f"Serving snapshot {snapshot.version} (built in {time.perf_counter() - started:.1f}s)")
+        except Exception as e:
+            SNAPSHOT_RELOADS.inc(result='failure')
+            self.last_error = f"{type(e).__name__}: {e}"
+            print(f"Snapshot reload failed, keeping current snapshot: {self.last_error}")
+            if raise_errors:
+                raise
+        finally:
+            with self._reload_lock:
+                self._reloading = False
+
+    def _retire(self, snapshot: Snapshot):
+        timer = threading.Timer(RETIRE_GRACE_SECONDS, snapshot.matcher.close)
+        timer.daemon = True
+        timer.start()
+
+    def status(self) -> Dict:
+        return {
+            'current': self._current.info() if self._current is not None else None,
+            'reloading': self._reloading,
+            'last_error': self.last_error,
+        }
+
+    def watch(self, paths: Callable[[], List[str]], interval: float = 10.0):
+        """Poll file signatures and reload once a change has settled for one interval."""
+        if self._watcher is not None or interval <= 0:
+            return
+
+        def run():
+            pending = None
+            failed = None
+            while True:
+                time.sleep(interval)
+                current = self._current
+                if current is None:
+                    continue
+                signature = file_signature(paths())
+                if signature == current.sources or signature == failed:
+                    pending = None
+                elif signature == pending:
+                    print("Data files changed, reloading snapshot...")
+                    if self._begin_reload():
+                        self._reload()
+                        # Don't rebuild the same broken files on every poll
+                        failed = signature if self.last_error else None
+                    pending = None
+                else:
+                    pending = signature
+
+        self._watcher = threading.Thread(target=run, name='snapshot-watcher', daemon=True)
+        self._watcher.start()
@@ -0,0 +1,65 @@
+"""
+Shared fixtures: a small slice of the bundled trials and a stub encoder, so the
+suite runs without downloading sentence-transformer weights.
+
+    cd backend && python -m pytest -q tests
+"""
+import hashlib
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from bert_matcher import ClinicalTrialMatcher  # noqa: E402
+
+TRIALS_CSV = os.path.join(BACKEND, 'heart_disease_trials.csv')
+
+
+class StubModel:
+    """Signed bag-of-words hashing in the SentenceTransformer.encode interface."""
+
+    def __init__(self, dim: int = 96):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, convert_to_tensor=False, **kwargs):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:8], 'little')
+                vectors[i, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+        return torch.from_numpy(vectors) if convert_to_tensor else vectors
+
+
+@pytest.fixture(scope='session')
+def model():
+    return StubModel()
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    """(csv_file, embeddings_file) for 150 trials, embeddings written by the stub model."""
+    csv_file = str(tmp_path / 'trials.csv')
+    pd.read_csv(TRIALS_CSV).head(150).to_csv(csv_file, index=False)
+    return csv_file, str(tmp_path / 'trial_embeddings.pt')
+
+
+@pytest.fixture
+def make_matcher(model):
+    """Builds a ClinicalTrialMatcher over a CSV the way SnapshotBuilder does."""
+    def make(csv_file, embeddings_file, engines=('dense',)):
+        matcher = ClinicalTrialMatcher(model=model)
+        matcher.enable_engines(list(engines))
+        matcher.load_trials_data(csv_file)
+        matcher.sync_embeddings(embeddings_file)
+        return matcher
+    return make
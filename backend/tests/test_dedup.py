@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+
+import dedup
+from conftest import TRIALS_CSV
+from trial_rows import DUPLICATES_COLUMN, trial_text
+
+
+def test_parallel_signatures_equal_serial(monkeypatch):
+    texts = [trial_text(trial) for _, trial in pd.read_csv(TRIALS_CSV).head(120).iterrows()]
+    monkeypatch.setattr(dedup, 'PARALLEL_MIN_ROWS', 10)
+    serial = dedup.minhash_signatures(texts)
+    parallel = dedup.parallel_signatures(texts, workers=3)
+    np.testing.assert_array_equal(parallel[0], serial[0])
+    np.testing.assert_array_equal(parallel[1], serial[1])
+
+
+def test_deduplicate_folds_planted_copies():
+    trials = pd.read_csv(TRIALS_CSV).head(200)
+    copies = trials.sample(12, random_state=3).copy()
+    copies['NCTId'] = [f"NCTCOPY{i:04d}" for i in range(len(copies))]
+    copies['BriefTitle'] = copies['BriefTitle'].astype(str) + ' (extension study)'
+    # A re-listed row with the same NCTId is always merged
+    relisted = trials.iloc[[0]]
+    canonical, stats = dedup.deduplicate(pd.concat([trials, copies, relisted], ignore_index=True), workers=1)
+
+    folded = {nct_id for value in canonical[DUPLICATES_COLUMN] for nct_id in str(value).split(';') if nct_id}
+    assert set(copies['NCTId']) <= folded
+    assert stats['same_nct_merges'] == 1
+    assert stats['input_rows'] - stats['canonical_rows'] == stats['same_nct_merges'] + stats['near_duplicate_merges']
+    assert stats['verified_pairs'] <= stats['candidate_checks']
+    # The earliest row of a cluster is its representative, so no copy is kept over its original
+    assert not set(copies['NCTId']) & set(canonical['NCTId'].astype(str))
+
+
+def test_deduplicate_is_stable_under_recanonicalization():
+    trials = pd.read_csv(TRIALS_CSV).head(150)
+    copies = trials.head(5).copy()
+    copies['NCTId'] = [f"NCTCOPY{i:04d}" for i in range(5)]
+    canonical, _ = dedup.deduplicate(pd.concat([trials, copies], ignore_index=True), workers=1)
+    again, stats = dedup.deduplicate(canonical, workers=1)
+    assert stats['near_duplicate_merges'] == 0
+    assert list(again[DUPLICATES_COLUMN]) == list(canonical[DUPLICATES_COLUMN])
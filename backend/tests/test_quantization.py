@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from engines import QuantizedEngine
+from quantization import CompressedIndex, rerank, rerank_depth
+from trial_rows import top_k_indices
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, 64))
+    matrix = (centers[rng.integers(20, size=800)] + rng.normal(0, 0.4, size=(800, 64))).astype(np.float32)
+    queries = (matrix[rng.integers(800, size=40)] + rng.normal(0, 0.1, size=(40, 64))).astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1)
+    return matrix, norms, queries
+
+
+def exact_scores(matrix, norms, query):
+    return (matrix @ query) / (norms * np.linalg.norm(query))
+
+
+def recall(index, vectors, top_k=10, candidates=0):
+    matrix, norms, queries = vectors
+    hits = 0
+    for query in queries:
+        scores = index.scores(query)
+        if candidates:
+            scores = rerank(scores, query, matrix, norms, rerank_depth(candidates, top_k))
+        hits += len(np.intersect1d(top_k_indices(scores, top_k),
+                                   top_k_indices(exact_scores(matrix, norms, query), top_k)))
+    return hits / (len(queries) * top_k)
+
+
+@pytest.mark.parametrize('kind, params, floor', [('int8', {}, 0.9), ('pq', {'n_subspaces': 16}, 0.5)])
+def test_quantized_recall(vectors, kind, params, floor):
+    index = CompressedIndex.build(vectors[0], kind, **params)
+    assert recall(index, vectors) >= floor
+    # Re-ranking the best approximate candidates exactly recovers (nearly) the exact top-k
+    assert recall(index, vectors, candidates=100) >= 0.98
+
+
+def test_compressed_index_round_trips(tmp_path, vectors):
+    index = CompressedIndex.build(vectors[0], 'pq', n_subspaces=16)
+    index.save(str(tmp_path / 'codes.npz'))
+    loaded = CompressedIndex.load(str(tmp_path / 'codes.npz'))
+    np.testing.assert_allclose(loaded.scores(vectors[2][0]), index.scores(vectors[2][0]), rtol=1e-6)
+
+
+def test_rerank_never_covers_fewer_rows_than_top_k():
+    assert rerank_depth(100, 5) == 100
+    assert rerank_depth(100, 250) == 250
+    assert rerank_depth(100, None) is None
+
+
+@pytest.mark.parametrize('engine', ['int8', 'pq'])
+def test_quantized_engine_returns_top_k_beyond_rerank_candidates(corpus, make_matcher, monkeypatch, engine):
+    matcher = make_matcher(*corpus, engines=('dense', engine))
+    monkeypatch.setattr(QuantizedEngine, 'rerank_candidates', 5)
+    query = "Patient with heart failure looking for clinical trials"
+    ranked = matcher.rank(query, top_k=30, similarity_threshold=-1.0, engine=engine)
+    assert len(ranked) == 30
+    exact = dict(matcher.rank(query, top_k=None, similarity_threshold=-1.0, engine='dense'))
+    # Every returned score is the exact one
+    assert [s for _, s in ranked] == pytest.approx([exact[i] for i, _ in ranked], abs=1e-5)
@@ -0,0 +1,49 @@
+import pytest
+
+from result_cache import build_result_cache
+
+QUERIES = [
+    "heart failure",
+    "Patient with heart failure looking for clinical trials",
+    "Elderly patient with atrial fibrillation",
+]
+
+
+@pytest.fixture
+def cached(corpus, make_matcher):
+    matcher = make_matcher(*corpus)
+    matcher.result_cache = build_result_cache(matcher, QUERIES, conditions=10, depth=20)
+    return matcher
+
+
+def uncached_rank(matcher, query, **kwargs):
+    cache, matcher.result_cache = matcher.result_cache, None
+    try:
+        return matcher.rank(query, **kwargs)
+    finally:
+        matcher.result_cache = cache
+
+
+@pytest.mark.parametrize('top_k', [-1, 0, 1, 5, 20, 21, None])
+@pytest.mark.parametrize('threshold', [None, -1.0, 0.2])
+def test_cached_answer_equals_uncached(cached, top_k, threshold):
+    for query in QUERIES:
+        got = cached.rank(query, top_k=top_k, similarity_threshold=threshold)
+        expected = uncached_rank(cached, query, top_k=top_k, similarity_threshold=threshold)
+        assert [i for i, _ in got] == [i for i, _ in expected]
+        assert [s for _, s in got] == pytest.approx([s for _, s in expected], abs=1e-6)
+
+
+def test_only_answerable_top_k_hit_the_cache(cached):
+    cache = cached.result_cache
+    cached.rank(QUERIES[0], top_k=5)
+    assert cache.hits == 1
+    for top_k in (-1, 0, 21, None):
+        cached.rank(QUERIES[0], top_k=top_k)
+    assert cache.hits == 1
+
+
+def test_near_duplicate_query_text_hits(cached):
+    cache = cached.result_cache
+    assert cached.rank("  Heart   FAILURE ", top_k=5) == uncached_rank(cached, "heart failure", top_k=5)
+    assert cache.hits == 1
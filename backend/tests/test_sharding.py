@@ -0,0 +1,92 @@
+import pandas as pd
+import pytest
+
+from sharding import ShardedMatcher, ShardUnavailable, shard_of
+
+QUERIES = [
+    "Patient with heart failure looking for clinical trials",
+    "Elderly patient with atrial fibrillation",
+    "Heart attack survivor seeking rehabilitation studies",
+    "congenital heart disease in children",
+    "hypertension medication study",
+]
+
+
+@pytest.fixture
+def sharded(model):
+    matchers = []
+
+    def start(csv_file, embeddings_file, n_shards=3, **kwargs):
+        matcher = ShardedMatcher(csv_file, embeddings_file, n_shards, model=model, timeout=10.0, **kwargs)
+        matchers.append(matcher)
+        return matcher.start()
+
+    yield start
+    for matcher in matchers:
+        matcher.close()
+
+
+def ranked(matches):
+    """Scores in order, with the ids grouped by score: trials tied on score may come back in either order."""
+    groups = {}
+    for m in matches:
+        groups.setdefault(round(m['similarity'], 5), set()).add(m['nct_id'])
+    return [round(m['similarity'], 5) for m in matches], groups
+
+
+def assert_same_ranking(got, expected):
+    got_scores, got_groups = ranked(got)
+    expected_scores, expected_groups = ranked(expected)
+    assert got_scores == expected_scores
+    # Which of the trials tied at the cut-off make it into the top-k is arbitrary
+    last = expected_scores[-1] if expected_scores else None
+    assert {s: g for s, g in got_groups.items() if s != last} == {s: g for s, g in expected_groups.items() if s != last}
+
+
+def test_sharded_top_k_equals_single_process(corpus, make_matcher, sharded):
+    single = make_matcher(*corpus)
+    matcher = sharded(*corpus)
+    assert matcher.corpus_size == len(single.trials_data)
+    assert len({shard_of(n, 3) for n in single.trials_data['NCTId']}) == 3
+    for query in QUERIES:
+        for top_k in (1, 10, 40):
+            expected = single.find_matches(query, top_k=top_k, similarity_threshold=-1.0)
+            assert_same_ranking(matcher.find_matches(query, top_k=top_k, similarity_threshold=-1.0), expected)
+
+
+def test_shards_pair_vectors_by_nct_id_after_same_size_refresh(corpus, make_matcher, sharded):
+    csv_file, embeddings_file = corpus
+    make_matcher(csv_file, embeddings_file)
+    # Same row count, different order: the embeddings file must not be paired by position
+    pd.read_csv(csv_file).iloc[::-1].to_csv(csv_file, index=False)
+    matcher = sharded(csv_file, embeddings_file)
+    single = make_matcher(csv_file, embeddings_file)
+    for query in QUERIES:
+        expected = single.find_matches(query, top_k=10, similarity_threshold=-1.0)
+        assert_same_ranking(matcher.find_matches(query, top_k=10, similarity_threshold=-1.0), expected)
+
+
+def test_shards_refuse_embeddings_out_of_sync_with_csv(corpus, make_matcher, model):
+    csv_file, embeddings_file = corpus
+    make_matcher(csv_file, embeddings_file)
+    trials = pd.read_csv(csv_file)
+    trials.loc[0, 'BriefTitle'] = 'A retitled trial whose stored vector is stale'
+    trials.to_csv(csv_file, index=False)
+    matcher = ShardedMatcher(csv_file, embeddings_file, 2, model=model)
+    with pytest.raises(ValueError, match="no row"):
+        matcher.start()
+    assert matcher._shm is None
+
+
+def test_dead_shard_fails_fast_and_frees_its_slot(corpus, make_matcher, sharded):
+    make_matcher(*corpus)
+    matcher = sharded(*corpus, n_shards=2, slots=4)
+    assert matcher.find_matches(QUERIES[0], top_k=3)
+    process = matcher._processes[1]
+    process.kill()
+    process.join(5)
+    with pytest.raises(ShardUnavailable):
+        matcher.find_matches(QUERIES[0], top_k=3)
+    assert matcher.dead_shards() == [1]
+    assert matcher._free_slots.qsize() == 4
+    assert not matcher._pending
@@ -0,0 +1,51 @@
+import numpy as np
+
+from similarity_graph import NeighborGraph, build_neighbor_graph, refresh_neighbor_graph
+
+
+def clustered(rng, n, dim=32, clusters=12):
+    centers = rng.normal(size=(clusters, dim))
+    return (centers[rng.integers(clusters, size=n)] + rng.normal(0, 0.3, size=(n, dim))).astype(np.float32)
+
+
+def neighbor_sets(graph):
+    return {nct_id: {n for n, _ in graph.neighbors(nct_id)} for nct_id in graph.nct_ids}
+
+
+def test_incremental_refresh_equals_full_rebuild(tmp_path):
+    rng = np.random.default_rng(0)
+    nct_ids = [f"NCT{i:08d}" for i in range(300)]
+    embeddings = clustered(rng, 300)
+    graph = build_neighbor_graph(nct_ids, embeddings, k=8, block_size=64)
+    graph.save(str(tmp_path / 'graph.npz'))
+
+    # Drop 10 trials, re-embed 10 and add 15 new ones
+    keep = np.ones(300, dtype=bool)
+    keep[rng.choice(300, 10, replace=False)] = False
+    new_ids = [n for n, k in zip(nct_ids, keep) if k] + [f"NCT9{i:07d}" for i in range(15)]
+    new_embeddings = np.concatenate([embeddings[keep], clustered(rng, 15)])
+    changed = rng.choice(len(new_ids) - 15, 10, replace=False)
+    new_embeddings[changed] += rng.normal(0, 0.5, size=(10, new_embeddings.shape[1])).astype(np.float32)
+
+    refreshed, stats = refresh_neighbor_graph(NeighborGraph.load(str(tmp_path / 'graph.npz')),
+                                              new_ids, new_embeddings, block_size=64)
+    rebuilt = build_neighbor_graph(new_ids, new_embeddings, k=8, block_size=64)
+
+    assert stats['changed'] == 25 and stats['removed'] == 10
+    assert stats['recomputed_rows'] < len(new_ids)
+    assert refreshed.is_current(new_ids, new_embeddings)
+    assert neighbor_sets(refreshed) == neighbor_sets(rebuilt)
+    for nct_id in new_ids:
+        got = [s for _, s in refreshed.neighbors(nct_id)]
+        expected = [s for _, s in rebuilt.neighbors(nct_id)]
+        np.testing.assert_allclose(got, expected, atol=1e-3)
+
+
+def test_refresh_of_unchanged_corpus_recomputes_nothing():
+    rng = np.random.default_rng(1)
+    nct_ids = [f"NCT{i:08d}" for i in range(100)]
+    embeddings = clustered(rng, 100)
+    graph = build_neighbor_graph(nct_ids, embeddings, k=5)
+    refreshed, stats = refresh_neighbor_graph(graph, nct_ids, embeddings)
+    assert stats['changed'] == 0 and stats['recomputed_rows'] == 0
+    assert neighbor_sets(refreshed) == neighbor_sets(graph)
@@ -0,0 +1,133 @@
+"""
+Row-level helpers shared by the matcher, its engines and shard workers.
+
+Kept free of model/torch imports so shard worker processes can use them
+without loading the sentence-transformer stack.
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# Response field -> CSV column for match results (mirrors TrialResponse in bert_api.py)
+MATCH_FIELDS = {
+    'nct_id': 'NCTId',
+    'title': 'BriefTitle',
+    'condition': 'Condition',
+    'summary': 'BriefSummary',
+    'inclusion': 'InclusionCriteria',
+    'exclusion': 'ExclusionCriteria',
+    'country': 'LocationCountry',
+    'status': 'OverallStatus',
+    'phase': 'Phase',
+    'enrollment': 'EnrollmentCount',
+    'contact_name': 'ContactName',
+    'contact_role': 'ContactRole',
+    'contact_phone': 'ContactPhone',
+    'contact_email': 'ContactEmail',
+    'lead_sponsor': 'LeadSponsor',
+    'sponsor_type': 'SponsorType',
+    # NCTIds folded into this trial by dedup.py
+    'duplicates': 'DuplicateNCTIds',
+    'similarity': None,
+}
+DUPLICATES_COLUMN = 'DuplicateNCTIds'
+
+
+def clean_value(val):
+    if pd.isna(val) or val == 'N/A' or val == '':
+        return None
+    return str(val).strip()
+
+
+def duplicate_ids(value) -> List[str]:
+    """The ';'-separated NCTIds of a DuplicateNCTIds cell."""
+    value = clean_value(value)
+    return value.split(';') if value else []
+
+
+def trial_text(trial: pd.Series) -> str:
+    """The text a trial is embedded (and deduplicated) by."""
+    return f"""
+            Condition: {trial.get('Condition', '')}
+            Title: {trial.get('BriefTitle', '')}
+            Summary: {trial.get('BriefSummary', '')}
+            Inclusion Criteria: {trial.get('InclusionCriteria', '')}
+            Exclusion Criteria: {trial.get('ExclusionCriteria', '')}
+            Intervention: {trial.get('InterventionName', '')}
+            Phase: {trial.get('Phase', '')}
+            Status: {trial.get('OverallStatus', '')}
+            Location: {trial.get('LocationCountry', '')}
+            Sponsor: {trial.get('LeadSponsor', '')}
+            """.strip()
+
+
+def resolve_fields(fields: Optional[List[str]]) -> Optional[List[str]]:
+    """Validate a field projection; nct_id and similarity are always returned."""
+    if fields is None:
+        return None
+    unknown = [f for f in fields if f not in MATCH_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return ['nct_id'] + [f for f in dict.fromkeys(fields) if f not in ('nct_id', 'similarity')]
+
+
+def top_k_indices(scores: np.ndarray, top_k: Optional[int]) -> np.ndarray:
+    """Indices of the top_k highest scores, best first, without sorting the whole array."""
+    n = len(scores)
+    top_k = n if top_k is None else max(0, min(top_k, n))
+    if top_k == 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k] if top_k < n else np.arange(n)
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def materialize_row(trials_data: pd.DataFrame, idx: int, similarity: float,
+                    fields: Optional[List[str]] = None) -> Dict:
+    """Build a match dict from only the requested columns of one row."""
+    columns = trials_data.columns
+    match = {}
+    for field in fields or MATCH_FIELDS:
+        column = MATCH_FIELDS.get(field)
+        if column is None:
+            continue
+        if column not in columns:
+            match[field] = None
+            continue
+        value = trials_data.iat[idx, columns.get_loc(column)]
+        match[field] = duplicate_ids(value) if column == DUPLICATES_COLUMN else clean_value(value)
+    match['similarity'] = float(similarity)
+    return match
+
+
+def trial_details(trial: pd.Series) -> Dict:
+    return {
+        'nct_id': clean_value(trial.get('NCTId')),
+        'title': clean_value(trial.get('BriefTitle')),
+        'official_title': clean_value(trial.get('OfficialTitle')),
+        'condition': clean_value(trial.get('Condition')),
+        'summary': clean_value(trial.get('BriefSummary')),
+        'inclusion': clean_value(trial.get('InclusionCriteria')),
+        'exclusion': clean_value(trial.get('ExclusionCriteria')),
+        'country': clean_value(trial.get('LocationCountry')),
+        'status': clean_value(trial.get('OverallStatus')),
+        'phase': clean_value(trial.get('Phase')),
+        'enrollment': clean_value(trial.get('EnrollmentCount')),
+        'study_type': clean_value(trial.get('StudyType')),
+        'start_date': clean_value(trial.get('StartDate')),
+        'completion_date': clean_value(trial.get('CompletionDate')),
+        'intervention': clean_value(trial.get('InterventionName')),
+        'primary_outcome': clean_value(trial.get('PrimaryOutcomeMeasure')),
+        'contact_name': clean_value(trial.get('ContactName')),
+        'contact_role': clean_value(trial.get('ContactRole')),
+        'contact_phone': clean_value(trial.get('ContactPhone')),
+        'contact_email': clean_value(trial.get('ContactEmail')),
+        'lead_sponsor': clean_value(trial.get('LeadSponsor')),
+        'sponsor_type': clean_value(trial.get('SponsorType')),
+        'gender': clean_value(trial.get('Gender')),
+        'min_age': clean_value(trial.get('MinimumAge')),
+        'max_age': clean_value(trial.get('MaximumAge')),
+        'age_groups': clean_value(trial.get('StdAges')),
+        'healthy_volunteers': clean_value(trial.get('HealthyVolunteers')),
+        'duplicates': duplicate_ids(trial.get(DUPLICATES_COLUMN))
+    }
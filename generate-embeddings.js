@@ -49,6 +49,19 @@ async function generateEmbeddings() {
 
   fs.writeFileSync(outputPath, JSON.stringify(embeddingsDict, null, 2));
   console.log(`Embeddings saved to ${outputPath}`);
+
+  // Binary export read by api/bert-match.js (layout in backend/embedding_export.py); rows are already unit length
+  const ids = Object.keys(embeddingsDict);
+  const vectors = new Float32Array(ids.length * 384);
+  ids.forEach((id, index) => vectors.set(embeddingsDict[id], index * 384));
+  fs.writeFileSync(path.join(__dirname, 'trial_embeddings.bin'), Buffer.from(vectors.buffer));
+  fs.writeFileSync(
+    path.join(__dirname, 'trial_embeddings.ids.json'),
+    JSON.stringify({ dtype: 'float32', dim: 384, count: ids.length, scales: null, ids })
+  );
+  // Row digests from a previous Python export no longer describe this file
+  fs.rmSync(path.join(__dirname, 'trial_embeddings.digests'), { force: true });
+  console.log(`Binary export saved to ${path.join(__dirname, 'trial_embeddings.bin')}`);
 }
 
 generateEmbeddings().catch(console.error); 
\ No newline at end of file